@@ -12,6 +12,9 @@ from erpnext.healthcare.doctype.healthcare_settings.healthcare_settings import (
     get_account,
 )
 from hms_tz.hms_tz.doctype.lab_test.lab_test import create_sample_doc
+from hms_tz.hms_tz.doctype.patient_appointment.patient_appointment import (
+    set_appointment_status,
+)
 from erpnext.stock.stock_ledger import get_previous_sle
 from erpnext.stock.get_item_details import get_item_details
 from frappe.model.mapper import get_mapped_doc
@@ -47,9 +50,7 @@ class ClinicalProcedure(Document):
                 self.name,
             )
         if self.appointment:
-            frappe.db.set_value(
-                "Patient Appointment", self.appointment, "status", "Closed"
-            )
+            set_appointment_status(self.appointment, "Closed")
         template = frappe.get_doc(
             "Clinical Procedure Template", self.procedure_template
         )
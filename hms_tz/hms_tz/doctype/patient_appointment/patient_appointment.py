@@ -24,6 +24,10 @@ class Overlappingerror(frappe.ValidationError):
     pass
 
 
+# seconds a practitioner's day calendar or a day's appointments stay cached
+SLOT_CALENDAR_TTL = 6 * 60 * 60
+
+
 class PatientAppointment(Document):
     def validate(self):
         self.validate_overlaps()
@@ -39,6 +43,16 @@ class PatientAppointment(Document):
         send_confirmation_msg(self)
         # make_insurance_claim(self)
 
+    def on_update(self):
+        doc_before_save = self.get_doc_before_save()
+        clear_appointment_day_cache([
+            self.appointment_date,
+            doc_before_save and doc_before_save.appointment_date
+        ])
+
+    def on_trash(self):
+        clear_appointment_day_cache([self.appointment_date])
+
     def set_title(self):
         self.title = _('{0} with {1}').format(self.patient_name or self.patient,
                                               self.practitioner_name or self.practitioner)
@@ -54,55 +68,48 @@ class PatientAppointment(Document):
             self.status = 'Scheduled'
 
     def validate_overlaps(self):
-        end_time = datetime.datetime.combine(getdate(self.appointment_date), get_time(self.appointment_time)) \
-            + datetime.timedelta(minutes=flt(self.duration))
+        start_time = datetime.datetime.combine(getdate(self.appointment_date), get_time(self.appointment_time))
+        # a datetime, so appointments running past midnight keep their end
+        end_time = start_time + datetime.timedelta(minutes=flt(self.duration))
+        self.appointment_end_time = end_time
 
-        query = """
-		select
-			name, practitioner, patient, appointment_time, duration
-		from
-			`tabPatient Appointment`
-		where
-			appointment_date=%(appointment_date)s and name!=%(name)s and status NOT IN ("Closed", "Cancelled")
-			and (practitioner=%(practitioner)s or patient=%(patient)s) and
-			((appointment_time<%(appointment_time)s and appointment_time + INTERVAL duration MINUTE>%(appointment_time)s) or
-			(appointment_time>%(appointment_time)s and appointment_time<%(end_time)s) or
-			(appointment_time=%(appointment_time)s))
-		"""
+        # capacity settings of the service unit and the availability in one lookup
+        service_unit = frappe._dict()
+        if self.service_unit:
+            service_unit = frappe.db.sql("""
+			select
+				hsu.overlap_appointments, hsu.total_service_unit_capacity, hsu.company,
+				pa.total_service_unit_capacity as availability_capacity
+			from
+				`tabHealthcare Service Unit` hsu
+			left join `tabPractitioner Availability` pa on pa.name = %(practitioner_availability)s
+			where
+				hsu.name = %(service_unit)s
+			""", {'service_unit': self.service_unit, 'practitioner_availability': self.practitioner_availability or ''},
+                as_dict=True)
+            service_unit = service_unit[0] if service_unit else frappe._dict()
+
+        overlaps = get_overlapping_appointments(self, start_time, end_time)
 
         # service unit overlap
-        if self.service_unit:
-            query += """ and service_unit=%(service_unit)s"""
-            overlaps = frappe.db.sql(query.format(), {'appointment_date': self.appointment_date, 'name': self.name, 'practitioner': self.practitioner,
-                                                      'patient': self.patient, 'appointment_time': self.appointment_time,  'end_time': end_time.time(), 'service_unit': self.service_unit})
-            allow_overlap = frappe.get_value(
-                'Healthcare Service Unit', self.service_unit, 'overlap_appointments')
-            if allow_overlap:
-                if self.practitioner_availability:
-                    service_unit_capacity = frappe.get_value(
-                        'Practitioner Availability', self.practitioner_availability, 'total_service_unit_capacity')
-                else:
-                    service_unit_capacity = frappe.get_value(
-                        'Healthcare Service Unit', self.service_unit, 'total_service_unit_capacity')
+        if self.service_unit and service_unit.overlap_appointments:
+            if self.practitioner_availability:
+                service_unit_capacity = service_unit.availability_capacity
+            else:
+                service_unit_capacity = service_unit.total_service_unit_capacity
 
-                if service_unit_capacity and len(overlaps) >= int(service_unit_capacity):
-                    frappe.throw(_(""" Not Allowed, Maximum capacity reached Service unit {0}""").format(
-                        self.service_unit), Maximumcapacityerror)
-                else:
-                    overlaps = False
-        else:
-            overlaps = frappe.db.sql(query.format(), {"appointment_date": self.appointment_date, "name": self.name, "practitioner": self.practitioner,
-                                                      "patient": self.patient, "appointment_time": self.appointment_time,  "end_time": end_time.time()})
+            if service_unit_capacity and len(overlaps) >= int(service_unit_capacity):
+                frappe.throw(_(""" Not Allowed, Maximum capacity reached Service unit {0}""").format(
+                    self.service_unit), Maximumcapacityerror)
+            else:
+                overlaps = False
 
         if overlaps:
             frappe.throw(_("""Appointment overlaps with {0}.<br> {1} has appointment scheduled
 			with {2} at {3} having {4} minute(s) duration.""").format(overlaps[0][0], overlaps[0][1], overlaps[0][2], overlaps[0][3], overlaps[0][4]), Overlappingerror)
 
-        if self.service_unit:
-            service_unit_company = frappe.db.get_value(
-                "Healthcare Service Unit", self.service_unit, "company")
-            if service_unit_company and service_unit_company != self.company:
-                self.company = service_unit_company
+        if service_unit.company and service_unit.company != self.company:
+            self.company = service_unit.company
 
     def set_appointment_datetime(self):
         self.appointment_datetime = "%s %s" % (
@@ -137,6 +144,39 @@ class PatientAppointment(Document):
                 self.patient, fee_validity.valid_till))
 
 
+def get_overlapping_appointments(doc, start_time, end_time):
+    """Open appointments of the practitioner or the patient overlapping doc's
+    time, read through the (date, practitioner|patient, time) indexes with
+    the stored end time. Appointments of the day before are included, as
+    they may run past midnight. An appointment starting at the same time
+    always overlaps, even with zero duration."""
+    query = """
+		select
+			name, practitioner, patient, appointment_time, duration
+		from
+			`tabPatient Appointment`
+		where
+			appointment_date in %(appointment_dates)s and {0}=%({0})s and name!=%(name)s
+			and status NOT IN ("Closed", "Cancelled")
+			and ((timestamp(appointment_date, appointment_time)<%(end_time)s
+				and appointment_end_time>%(start_time)s) or
+			(appointment_date=%(appointment_date)s and appointment_time=%(appointment_time)s))
+			{1}
+		"""
+    values = {'appointment_date': start_time.date(), 'name': doc.name, 'practitioner': doc.practitioner,
+              'appointment_dates': [start_time.date() - datetime.timedelta(days=1), start_time.date()],
+              'patient': doc.patient, 'appointment_time': doc.appointment_time,
+              'start_time': start_time, 'end_time': end_time, 'service_unit': doc.service_unit}
+    service_unit_condition = 'and service_unit=%(service_unit)s' if doc.service_unit else ''
+
+    overlaps = []
+    for field in ('practitioner', 'patient'):
+        for row in frappe.db.sql(query.format(field, service_unit_condition), values):
+            if row[0] not in [r[0] for r in overlaps]:
+                overlaps.append(row)
+    return overlaps
+
+
 @frappe.whitelist()
 def check_payment_fields_reqd(patient):
     automate_invoicing = frappe.db.get_single_value(
@@ -287,6 +327,52 @@ def get_availability_data(date, practitioner):
     """
 
     date = getdate(date)
+    calendar = get_slot_calendar(practitioner, date)
+    appointments = get_day_appointments(date)
+
+    return {
+        'slot_details': merge_booked_appointments(calendar['slot_details'], appointments),
+        'present_events': merge_booked_appointments(calendar['present_events'], appointments)
+    }
+
+
+@frappe.whitelist()
+def get_availability_data_for_week(date, practitioner, days=7):
+    """Availability of 'practitioner' for 'days' days starting on 'date', days
+    the practitioner is not available carry the reason in 'error'"""
+    week = []
+    for i in range(min(int(days), 31)):
+        day = add_days(getdate(date), i)
+        try:
+            data = get_availability_data(day, practitioner)
+        except frappe.ValidationError as e:
+            frappe.clear_messages()
+            data = {'error': str(e)}
+        data['date'] = day
+        week.append(data)
+    return week
+
+
+def get_slot_calendar_version(practitioner):
+    # the site wide part is bumped by holiday changes, which may affect anyone
+    return '{0}.{1}'.format(
+        frappe.cache().get_value('slot_calendar_version') or '',
+        frappe.cache().get_value('slot_calendar_version|' + practitioner) or '')
+
+
+def get_slot_calendar(practitioner, date):
+    """The slot groups of 'practitioner' on 'date' without the booked
+    appointments, built once and kept until a source document changes"""
+    key = 'slot_calendar|{0}|{1}|{2}'.format(
+        practitioner, get_slot_calendar_version(practitioner), date)
+    calendar = frappe.cache().get_value(key)
+    if calendar is None:
+        calendar = build_slot_calendar(practitioner, date)
+        frappe.cache().set_value(key, calendar, expires_in_sec=SLOT_CALENDAR_TTL)
+    return calendar
+
+
+def build_slot_calendar(practitioner, date):
     weekday = date.strftime('%A')
 
     practitioner_doc = frappe.get_doc('Healthcare Practitioner', practitioner)
@@ -295,9 +381,10 @@ def get_availability_data(date, practitioner):
     present_events = get_present_event(practitioner, date)
 
     if practitioner_doc.practitioner_schedules or present_events:
-        slot_details = get_available_slots(practitioner_doc, date)
+        absent_events = get_absent_event(practitioner, date)
+        slot_details = get_available_slots(practitioner_doc, date, absent_events)
         present_events = get_present_event_slots(
-            present_events, date, practitioner)
+            present_events, date, practitioner, absent_events)
     else:
         frappe.throw(_('{0} does not have a Healthcare Practitioner Schedule. Add it in Healthcare Practitioner master').format(
             practitioner), title=_('Practitioner Schedule Not Found'))
@@ -313,6 +400,123 @@ def get_availability_data(date, practitioner):
     }
 
 
+def get_day_appointments(date):
+    """All not cancelled appointments on 'date', shared by every practitioner
+    and service unit calendar of the day"""
+    key = 'appointments_by_day|{0}'.format(date)
+    appointments = frappe.cache().get_value(key)
+    if appointments is None:
+        appointments = frappe.get_all(
+            'Patient Appointment',
+            filters={'appointment_date': date, 'status': ['not in', ['Cancelled']]},
+            fields=['name', 'practitioner', 'patient', 'service_unit',
+                    'appointment_time', 'duration', 'status'],
+            order_by='appointment_time')
+        frappe.cache().set_value(key, appointments, expires_in_sec=SLOT_CALENDAR_TTL)
+    return appointments
+
+
+def merge_booked_appointments(slot_groups, appointments):
+    """Attach the appointments each slot group is booked by, and the number
+    of them overlapping each slot"""
+    merged = []
+    for group in slot_groups:
+        filters = group['appointment_filters']
+        booked = [
+            frappe._dict({
+                'name': a.name, 'appointment_time': a.appointment_time,
+                'duration': a.duration, 'status': a.status
+            })
+            for a in appointments
+            if all(a.get(field) == value for field, value in filters.items())
+        ]
+        details = {k: v for k, v in group.items() if k != 'appointment_filters'}
+        details['appointments'] = booked
+        details['avail_slot'] = [
+            dict(slot, booked_count=get_booked_count(slot, booked))
+            for slot in group['avail_slot']
+        ]
+        merged.append(details)
+    return merged
+
+
+def get_booked_count(slot, appointments):
+    from_time = get_timedelta(slot['from_time'])
+    to_time = get_timedelta(slot['to_time'])
+    count = 0
+    for appointment in appointments:
+        start = get_timedelta(appointment.appointment_time)
+        end = start + datetime.timedelta(minutes=flt(appointment.duration))
+        if start == from_time or (start < to_time and end > from_time):
+            count += 1
+    return count
+
+
+def get_timedelta(value):
+    if isinstance(value, datetime.timedelta):
+        return value
+    value = get_time(value)
+    return datetime.timedelta(hours=value.hour, minutes=value.minute, seconds=value.second)
+
+
+def get_appointment_filters(practitioner, service_unit, allow_overlap):
+    # fetch all appointments to practitioner by service unit
+    if not service_unit:
+        # fetch all appointments to practitioner without service unit
+        return {'practitioner': practitioner}
+    if not allow_overlap:
+        # fetch all appointments to service unit
+        return {'service_unit': service_unit}
+    return {'practitioner': practitioner, 'service_unit': service_unit}
+
+
+def clear_slot_calendar(practitioners):
+    for practitioner in set(practitioners):
+        if practitioner:
+            frappe.cache().set_value(
+                'slot_calendar_version|' + practitioner, frappe.generate_hash(length=10))
+
+
+def clear_slot_calendar_cache(doc, method=None):
+    """Invalidate the slot calendars built from 'doc'"""
+    if doc.doctype == 'Healthcare Practitioner':
+        practitioners = [doc.name]
+    elif doc.doctype == 'Practitioner Availability':
+        practitioners = [doc.practitioner]
+    elif doc.doctype == 'Practitioner Schedule':
+        practitioners = frappe.get_all(
+            'Practitioner Service Unit Schedule',
+            filters={'schedule': doc.name, 'parenttype': 'Healthcare Practitioner'},
+            pluck='parent')
+    elif doc.doctype in ('Leave Application', 'Employee'):
+        employee = doc.name if doc.doctype == 'Employee' else doc.employee
+        user_id = frappe.get_cached_value('Employee', employee, 'user_id')
+        practitioners = frappe.get_all(
+            'Healthcare Practitioner',
+            or_filters={'employee': employee, 'user_id': user_id or employee},
+            pluck='name')
+    elif doc.doctype == 'Holiday List':
+        frappe.cache().set_value('slot_calendar_version', frappe.generate_hash(length=10))
+        return
+    else:
+        return
+    clear_slot_calendar(practitioners)
+
+
+def clear_appointment_day_cache(dates):
+    for date in set(dates):
+        if date:
+            frappe.cache().delete_value('appointments_by_day|{0}'.format(getdate(date)))
+
+
+def set_appointment_status(appointment, status):
+    """Set the status without saving the appointment, clearing its cached
+    day as on_update would"""
+    frappe.db.set_value('Patient Appointment', appointment, 'status', status)
+    clear_appointment_day_cache([frappe.db.get_value(
+        'Patient Appointment', appointment, 'appointment_date')])
+
+
 def check_employee_wise_availability(date, practitioner_doc):
     employee = None
     if practitioner_doc.employee:
@@ -386,7 +590,7 @@ def get_absent_event(practitioner, date):
     return absent_events if absent_events else []
 
 
-def get_available_slots(practitioner_doc, date):
+def get_available_slots(practitioner_doc, date, absent_events):
     available_slots = []
     slot_details = []
     weekday = date.strftime('%A')
@@ -404,47 +608,30 @@ def get_available_slots(practitioner_doc, date):
             available_slots = []
             for time_slot in practitioner_schedule.time_slots:
                 if weekday == time_slot.day:
-                    available_slots.append(time_slot)
+                    available_slots.append({
+                        'day': time_slot.day, 'from_time': time_slot.from_time, 'to_time': time_slot.to_time})
 
             if available_slots:
-                appointments = []
                 allow_overlap = 0
                 service_unit_capacity = 0
-                # fetch all appointments to practitioner by service unit
-                filters = {
-                    'practitioner': practitioner,
-                    'service_unit': schedule_entry.service_unit,
-                    'appointment_date': date,
-                    'status': ['not in', ['Cancelled']]
-                }
 
                 if schedule_entry.service_unit:
                     slot_name = schedule_entry.schedule + ' - ' + schedule_entry.service_unit
                     allow_overlap, service_unit_capacity = frappe.get_value('Healthcare Service Unit', schedule_entry.service_unit, [
                                                                             'overlap_appointments', 'total_service_unit_capacity'])
-                    if not allow_overlap:
-                        # fetch all appointments to service unit
-                        filters.pop('practitioner')
                 else:
                     slot_name = schedule_entry.schedule
-                    # fetch all appointments to practitioner without service unit
-                    filters['practitioner'] = practitioner
-                    filters.pop('service_unit')
-
-                appointments = frappe.get_all(
-                    'Patient Appointment',
-                    filters=filters,
-                    fields=['name', 'appointment_time', 'duration', 'status'])
 
-                absent_events = get_absent_event(practitioner, date)
+                appointment_filters = get_appointment_filters(
+                    practitioner, schedule_entry.service_unit, allow_overlap)
 
                 slot_details.append({'slot_name': slot_name, 'service_unit': schedule_entry.service_unit, 'absent_events': absent_events,
-                                     'avail_slot': available_slots, 'appointments': appointments,  'allow_overlap': allow_overlap, 'service_unit_capacity': service_unit_capacity})
+                                     'avail_slot': available_slots, 'appointment_filters': appointment_filters,  'allow_overlap': allow_overlap, 'service_unit_capacity': service_unit_capacity})
 
     return slot_details
 
 
-def get_present_event_slots(present_events, date, practitioner):
+def get_present_event_slots(present_events, date, practitioner, absent_events):
     present_events_details = []
     if present_events:
         remove_events, add_events = remove_events_by_repeat_on(
@@ -465,42 +652,20 @@ def get_present_event_slots(present_events, date, practitioner):
                 event_available_slots.append(
                     {'from_time': from_time, 'to_time': to_time})
                 from_time = to_time
-            appointments = []
             if event_available_slots:
-                appointments = []
                 allow_overlap = 0
                 service_unit_capacity = 0
-                # fetch all appointments to practitioner by service unit
-                filters = {
-                    'practitioner': practitioner,
-                    'service_unit': present_event.service_unit,
-                    'appointment_date': date,
-                    'status': ['not in', ['Cancelled']]
-                }
 
                 if present_event.service_unit:
                     slot_name = slot_name+" - "+present_event.service_unit
                     allow_overlap, service_unit_capacity = frappe.get_value('Healthcare Service Unit', present_event.service_unit, [
                                                                             'overlap_appointments', 'total_service_unit_capacity'])
-                    if not allow_overlap:
-                        # fetch all appointments to service unit
-                        filters.pop('practitioner')
-                else:
-                    # fetch all appointments to practitioner without service unit
-                    filters['practitioner'] = practitioner
-                    filters.pop('service_unit')
-
-                appointments = frappe.get_all(
-                    'Patient Appointment',
-                    filters=filters,
-                    fields=['name', 'appointment_time',
-                            'duration', 'status'],
-                    order_by="appointment_date, appointment_time")
 
-                absent_events = get_absent_event(practitioner, date)
+                appointment_filters = get_appointment_filters(
+                    practitioner, present_event.service_unit, allow_overlap)
 
                 present_events_details.append({'slot_name': slot_name, "service_unit": present_event.service_unit, 'availability': present_event.name,
-                                               'avail_slot': event_available_slots, 'appointments': appointments, 'absent_events': absent_events, 'allow_overlap': allow_overlap, 'service_unit_capacity': service_unit_capacity})
+                                               'avail_slot': event_available_slots, 'appointment_filters': appointment_filters, 'absent_events': absent_events, 'allow_overlap': allow_overlap, 'service_unit_capacity': service_unit_capacity})
     return present_events_details
 
 
@@ -538,8 +703,7 @@ def remove_events_by_repeat_on(events_list, date):
 
 @frappe.whitelist()
 def update_status(appointment_id, status):
-    frappe.db.set_value('Patient Appointment',
-                        appointment_id, 'status', status)
+    set_appointment_status(appointment_id, status)
     appointment_booked = True
     if status == 'Cancelled':
         appointment_booked = False
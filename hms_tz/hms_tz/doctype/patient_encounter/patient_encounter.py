@@ -10,6 +10,7 @@ from frappe.model.document import Document
 from frappe.utils import cstr
 from frappe import _
 from hms_tz.hms_tz.utils import make_healthcare_service_order
+from hms_tz.hms_tz.doctype.patient_appointment.patient_appointment import set_appointment_status
 
 class PatientEncounter(Document):
 	def validate(self):
@@ -23,7 +24,7 @@ class PatientEncounter(Document):
 
 	def on_update(self):
 		if self.appointment:
-			frappe.db.set_value('Patient Appointment', self.appointment, 'status', 'Closed')
+			set_appointment_status(self.appointment, 'Closed')
 		update_encounter_medical_record(self)
 
 	def after_insert(self):
@@ -37,7 +38,7 @@ class PatientEncounter(Document):
 
 	def on_cancel(self):
 		if self.appointment:
-			frappe.db.set_value('Patient Appointment', self.appointment, 'status', 'Open')
+			set_appointment_status(self.appointment, 'Open')
 		delete_medical_record(self)
 
 	def set_title(self):
@@ -11,6 +11,7 @@ from frappe.model.mapper import get_mapped_doc
 from frappe import _
 from frappe.utils import cstr, getdate, get_link_to_form
 from erpnext.healthcare.doctype.healthcare_settings.healthcare_settings import get_receivable_account, get_income_account
+from hms_tz.hms_tz.doctype.patient_appointment.patient_appointment import set_appointment_status
 
 
 class TherapySession(Document):
@@ -48,13 +49,11 @@ class TherapySession(Document):
 
     def on_update(self):
         if self.appointment:
-            frappe.db.set_value('Patient Appointment',
-                                self.appointment, 'status', 'Closed')
+            set_appointment_status(self.appointment, 'Closed')
 
     def on_cancel(self):
         if self.appointment:
-            frappe.db.set_value('Patient Appointment',
-                                self.appointment, 'status', 'Open')
+            set_appointment_status(self.appointment, 'Open')
 
         self.update_sessions_count_in_therapy_plan(on_cancel=True)
 
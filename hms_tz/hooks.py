@@ -157,28 +157,70 @@ doc_events = {
     },
     "Practitioner Availability": {
         "validate": "hms_tz.nhif.api.practitioner_availability.validate",
-        "on_trash": "hms_tz.nhif.api.practitioner_availability.on_trash",
+        "on_update": "hms_tz.hms_tz.doctype.patient_appointment.patient_appointment.clear_slot_calendar_cache",
+        "on_trash": [
+            "hms_tz.nhif.api.practitioner_availability.on_trash",
+            "hms_tz.hms_tz.doctype.patient_appointment.patient_appointment.clear_slot_calendar_cache",
+        ],
+    },
+    "Practitioner Schedule": {
+        "on_update": "hms_tz.hms_tz.doctype.patient_appointment.patient_appointment.clear_slot_calendar_cache",
+        "on_trash": "hms_tz.hms_tz.doctype.patient_appointment.patient_appointment.clear_slot_calendar_cache",
+    },
+    "Healthcare Practitioner": {
+        "on_update": "hms_tz.hms_tz.doctype.patient_appointment.patient_appointment.clear_slot_calendar_cache",
+        "on_trash": "hms_tz.hms_tz.doctype.patient_appointment.patient_appointment.clear_slot_calendar_cache",
+    },
+    "Leave Application": {
+        "on_submit": "hms_tz.hms_tz.doctype.patient_appointment.patient_appointment.clear_slot_calendar_cache",
+        "on_cancel": "hms_tz.hms_tz.doctype.patient_appointment.patient_appointment.clear_slot_calendar_cache",
+        "on_update_after_submit": "hms_tz.hms_tz.doctype.patient_appointment.patient_appointment.clear_slot_calendar_cache",
+    },
+    "Employee": {
+        "on_update": "hms_tz.hms_tz.doctype.patient_appointment.patient_appointment.clear_slot_calendar_cache",
+    },
+    "Holiday List": {
+        "on_update": "hms_tz.hms_tz.doctype.patient_appointment.patient_appointment.clear_slot_calendar_cache",
+        "on_trash": "hms_tz.hms_tz.doctype.patient_appointment.patient_appointment.clear_slot_calendar_cache",
     },
     "Lab Test": {
         "on_submit": "hms_tz.nhif.api.lab_test.on_submit",
-        "after_insert": "hms_tz.nhif.api.lab_test.after_insert",
-        "on_trash": "hms_tz.nhif.api.lab_test.on_trash",
+        "after_insert": [
+            "hms_tz.nhif.api.lab_test.after_insert",
+            "hms_tz.nhif.api.patient_encounter.clear_last_prescribed_cache",
+        ],
+        "on_trash": [
+            "hms_tz.nhif.api.lab_test.on_trash",
+            "hms_tz.nhif.api.patient_encounter.clear_last_prescribed_cache",
+        ],
         "validate": "hms_tz.nhif.api.lab_test.validate",
     },
+    "Lab Test Template": {
+        "on_update": "hms_tz.nhif.api.lab_test.clear_reference_ranges_cache",
+        "on_trash": "hms_tz.nhif.api.lab_test.clear_reference_ranges_cache",
+    },
     "Radiology Examination": {
         "on_submit": "hms_tz.nhif.api.radiology_examination.on_submit",
         "validate": "hms_tz.nhif.api.radiology_examination.validate",
+        "after_insert": "hms_tz.nhif.api.patient_encounter.clear_last_prescribed_cache",
+        "on_trash": "hms_tz.nhif.api.patient_encounter.clear_last_prescribed_cache",
     },
     "Clinical Procedure": {
         "on_submit": "hms_tz.nhif.api.clinical_procedure.on_submit",
         "validate": "hms_tz.nhif.api.clinical_procedure.validate",
+        "after_insert": "hms_tz.nhif.api.patient_encounter.clear_last_prescribed_cache",
+        "on_trash": "hms_tz.nhif.api.patient_encounter.clear_last_prescribed_cache",
     },
     "Delivery Note": {
         "validate": "hms_tz.nhif.api.delivery_note.validate",
         "onload": "hms_tz.nhif.api.delivery_note.onload",
         "after_insert": "hms_tz.nhif.api.delivery_note.after_insert",
         "before_submit": "hms_tz.nhif.api.delivery_note.before_submit",
-        "on_submit": "hms_tz.nhif.api.delivery_note.on_submit",
+        "on_submit": [
+            "hms_tz.nhif.api.delivery_note.on_submit",
+            "hms_tz.nhif.api.patient_encounter.clear_last_prescribed_cache",
+        ],
+        "on_cancel": "hms_tz.nhif.api.patient_encounter.clear_last_prescribed_cache",
     },
     "Inpatient Record": {
         "validate": "hms_tz.nhif.api.inpatient_record.validate",
@@ -204,8 +246,16 @@ scheduler_events = {
     # 		"hms_tz.tasks.all"
     # 	],
     # "cron": {"*/1 * * * *": ["hms_tz.nhif.api.service_order.real_auto_submit"]},
+    "all": [
+        "hms_tz.nhif.doctype.nhif_response_log.nhif_response_log.flush_logs",
+        "hms_tz.nhif.doctype.lab_machine_message.lab_machine_message.process_queued_messages",
+    ],
     "hourly": ["hms_tz.nhif.api.healthcare_utils.set_uninvoiced_so_closed"],
-    "daily": ["hms_tz.nhif.api.inpatient_record.daily_update_inpatient_occupancies"],
+    "daily": [
+        "hms_tz.nhif.api.inpatient_record.daily_update_inpatient_occupancies",
+        "hms_tz.nhif.doctype.nhif_response_log.nhif_response_log.prune_logs",
+        "hms_tz.nhif.doctype.nhif_patient_claim.nhif_patient_claim.refresh_stale_claims",
+    ],
     
     "cron": {
         # Routine for every day 00:01 am at night
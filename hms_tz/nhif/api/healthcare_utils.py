@@ -8,12 +8,32 @@ from frappe import _
 import datetime
 
 from hms_tz.hms_tz.utils import validate_customer_created
-from frappe.utils import nowdate, nowtime, now_datetime, add_to_date, get_url_to_form
+from hms_tz.hms_tz.doctype.patient_appointment.patient_appointment import (
+    clear_appointment_day_cache,
+)
+from frappe.utils import nowdate, nowtime, now_datetime, add_to_date, get_url_to_form, cint, flt, cstr, get_datetime
 from datetime import timedelta
 import base64
 import re
 import json
 from frappe.model.workflow import apply_workflow
+from time import perf_counter, time
+
+# worker jobs a month's claims are spread over for auto submission
+AUTO_SUBMIT_CONCURRENCY = 4
+# seconds without progress after which a run is considered dead
+AUTO_SUBMIT_RUN_TIMEOUT = 60 * 60
+# seconds without progress after which a worker's slot is given to a new one
+AUTO_SUBMIT_WORKER_TIMEOUT = 15 * 60
+
+# documents per chunk and default seconds the nightly cleanup may run
+CLEANUP_CHUNK_SIZE = 500
+CLEANUP_TIME_BUDGET = 3 * 60 * 60
+
+# pending invoiced LRP items are picked up from this watermark on
+LRP_WATERMARK_KEY = "hms_tz_lrp_items_watermark"
+LRP_BATCH_SIZE = 200
+LRP_RETRY_DAYS = 3
 
 
 @frappe.whitelist()
@@ -791,108 +811,230 @@ def delete_or_cancel_draft_document():
         2. Delete draft vital signs after every 7 days and
         3. Cancel draft delivery note after every 2 days
     this routine runs every day on 2:30am at night
-    """
 
+    Candidates are paged by name in chunks of CLEANUP_CHUNK_SIZE. The job
+    stops once the `hms_tz_cleanup_time_budget` site config (seconds) is
+    used up and the next run continues after the last processed name.
+    """
+    deadline = perf_counter() + cint(
+        frappe.conf.get("hms_tz_cleanup_time_budget") or CLEANUP_TIME_BUDGET
+    )
     before_7_days_date = add_to_date(nowdate(), days=-7, as_string=False)
     before_2_days_date = add_to_date(nowdate(), days=-2, as_string=False)
 
-    appointments = frappe.db.sql(
-        """
-        SELECT name FROM `tabPatient Appointment` 
-        WHERE status = "Open" AND appointment_date < '{before_7_days_date}'
-    """.format(
-            before_7_days_date=before_7_days_date
+    stages = [
+        (
+            "Patient Appointment",
+            "status = 'Open' AND appointment_date < %(before_date)s",
+            before_7_days_date,
+            cancel_open_appointments,
         ),
-        as_dict=1,
-    )
+        (
+            "Vital Signs",
+            "docstatus = 0 AND signs_date < %(before_date)s",
+            before_7_days_date,
+            delete_draft_vital_signs,
+        ),
+        (
+            "Delivery Note",
+            "docstatus = 0 AND workflow_state != 'Not Serviced' AND posting_date < %(before_date)s",
+            before_2_days_date,
+            lambda names: return_draft_delivery_notes(names, before_2_days_date),
+        ),
+    ]
+    for doctype, conditions, before_date, handler in stages:
+        if not run_cleanup_stage(doctype, conditions, before_date, handler, deadline):
+            break
+
+
+def run_cleanup_stage(doctype, conditions, before_date, handler, deadline):
+    """Feed the candidates of `doctype` to `handler` a chunk at a time,
+    saving the last name as a cursor. Returns False when out of time."""
+    cursor_key = "hms_tz_cleanup_cursor_" + frappe.scrub(doctype)
+    last_name = frappe.db.get_global(cursor_key) or ""
+    while perf_counter() < deadline:
+        names = frappe.db.sql_list(
+            """
+            SELECT name FROM `tab{doctype}`
+            WHERE {conditions} AND name > %(last_name)s
+            ORDER BY name
+            LIMIT %(limit)s
+        """.format(
+                doctype=doctype, conditions=conditions
+            ),
+            {"before_date": before_date, "last_name": last_name, "limit": CLEANUP_CHUNK_SIZE},
+        )
+        if not names:
+            # stage complete, start from the beginning next time
+            frappe.db.set_global(cursor_key, "")
+            frappe.db.commit()
+            return True
 
-    for app_doc in appointments:
         try:
-            doc = frappe.get_doc("Patient Appointment", app_doc.name)
-            doc.status = "Cancelled"
-            doc.save(ignore_permissions=True)
-
+            handler(names)
         except Exception:
+            frappe.db.rollback()
             frappe.log_error(
-                frappe.get_traceback(), str("Error in cancelling draft appointment")
+                frappe.get_traceback(), str("Error in cleaning up {0}".format(doctype))
             )
 
-    vital_docs = frappe.db.sql(
-        """
-        SELECT name FROM `tabVital Signs` 
-        WHERE docstatus = 0 AND signs_date < '{before_7_days_date}'
-    """.format(
-            before_7_days_date=before_7_days_date
+        last_name = names[-1]
+        frappe.db.set_global(cursor_key, last_name)
+        frappe.db.commit()
+    return False
+
+
+def insert_audit_rows(table, columns, rows):
+    if not rows:
+        return
+    frappe.db.sql(
+        "INSERT INTO `tab{0}` ({1}) VALUES {2}".format(
+            table,
+            ", ".join("`{0}`".format(c) for c in columns),
+            ", ".join(["%s"] * len(rows)),
         ),
-        as_dict=1,
+        tuple(rows),
     )
 
-    for vs_doc in vital_docs:
-        try:
-            doc = frappe.get_cached_doc("Vital Signs", vs_doc.name)
-            doc.delete()
-
-        except Exception:
-            frappe.log_error(
-                frappe.get_traceback(), str("Error in deleting draft vital signs")
-            )
-        frappe.db.commit()
 
-    delivery_documents = frappe.db.sql(
-        """
-        SELECT name FROM `tabDelivery Note` 
-        WHERE docstatus = 0
-        AND workflow_state != "Not Serviced"
-        AND posting_date < '{before_2_days_date}'
-    """.format(
-            before_2_days_date=before_2_days_date
-        ),
+def cancel_open_appointments(names):
+    time_stamp = now_datetime()
+    user = frappe.session.user
+    appointments = frappe.db.sql(
+        "SELECT name, appointment_date FROM `tabPatient Appointment` WHERE name IN %(names)s AND status = 'Open' FOR UPDATE",
+        {"names": names},
         as_dict=1,
     )
+    if not appointments:
+        return
+    names = [appointment.name for appointment in appointments]
+    frappe.db.sql(
+        """
+        UPDATE `tabPatient Appointment`
+        SET status = 'Cancelled', modified = %(modified)s, modified_by = %(user)s
+        WHERE name IN %(names)s
+    """,
+        {"names": names, "modified": time_stamp, "user": user},
+    )
+    # same Version entries a save would have tracked
+    data = json.dumps(
+        {"added": [], "changed": [["status", "Open", "Cancelled"]], "removed": [], "row_changed": []}
+    )
+    insert_audit_rows(
+        "Version",
+        ["name", "creation", "modified", "modified_by", "owner", "ref_doctype", "docname", "data"],
+        [
+            (frappe.generate_hash("", 10), time_stamp, time_stamp, user, user, "Patient Appointment", name, data)
+            for name in names
+        ],
+    )
+    clear_appointment_day_cache([appointment.appointment_date for appointment in appointments])
 
-    for delivery_note  in delivery_documents:
-        delivery_note_doc = frappe.get_doc("Delivery Note", delivery_note.name)
-        try:
-            return_quatity_or_cancel_delivery_note_via_lrpmt_returns(delivery_note_doc, "Backend")
-
-        except Exception:
-            frappe.log_error(frappe.get_traceback(), str("Error for Return or Cancel Delivery Note: {0} Via LRPMT Returns".format(frappe.bold(delivery_note_doc.name))))
 
-        frappe.db.commit()
+def delete_draft_vital_signs(names):
+    time_stamp = now_datetime()
+    user = frappe.session.user
+    vital_signs = frappe.get_all(
+        "Vital Signs", filters={"name": ["in", names], "docstatus": 0}, fields=["*"]
+    )
+    if not vital_signs:
+        return
+    # same Deleted Document entries a delete would have left
+    insert_audit_rows(
+        "Deleted Document",
+        ["name", "creation", "modified", "modified_by", "owner", "deleted_doctype", "deleted_name", "data"],
+        [
+            (
+                frappe.generate_hash("", 10),
+                time_stamp,
+                time_stamp,
+                user,
+                user,
+                "Vital Signs",
+                vs.name,
+                frappe.as_json(dict(vs, doctype="Vital Signs")),
+            )
+            for vs in vital_signs
+        ],
+    )
+    frappe.db.sql(
+        "DELETE FROM `tabVital Signs` WHERE name IN %(names)s AND docstatus = 0",
+        {"names": [vs.name for vs in vital_signs]},
+    )
 
 
-@frappe.whitelist()
-def return_quatity_or_cancel_delivery_note_via_lrpmt_returns(source_doc, method):
-    """
-        Return Quantiies to stock from submitted delivery note and/or
-        Cancel draft delivery note if all items was not serviced
-    """
+def return_draft_delivery_notes(names, before_date):
+    """Return the draft delivery notes through one LRPMT Returns per
+    appointment, including the appointment's other notes that are stale too"""
+    delivery_notes = frappe.get_all(
+        "Delivery Note",
+        filters={"name": ["in", names]},
+        fields=["hms_tz_appointment_no"],
+    )
+    appointments = list({dn.hms_tz_appointment_no for dn in delivery_notes if dn.hms_tz_appointment_no})
+    or_filters = {"name": ["in", names]}
+    if appointments:
+        or_filters["hms_tz_appointment_no"] = ["in", appointments]
+    delivery_notes = frappe.get_all(
+        "Delivery Note",
+        filters={
+            "docstatus": 0,
+            "workflow_state": ["!=", "Not Serviced"],
+            # notes newer than the cutoff are still pending
+            "posting_date": ["<", before_date],
+        },
+        or_filters=or_filters,
+        fields=["name", "hms_tz_appointment_no"],
+        order_by="name",
+    )
 
-    source_doc = frappe.get_doc(frappe.parse_json(source_doc))
+    groups = {}
+    for dn in delivery_notes:
+        groups.setdefault(dn.hms_tz_appointment_no or dn.name, []).append(dn.name)
 
-    status = ""
-    if source_doc.docstatus == 1:
-        status = "Submitted"
-    else:
-        status = "Draft"
+    for group in groups.values():
+        try:
+            target_doc = make_lrpmt_returns(
+                [frappe.get_doc("Delivery Note", name) for name in group]
+            )
+            target_doc.insert()
+            target_doc.submit()
+            frappe.db.commit()
 
-    drug_items = []
+        except Exception:
+            frappe.db.rollback()
+            frappe.log_error(frappe.get_traceback(), str("Error for Return or Cancel Delivery Note: {0} Via LRPMT Returns".format(
+                frappe.bold(", ".join(group))
+            )))
 
-    for dni_item in source_doc.items:
-        drug_items.append({
-            "drug_name": dni_item.item_code,
-            "quantity_prescribed": dni_item.qty,
-            "quantity_to_return": dni_item.qty,
-            "reason": "Not Serviced",
-            "drug_condition": "Good",
-            "encounter_no": source_doc.reference_name,
-            "delivery_note_no": source_doc.name,
-            "status": status,
-            "dn_detail": dni_item.name,
-            "child_name": dni_item.reference_name
-        })
 
-    target_doc = frappe.get_doc(
+def make_lrpmt_returns(delivery_notes):
+    """LRPMT Returns of all items of the delivery notes, which belong to the
+    same patient and appointment"""
+    drug_items = []
+    for source_doc in delivery_notes:
+        status = ""
+        if source_doc.docstatus == 1:
+            status = "Submitted"
+        else:
+            status = "Draft"
+
+        for dni_item in source_doc.items:
+            drug_items.append({
+                "drug_name": dni_item.item_code,
+                "quantity_prescribed": dni_item.qty,
+                "quantity_to_return": dni_item.qty,
+                "reason": "Not Serviced",
+                "drug_condition": "Good",
+                "encounter_no": source_doc.reference_name,
+                "delivery_note_no": source_doc.name,
+                "status": status,
+                "dn_detail": dni_item.name,
+                "child_name": dni_item.reference_name
+            })
+
+    source_doc = delivery_notes[0]
+    return frappe.get_doc(
         dict(
             doctype = "LRPMT Returns",
             patient = source_doc.patient,
@@ -903,6 +1045,17 @@ def return_quatity_or_cancel_delivery_note_via_lrpmt_returns(source_doc, method)
         )
     )
 
+
+@frappe.whitelist()
+def return_quatity_or_cancel_delivery_note_via_lrpmt_returns(source_doc, method):
+    """
+        Return Quantiies to stock from submitted delivery note and/or
+        Cancel draft delivery note if all items was not serviced
+    """
+
+    source_doc = frappe.get_doc(frappe.parse_json(source_doc))
+    target_doc = make_lrpmt_returns([source_doc])
+
     target_doc.insert()
     target_doc.reload()
 
@@ -923,150 +1076,249 @@ def return_quatity_or_cancel_delivery_note_via_lrpmt_returns(source_doc, method)
         target_doc.submit()
 
 
-def create_invoiced_items_if_not_created():
-    """create pending LRP item(s) after submission of sales invoice"""
-
-    today_date = nowdate()
-    si_invoices = frappe.db.sql(
-        """ SELECT Distinct(si.name) FROM `tabSales Invoice` si
-        INNER JOIN `tabSales Invoice Item` sii ON si.name = sii.parent
-        WHERE si.patient is not null
-        AND si.docstatus = 1 
-        AND si.posting_date = %s
+LRP_REFERENCE_DOCTYPES = {
+    "Lab Prescription": {
+        "doctype": "Lab Test",
+        "template_doctype": "Lab Test Template",
+        "template_field": "lab_test_code",
+        "comment_field": "lab_test_comment",
+        "created_field": "lab_test_created",
+    },
+    "Radiology Procedure Prescription": {
+        "doctype": "Radiology Examination",
+        "template_doctype": "Radiology Examination Template",
+        "template_field": "radiology_examination_template",
+        "comment_field": "radiology_test_comment",
+        "created_field": "radiology_examination_created",
+    },
+    "Procedure Prescription": {
+        "doctype": "Clinical Procedure",
+        "template_doctype": "Clinical Procedure Template",
+        "template_field": "procedure",
+        "comment_field": "comments",
+        "created_field": "procedure_created",
+    },
+}
+
+
+def get_lrp_watermark():
+    watermark = frappe.db.get_global(LRP_WATERMARK_KEY)
+    if watermark:
+        return get_datetime(watermark)
+    # first run, pick up everything from yesterday on
+    return get_datetime(add_to_date(nowdate(), days=-1))
+
+
+def get_pending_lrp_items(watermark, last_name, limit):
+    return frappe.db.sql(
+        """
+        SELECT sii.name, sii.parent, sii.modified, sii.reference_dt, sii.reference_dn
+        FROM `tabSales Invoice Item` sii
+        INNER JOIN `tabSales Invoice` si ON si.name = sii.parent
+        WHERE (sii.modified > %(watermark)s
+            OR (sii.modified = %(watermark)s AND sii.name > %(last_name)s))
         AND sii.hms_tz_is_lrp_item_created = 0
+        AND sii.reference_dt IN %(reference_dts)s
+        AND sii.parenttype = 'Sales Invoice'
+        AND si.docstatus = 1
+        AND si.patient is not null
+        ORDER BY sii.modified, sii.name
+        LIMIT %(limit)s
     """,
-        today_date,
+        {
+            "watermark": watermark,
+            "last_name": last_name,
+            "reference_dts": list(LRP_REFERENCE_DOCTYPES),
+            "limit": limit,
+        },
         as_dict=1,
     )
 
-    for invoice in si_invoices:
-        si_doc = frappe.get_doc("Sales Invoice", invoice.name)
-
-        for item in si_doc.items:
-            if item.reference_dt in [
-                "Lab Prescription",
-                "Radiology Procedure Prescription",
-                "Procedure Prescription",
-            ]:
-                if item.hms_tz_is_lrp_item_created == 1:
-                    continue
-
-                try:
-                    child = frappe.get_doc(item.reference_dt, item.reference_dn)
-                    patient_encounter_doc = frappe.get_doc(
-                        "Patient Encounter", child.parent
-                    )
 
-                    if child.doctype == "Lab Prescription":
-                        ltt_doc = frappe.get_cached_doc(
-                            "Lab Test Template", child.lab_test_code
-                        )
+def get_lrp_prefetch_data(items):
+    """Load the referenced prescriptions, their encounters and the template
+    departments with one query per doctype"""
+    children = {}
+    departments = {}
+    for reference_dt, settings in LRP_REFERENCE_DOCTYPES.items():
+        names = [item.reference_dn for item in items if item.reference_dt == reference_dt]
+        if not names:
+            continue
+        rows = frappe.get_all(
+            reference_dt,
+            filters={"name": ["in", names]},
+            fields=[
+                "name",
+                "parent",
+                "prescribe",
+                "medical_code",
+                settings["template_field"],
+                settings["comment_field"],
+            ],
+        )
+        for row in rows:
+            children[(reference_dt, row.name)] = row
+
+        templates = list({row.get(settings["template_field"]) for row in rows})
+        if reference_dt != "Lab Prescription" and templates:
+            for template in frappe.get_all(
+                settings["template_doctype"],
+                filters={"name": ["in", templates]},
+                fields=["name", "medical_department"],
+            ):
+                departments[(settings["template_doctype"], template.name)] = template.medical_department
+
+    encounters = {}
+    encounter_names = list({child.parent for child in children.values()})
+    if encounter_names:
+        for encounter in frappe.get_all(
+            "Patient Encounter",
+            filters={"name": ["in", encounter_names]},
+            fields=[
+                "name",
+                "patient",
+                "patient_sex",
+                "company",
+                "practitioner",
+                "source",
+                "insurance_subscription",
+            ],
+        ):
+            encounters[encounter.name] = encounter
+
+    return children, encounters, departments
+
+
+def create_lrp_document(item, child, encounter, departments):
+    settings = LRP_REFERENCE_DOCTYPES[item.reference_dt]
+    template = child.get(settings["template_field"])
+    doc = {
+        "doctype": settings["doctype"],
+        "patient": encounter.patient,
+        "company": encounter.company,
+        "practitioner": encounter.practitioner,
+        "source": encounter.source,
+        "prescribe": child.prescribe,
+        "insurance_subscription": encounter.insurance_subscription or "",
+        "ref_doctype": "Patient Encounter",
+        "ref_docname": encounter.name,
+        "invoiced": 1,
+        "service_comment": child.medical_code
+        or "No ICD Code" + " : " + child.get(settings["comment_field"])
+        or "No Comment",
+    }
+    if item.reference_dt == "Lab Prescription":
+        doc.update({"patient_sex": encounter.patient_sex, "template": template})
+    elif item.reference_dt == "Radiology Procedure Prescription":
+        doc.update({
+            "radiology_examination_template": template,
+            "medical_department": departments.get((settings["template_doctype"], template)),
+        })
+    else:
+        doc.update({
+            "patient_sex": encounter.patient_sex,
+            "procedure_template": template,
+            "medical_department": departments.get((settings["template_doctype"], template)),
+        })
 
-                        lab_doc = frappe.get_doc(
-                            {
-                                "doctype": "Lab Test",
-                                "patient": patient_encounter_doc.patient,
-                                "patient_sex": patient_encounter_doc.patient_sex,
-                                "company": patient_encounter_doc.company,
-                                "template": ltt_doc.name,
-                                "practitioner": patient_encounter_doc.practitioner,
-                                "source": patient_encounter_doc.source,
-                                "prescribe": child.prescribe,
-                                "insurance_subscription": patient_encounter_doc.insurance_subscription
-                                if patient_encounter_doc.insurance_subscription
-                                else "",
-                                "ref_doctype": patient_encounter_doc.doctype,
-                                "ref_docname": patient_encounter_doc.name,
-                                "invoiced": 1,
-                                "service_comment": child.medical_code
-                                or "No ICD Code" + " : " + child.lab_test_comment
-                                or "No Comment",
-                            }
-                        )
-                        lab_doc.insert(ignore_permissions=True, ignore_mandatory=True)
-                        if lab_doc.name:
-                            child.lab_test_created = 1
-                            child.invoiced = 1
-                            child.sales_invoice_number = item.parent
-                            child.db_update()
-
-                    elif child.doctype == "Radiology Procedure Prescription":
-                        radiology_doc = frappe.get_doc(
-                            {
-                                "doctype": "Radiology Examination",
-                                "patient": patient_encounter_doc.patient,
-                                "company": patient_encounter_doc.company,
-                                "radiology_examination_template": child.radiology_examination_template,
-                                "practitioner": patient_encounter_doc.practitioner,
-                                "source": patient_encounter_doc.source,
-                                "prescribe": child.prescribe,
-                                "insurance_subscription": patient_encounter_doc.insurance_subscription
-                                if patient_encounter_doc.insurance_subscription
-                                else "",
-                                "medical_department": frappe.get_cached_value(
-                                    "Radiology Examination Template",
-                                    child.radiology_examination_template,
-                                    "medical_department",
-                                ),
-                                "ref_doctype": patient_encounter_doc.doctype,
-                                "ref_docname": patient_encounter_doc.name,
-                                "invoiced": 1,
-                                "service_comment": child.medical_code
-                                or "No ICD Code" + " : " + child.radiology_test_comment
-                                or "No Comment",
-                            }
-                        )
-                        radiology_doc.insert(
-                            ignore_permissions=True, ignore_mandatory=True
-                        )
-                        if radiology_doc.name:
-                            child.radiology_examination_created = 1
-                            child.invoiced = 1
-                            child.sales_invoice_number = item.parent
-                            child.db_update()
-
-                    elif child.doctype == "Procedure Prescription":
-                        procedure_doc = frappe.get_doc(
-                            {
-                                "doctype": "Clinical Procedure",
-                                "patient": patient_encounter_doc.patient,
-                                "patient_sex": patient_encounter_doc.patient_sex,
-                                "company": patient_encounter_doc.company,
-                                "procedure_template": child.procedure,
-                                "practitioner": patient_encounter_doc.practitioner,
-                                "source": patient_encounter_doc.source,
-                                "prescribe": child.prescribe,
-                                "insurance_subscription": patient_encounter_doc.insurance_subscription,
-                                "medical_department": frappe.get_cached_value(
-                                    "Clinical Procedure Template",
-                                    child.procedure,
-                                    "medical_department",
-                                ),
-                                "ref_doctype": patient_encounter_doc.doctype,
-                                "ref_docname": patient_encounter_doc.name,
-                                "invoiced": 1,
-                                "service_comment": child.medical_code
-                                or "No ICD Code" + " : " + child.comments
-                                or "No Comment",
-                            }
-                        )
-                        procedure_doc.insert(
-                            ignore_permissions=True, ignore_mandatory=True
-                        )
-                        if procedure_doc.name:
-                            child.procedure_created = 1
-                            child.invoiced = 1
-                            child.sales_invoice_number = item.parent
-                            child.db_update()
-
-                    item.hms_tz_is_lrp_item_created = 1
-                    item.db_update()
-                except Exception:
-                    traceback = frappe.get_traceback()
-                    frappe.log_error(traceback)
+    lrp_doc = frappe.get_doc(doc)
+    lrp_doc.insert(ignore_permissions=True, ignore_mandatory=True)
+    if lrp_doc.name:
+        frappe.db.set_value(
+            item.reference_dt,
+            child.name,
+            {
+                settings["created_field"]: 1,
+                "invoiced": 1,
+                "sales_invoice_number": item.parent,
+            },
+            update_modified=False,
+        )
 
+
+def create_invoiced_items_if_not_created():
+    """create pending LRP item(s) after submission of sales invoice
+
+    Picks up pending Sales Invoice Items modified since the persisted
+    watermark, so invoices submitted before midnight are not left behind.
+    A failing item holds the watermark back for LRP_RETRY_DAYS at most.
+    """
+    watermark = get_lrp_watermark()
+    retry_limit = get_datetime(add_to_date(now_datetime(), days=-LRP_RETRY_DAYS))
+    next_watermark = None
+    last_name = ""
+
+    while True:
+        items = get_pending_lrp_items(watermark, last_name, LRP_BATCH_SIZE)
+        if not items:
+            break
+
+        children, encounters, departments = get_lrp_prefetch_data(items)
+        created = []
+        for item in items:
+            child = children.get((item.reference_dt, item.reference_dn))
+            encounter = child and encounters.get(child.parent)
+            try:
+                frappe.db.savepoint("lrp_item")
+                if not encounter:
+                    frappe.throw(
+                        _("{0} {1} on Sales Invoice {2} has no patient encounter").format(
+                            item.reference_dt, item.reference_dn, item.parent
+                        )
+                    )
+                create_lrp_document(item, child, encounter, departments)
+                created.append(item.name)
+            except Exception:
+                frappe.db.rollback(save_point="lrp_item")
+                frappe.log_error(frappe.get_traceback())
+                if not next_watermark and item.modified > retry_limit:
+                    next_watermark = item.modified
+
+        if created:
+            frappe.db.sql(
+                """UPDATE `tabSales Invoice Item` SET hms_tz_is_lrp_item_created = 1
+                WHERE name IN %(names)s""",
+                {"names": created},
+            )
         frappe.db.commit()
 
+        # failed items stay pending, page past them
+        watermark, last_name = items[-1].modified, items[-1].name
+        if len(items) < LRP_BATCH_SIZE:
+            break
+
+    frappe.db.set_global(LRP_WATERMARK_KEY, cstr(next_watermark or watermark))
+    frappe.db.commit()
+
+
+@frappe.whitelist()
+def get_lrp_backlog():
+    """Number of invoiced LRP items still waiting for their documents and the
+    age in seconds of the oldest one"""
+    backlog = frappe.db.sql(
+        """
+        SELECT COUNT(sii.name) AS pending, MIN(sii.modified) AS oldest
+        FROM `tabSales Invoice Item` sii
+        INNER JOIN `tabSales Invoice` si ON si.name = sii.parent
+        WHERE sii.hms_tz_is_lrp_item_created = 0
+        AND sii.reference_dt IN %(reference_dts)s
+        AND sii.parenttype = 'Sales Invoice'
+        AND si.docstatus = 1
+        AND si.patient is not null
+        AND sii.modified >= %(since)s
+    """,
+        {
+            "reference_dts": list(LRP_REFERENCE_DOCTYPES),
+            "since": add_to_date(now_datetime(), days=-LRP_RETRY_DAYS),
+        },
+        as_dict=1,
+    )[0]
+    return {
+        "pending": cint(backlog.pending),
+        "lag": cint((now_datetime() - backlog.oldest).total_seconds()) if backlog.oldest else 0,
+        "watermark": frappe.db.get_global(LRP_WATERMARK_KEY),
+    }
+
 @frappe.whitelist()
 def auto_submit_nhif_patient_claim(setting_dict=None):
     """Routine to submit patient claims and will be triggered:
@@ -1095,35 +1347,179 @@ def auto_submit_nhif_patient_claim(setting_dict=None):
             setting_obj=detail,
         )
 
+def get_auto_submit_run_key(setting_obj):
+    return "nhif_claim_auto_submit|{0}|{1}|{2}".format(
+        setting_obj.company, setting_obj.submit_claim_year, setting_obj.submit_claim_month
+    )
+
+
 def enqueue_auto_sending_of_patient_claims(setting_obj):
+    """Queue the ready claims of the month in redis and start at most
+    AUTO_SUBMIT_CONCURRENCY worker jobs popping from it, so a slow folio
+    only holds up its own worker.
+
+    Calling it again while the run is active only starts workers for the
+    slots whose worker has died. Submitted claims are the checkpoint: a run
+    that dies altogether leaves the rest in draft for the next run once its
+    active marker has expired."""
+    setting_obj = frappe._dict(setting_obj)
+    run_key = get_auto_submit_run_key(setting_obj)
+    queue_key = frappe.cache().make_key(run_key + "|queue")
+    if frappe.cache().set(
+        frappe.cache().make_key(run_key + "|active"),
+        1,
+        nx=True,
+        ex=AUTO_SUBMIT_RUN_TIMEOUT,
+    ):
+        patient_claims = frappe.get_all("NHIF Patient Claim", filters={
+            "company": setting_obj.company, 
+            "claim_month": setting_obj.submit_claim_month, 
+            "claim_year": setting_obj.submit_claim_year,
+            "is_ready_for_auto_submission": 1,
+            "docstatus": 0
+        }, pluck="name")
+        if len(patient_claims) == 0:
+            frappe.cache().delete(frappe.cache().make_key(run_key + "|active"))
+            return
+
+        frappe.cache().delete_value(run_key)
+        frappe.cache().delete(queue_key)
+        frappe.cache().rpush(queue_key, *patient_claims)
+        frappe.cache().hset(run_key, "__started__", time())
+        frappe.cache().hset(run_key, "__total__", len(patient_claims))
+        workers = start_auto_submit_workers(run_key, setting_obj.company)
+    else:
+        workers = start_auto_submit_workers(run_key, setting_obj.company)
+        if workers == AUTO_SUBMIT_CONCURRENCY:
+            # every worker of the run died, put back the claims they held
+            processing = [
+                frappe.safe_decode(claim)
+                for claim, status in (frappe.cache().hgetall(run_key) or {}).items()
+                if status == "Processing"
+            ]
+            if processing:
+                frappe.cache().rpush(queue_key, *processing)
+
+    if not workers:
+        frappe.msgprint(
+            _("Auto submission of claims for {0} is already running").format(
+                setting_obj.company
+            ),
+            alert=True,
+        )
+
+
+def get_auto_submit_slot_key(run_key, slot):
+    return frappe.cache().make_key("{0}|worker|{1}".format(run_key, slot))
+
+
+def start_auto_submit_workers(run_key, company):
+    """Enqueue a worker for every free slot of the run, return how many"""
+    workers = 0
+    for slot in range(AUTO_SUBMIT_CONCURRENCY):
+        if not frappe.cache().set(
+            get_auto_submit_slot_key(run_key, slot),
+            1,
+            nx=True,
+            ex=AUTO_SUBMIT_WORKER_TIMEOUT,
+        ):
+            continue
+        frappe.enqueue(
+            method=submit_patient_claims,
+            queue="long",
+            timeout=1000000,
+            is_async=True,
+            run_key=run_key,
+            company=company,
+            slot=slot,
+        )
+        workers += 1
+    return workers
+
+
+def submit_patient_claims(run_key, company, slot):
+    """Submit claims popped from the run's queue until it is empty"""
     from hms_tz.nhif.doctype.nhif_response_log.nhif_response_log import add_log
 
-    patient_claims = frappe.get_all("NHIF Patient Claim", filters={
-        "company": setting_obj.company, 
-        "claim_month": setting_obj.submit_claim_month, 
-        "claim_year": setting_obj.submit_claim_year,
-        "is_ready_for_auto_submission": 1,
-        "docstatus": 0
-    })
-    
-    if len(patient_claims) == 0:
-        return
+    queue_key = frappe.cache().make_key(run_key + "|queue")
+    while True:
+        claim = frappe.cache().lpop(queue_key)
+        if not claim:
+            break
+        claim = frappe.safe_decode(claim)
+        frappe.cache().hset(run_key, claim, "Processing")
+
+        start_time = perf_counter()
+        error = ""
+        if frappe.db.get_value(
+            "NHIF Patient Claim", claim, ["docstatus", "is_ready_for_auto_submission"]
+        ) != (0, 1):
+            status = "Skipped"
+        else:
+            try:
+                doc = frappe.get_doc("NHIF Patient Claim", claim)
+                doc.submit()
+                frappe.db.commit()
+                status = "Submitted" if doc.docstatus == 1 else "Failed"
+            except Exception:
+                frappe.db.rollback()
+                status = "Failed"
+                error = frappe.get_traceback()
+
+        add_log(
+            request_type="AutoSubmitFolio",
+            request_url=claim,
+            response_data=error or status,
+            status_code=status,
+            duration=perf_counter() - start_time,
+        )
+        frappe.cache().hset(run_key, claim, status)
+        frappe.cache().expire(
+            frappe.cache().make_key(run_key + "|active"), AUTO_SUBMIT_RUN_TIMEOUT
+        )
+        frappe.cache().expire(
+            get_auto_submit_slot_key(run_key, slot), AUTO_SUBMIT_WORKER_TIMEOUT
+        )
 
-    success_count = 0
-    failed_count = 0
-    for claim in patient_claims:
-        doc = frappe.get_doc("NHIF Patient Claim", claim.name)
-        try:
-            doc.submit()
-            doc.reload()
-            if doc.docstatus == 1:
-                success_count += 1
-        except:
-            failed_count += 1
+    frappe.cache().delete(get_auto_submit_slot_key(run_key, slot))
+    finish_auto_sending_of_patient_claims(run_key, company)
+
+
+def finish_auto_sending_of_patient_claims(run_key, company):
+    """Write the run summary once the queue is empty and no claim of the
+    run is still being processed"""
+    from hms_tz.nhif.doctype.nhif_response_log.nhif_response_log import add_log
+
+    # redis returns the hash keys as bytes, only the values are unpickled
+    run = {
+        frappe.safe_decode(key): value
+        for key, value in (frappe.cache().hgetall(run_key) or {}).items()
+    }
+    total = cint(run.pop("__total__", 0))
+    started = flt(run.pop("__started__", 0))
+    if (
+        not total
+        or frappe.cache().llen(frappe.cache().make_key(run_key + "|queue"))
+        or "Processing" in run.values()
+    ):
+        return
+    if not frappe.cache().set(
+        frappe.cache().make_key(run_key + "|summary"), 1, nx=True, ex=60
+    ):
+        return
 
+    statuses = list(run.values())
+    elapsed_minutes = (time() - started) / 60 if started else 0
     description = "CLAIM'S AUTO SUBMISSION SUMMARY\n\n\ncompany: {0}\n\nTotal Claims Prepared for auto submit: {1}\
-        \n\nTotal claims Submitted: {2}\n\nTotal Claims failed: {3}".format(
-            setting_obj.company, len(patient_claims), success_count, failed_count
+        \n\nTotal claims Submitted: {2}\n\nTotal Claims failed: {3}\n\nTotal Claims skipped: {4}\
+        \n\nTime taken: {5} minutes\n\nThroughput: {6} claims per minute".format(
+            company,
+            total,
+            statuses.count("Submitted"),
+            statuses.count("Failed"),
+            statuses.count("Skipped"),
+            flt(elapsed_minutes, 2),
+            flt(total / elapsed_minutes, 2) if elapsed_minutes else total,
         )
     add_log(
         request_type="AutoSubmitFolios",
@@ -1132,5 +1528,9 @@ def enqueue_auto_sending_of_patient_claims(setting_obj):
         request_body="",
         response_data=description,
         status_code="Summary",
+        duration=elapsed_minutes * 60,
     )
-    frappe.db.commit()
\ No newline at end of file
+    frappe.cache().delete_value(run_key)
+    frappe.cache().delete(frappe.cache().make_key(run_key + "|queue"))
+    frappe.cache().delete(frappe.cache().make_key(run_key + "|active"))
+    frappe.db.commit()
@@ -5,13 +5,17 @@
 from __future__ import unicode_literals
 import frappe
 from frappe import _
-from frappe.utils import nowdate, nowtime
+from frappe.utils import nowdate, nowtime, now_datetime, flt
 from hms_tz.nhif.api.healthcare_utils import get_item_rate, get_item_price
-from hms_tz.nhif.api.patient_appointment import get_mop_amount
+from hms_tz.nhif.api.patient_appointment import get_mop_amount, get_default_price_list
 from hms_tz.nhif.api.patient_encounter import create_healthcare_docs_from_name
 from hms_tz.nhif.api.patient_appointment import get_discount_percent
 
 import json
+from time import perf_counter
+
+# occupancies written per statement and commit by the daily roll-over
+OCCUPANCY_BATCH_SIZE = 100
 
 
 def validate(doc, method):
@@ -48,27 +52,210 @@ def validate_inpatient_occupancies(doc):
             )
 
 
+def get_open_last_occupancies():
+    """The last occupancy row of every admitted record when the patient has
+    not left it yet, with what is needed to price the next day's bed"""
+    return frappe.db.sql(
+        """
+        SELECT ip.name AS inpatient_record, ip.company, ip.patient,
+            ip.insurance_subscription, ip.insurance_company,
+            io.name, io.idx, io.service_unit,
+            hsu.parent_healthcare_service_unit AS ward,
+            hsut.item_code, pe.mode_of_payment
+        FROM `tabInpatient Record` ip
+        INNER JOIN `tabInpatient Occupancy` io ON io.parent = ip.name
+            AND io.parenttype = 'Inpatient Record'
+            AND io.parentfield = 'inpatient_occupancies'
+        INNER JOIN (
+            SELECT parent, MAX(idx) AS idx FROM `tabInpatient Occupancy`
+            WHERE parenttype = 'Inpatient Record'
+            AND parentfield = 'inpatient_occupancies'
+            GROUP BY parent
+        ) last_row ON last_row.parent = io.parent AND last_row.idx = io.idx
+        LEFT JOIN `tabHealthcare Service Unit` hsu ON hsu.name = io.service_unit
+        LEFT JOIN `tabHealthcare Service Unit Type` hsut ON hsut.name = hsu.service_unit_type
+        LEFT JOIN `tabPatient Encounter` pe ON pe.name = ip.admission_encounter
+        WHERE ip.status = 'Admitted'
+        AND io.`left` = 0
+        ORDER BY ip.name
+    """,
+        as_dict=1,
+    )
+
+
+def get_bed_price_data(rows):
+    """Preload the (item, price list, currency) rates of the bed items and
+    the price lists of the insurance plans involved"""
+    prices = {}
+    item_codes = list({row.item_code for row in rows if row.item_code})
+    if item_codes:
+        for price in frappe.get_all(
+            "Item Price",
+            filters={"item_code": ["in", item_codes]},
+            fields=["item_code", "price_list", "currency", "price_list_rate"],
+            order_by="valid_from desc",
+        ):
+            prices.setdefault(
+                (price.item_code, price.price_list, price.currency),
+                price.price_list_rate,
+            )
+
+    plans = {}
+    subscriptions = list(
+        {row.insurance_subscription for row in rows if row.insurance_subscription}
+    )
+    if subscriptions:
+        for plan in frappe.db.sql(
+            """
+            SELECT his.name AS subscription, hicp.name AS plan, hicp.price_list,
+                hicp.secondary_price_list, hicp.insurance_company
+            FROM `tabHealthcare Insurance Subscription` his
+            INNER JOIN `tabHealthcare Insurance Coverage Plan` hicp
+                ON hicp.name = his.healthcare_insurance_coverage_plan
+            WHERE his.name IN %(subscriptions)s
+        """,
+            {"subscriptions": subscriptions},
+            as_dict=1,
+        ):
+            plans[plan.subscription] = plan
+
+    return prices, plans
+
+
+def get_bed_amount(row, prices, plans):
+    """Same rates as set_beds_price, resolved from the preloaded tables"""
+    currency = frappe.get_cached_value("Company", row.company, "default_currency")
+
+    def get_price(price_list):
+        return flt(prices.get((row.item_code, price_list, currency)))
+
+    if not row.insurance_subscription:
+        price_list = None
+        if row.mode_of_payment:
+            price_list = frappe.get_cached_value(
+                "Mode of Payment", row.mode_of_payment, "price_list"
+            )
+        if not price_list:
+            price_list = get_default_price_list(row.patient)
+        if not price_list:
+            frappe.throw(_("Please set Price List in Mode of Payment"))
+        return get_price(price_list), 0
+
+    plan = plans.get(row.insurance_subscription) or frappe._dict()
+    item_rate = get_price(plan.price_list) or get_price(plan.secondary_price_list)
+    if not item_rate:
+        price_list = plan.price_list
+        if plan.insurance_company:
+            price_list = frappe.get_cached_value(
+                "Healthcare Insurance Company", plan.insurance_company, "default_price_list"
+            )
+        if not price_list:
+            frappe.throw(
+                _(
+                    "Could not get price for item {0} for price list in {1}. Please set Price List in Healthcare Insurance Coverage Plan {1} or Insurance Company {2}"
+                ).format(row.item_code, plan.plan, plan.insurance_company)
+            )
+        item_rate = get_price(price_list)
+        if not item_rate:
+            frappe.throw(
+                _("Please set Price List for item: {0} in price list {1}").format(
+                    row.item_code, price_list
+                )
+            )
+
+    discount_percent = 0
+    if row.insurance_company and "NHIF" not in row.insurance_company:
+        discount_percent = get_discount_percent(row.insurance_company)
+    return item_rate - (item_rate * (discount_percent / 100)), 1 if discount_percent > 0 else 0
+
+
 def daily_update_inpatient_occupancies():
-    occupancies = frappe.get_all("Inpatient Record", filters={"status": "Admitted"})
+    """Check out the open last bed of every admitted patient and check them
+    in again for today, in bulk and without saving each Inpatient Record"""
+    start_time = perf_counter()
+    rows = get_open_last_occupancies()
+    prices, plans = get_bed_price_data(rows)
+    today = nowdate()
+    summary = frappe._dict(rolled_over=0, failed=0, wards={})
+
+    for i in range(0, len(rows), OCCUPANCY_BATCH_SIZE):
+        batch = rows[i : i + OCCUPANCY_BATCH_SIZE]
+        time_stamp = now_datetime()
+        check_outs = []
+        new_rows = []
+        for row in batch:
+            try:
+                amount, is_discount_applied = get_bed_amount(row, prices, plans)
+            except Exception:
+                frappe.clear_messages()
+                summary.failed += 1
+                frappe.log_error(
+                    frappe.get_traceback(),
+                    str("Daily Update Beds: {0}".format(row.inpatient_record)),
+                )
+                continue
+
+            check_outs.append(row.name)
+            new_rows.append(
+                (
+                    frappe.generate_hash("", 10),
+                    time_stamp,
+                    time_stamp,
+                    frappe.session.user,
+                    frappe.session.user,
+                    row.inpatient_record,
+                    "Inpatient Record",
+                    "inpatient_occupancies",
+                    row.idx + 1,
+                    today,
+                    0,
+                    row.service_unit,
+                    amount,
+                    is_discount_applied,
+                )
+            )
+            ward = row.ward or row.service_unit
+            summary.wards[ward] = summary.wards.get(ward, 0) + 1
+
+        if not check_outs:
+            continue
 
-    for item in occupancies:
         try:
-            doc = frappe.get_doc("Inpatient Record", item.name)
-            occupancies_len = len(doc.inpatient_occupancies)
-            if occupancies_len > 0:
-                last_row = doc.inpatient_occupancies[occupancies_len - 1]
-                if not last_row.left:
-                    last_row.left = 1
-                    last_row.check_out = nowdate()
-                    new_row = doc.append("inpatient_occupancies", {})
-                    new_row.check_in = nowdate()
-                    new_row.left = 0
-                    new_row.service_unit = last_row.service_unit
-                    doc.save(ignore_permissions=True)
-                    frappe.db.commit()
+            frappe.db.sql(
+                """
+                UPDATE `tabInpatient Occupancy`
+                SET `left` = 1, check_out = %(today)s, modified = %(modified)s
+                WHERE name IN %(names)s
+            """,
+                {"today": today, "modified": time_stamp, "names": check_outs},
+            )
+            frappe.db.sql(
+                """
+                INSERT INTO `tabInpatient Occupancy`
+                    (name, creation, modified, owner, modified_by, parent,
+                    parenttype, parentfield, idx, check_in, `left`,
+                    service_unit, amount, hms_tz_is_discount_applied)
+                VALUES {0}
+            """.format(
+                    ", ".join(["%s"] * len(new_rows))
+                ),
+                tuple(new_rows),
+            )
+            frappe.db.sql(
+                """UPDATE `tabInpatient Record` SET modified = %(modified)s
+                WHERE name IN %(names)s""",
+                {"modified": time_stamp, "names": [r[5] for r in new_rows]},
+            )
+            frappe.db.commit()
+            summary.rolled_over += len(new_rows)
         except Exception:
+            frappe.db.rollback()
+            summary.failed += len(new_rows)
             frappe.log_error(frappe.get_traceback(), str("Daily Update Beds"))
-            continue
+
+    summary.time_taken = round(perf_counter() - start_time, 3)
+    frappe.logger().info({"daily_update_inpatient_occupancies": summary})
+    return summary
 
 
 @frappe.whitelist()
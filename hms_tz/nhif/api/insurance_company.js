@@ -32,5 +32,18 @@ var add_get_price_btn = function (frm) {
             }
         });
     });
+    frm.add_custom_button(__('Preview NHIF Price List Changes'), function () {
+        frappe.call({
+            method: 'hms_tz.nhif.api.insurance_company.get_prices_list_dry_run',
+            args: { company: frm.doc.company },
+            freeze: true,
+            callback: function (data) {
+                if (data.message) {
+                    frappe.msgprint(__("Item Prices to insert: {0}, to update: {1}, to delete: {2} (checked in {3} seconds)",
+                        [data.message.inserted, data.message.updated, data.message.deleted, data.message.time_taken]));
+                }
+            }
+        });
+    });
 
 }
\ No newline at end of file
@@ -6,18 +6,25 @@ from time import perf_counter
 import frappe
 from frappe import _
 from hms_tz.nhif.api.token import get_claimsservice_token
+from hms_tz.nhif.api.nhif_client import nhif_request, LONG_READ_TIMEOUT
 import json
-import requests
+import hashlib
 from frappe.utils.background_jobs import enqueue
 from hms_tz.nhif.doctype.nhif_product.nhif_product import add_product
 from hms_tz.nhif.doctype.nhif_scheme.nhif_scheme import add_scheme
-from frappe.utils import now
+from frappe.utils import now, nowdate, cstr, flt, cint
 from hms_tz.nhif.doctype.nhif_response_log.nhif_response_log import add_log
-from frappe.model.naming import set_new_name
+from hms_tz.nhif.doctype.nhif_price_package_snapshot.nhif_price_package_snapshot import (
+    SNAPSHOT_SECTIONS,
+    get_latest_snapshots,
+    get_snapshot_diff,
+    get_snapshot_records,
+    save_snapshot,
+)
+from frappe.model.naming import parse_naming_series
+from erpnext.stock.doctype.item_price.item_price import ItemPriceDuplicateItem
 import ast
-from hms_tz.nhif.doctype.nhif_custom_excluded_services.nhif_custom_excluded_services import get_custom_excluded_services
 
-from time import sleep
 
 @frappe.whitelist()
 def enqueue_get_nhif_price_package(company):
@@ -31,9 +38,44 @@ def enqueue_get_nhif_price_package(company):
     return
 
 
+# NHIF payload key -> column, in the order the columns are written
+PRICE_PACKAGE_FIELDS = [
+    ("ItemCode", "itemcode"),
+    ("PriceCode", "pricecode"),
+    ("LevelPriceCode", "levelpricecode"),
+    ("OldItemCode", "olditemcode"),
+    ("ItemTypeID", "itemtypeid"),
+    ("ItemName", "itemname"),
+    ("Strength", "strength"),
+    ("Dosage", "dosage"),
+    ("PackageID", "packageid"),
+    ("SchemeID", "schemeid"),
+    ("FacilityLevelCode", "facilitylevelcode"),
+    ("UnitPrice", "unitprice"),
+    ("IsRestricted", "isrestricted"),
+    ("MaximumQuantity", "maximumquantity"),
+    ("AvailableInLevels", "availableinlevels"),
+    ("PractitionerQualifications", "practitionerqualifications"),
+    ("IsActive", "isactive"),
+]
+PRICE_PACKAGE_KEY = ("PriceCode", "SchemeID", "ItemCode")
+
+EXCLUDED_SERVICES_FIELDS = [
+    ("ItemCode", "itemcode"),
+    ("SchemeID", "schemeid"),
+    ("SchemeName", "schemename"),
+    ("ExcludedForProducts", "excludedforproducts"),
+]
+EXCLUDED_SERVICES_KEY = ("ItemCode", "SchemeID")
+
+# rows per multi-row INSERT/DELETE statement
+SYNC_BATCH_SIZE = 5000
+
+HSIC_NAMING_SERIES = "HSIC-.YYYY.-"
+
+
 def get_nhif_price_package(kwargs):
     company = kwargs
-    user = frappe.session.user
     token = get_claimsservice_token(company)
     claimsserver_url, facility_code = frappe.get_cached_value(
         "Company NHIF Settings", company, ["claimsserver_url", "facility_code"]
@@ -44,126 +86,183 @@ def get_nhif_price_package(kwargs):
         + "/claimsserver/api/v1/Packages/GetPricePackageWithExcludedServices?FacilityCode="
         + str(facility_code)
     )
-    r = requests.get(url, headers=headers, timeout=300)
+    r = nhif_request(
+        "GET",
+        url,
+        "GetPricePackageWithExcludedServices",
+        read_timeout=LONG_READ_TIMEOUT,
+        headers=headers,
+    )
     if r.status_code != 200:
         add_log(
             request_type="GetPricePackageWithExcludedServices",
             request_url=url,
             request_header=headers,
             response_data=r.text,
-            status_code=r.status_code
+            status_code=r.status_code,
+            duration=r.elapsed.total_seconds(),
         )
         frappe.throw(json.loads(r.text))
     else:
-        if json.loads(r.text):
-            frappe.db.sql(
-                """DELETE FROM `tabNHIF Price Package` WHERE company = '{0}' """.format(company)
-            )
-            frappe.db.sql(
-                """DELETE FROM `tabNHIF Excluded Services` WHERE company = '{0}' """.format(
-                    company
-                )
-            )
-            frappe.db.commit()
-
-            # wait for 60 seconds before creating records again
-            sleep(60)
-
+        data = json.loads(r.text)
+        if data:
+            start_time = perf_counter()
+            # written right away, the snapshot and NHIF Update link to it
             log_name = add_log(
                 request_type="GetPricePackageWithExcludedServices",
                 request_url=url,
                 request_header=headers,
                 response_data=r.text,
-                status_code=r.status_code
+                status_code=r.status_code,
+                duration=r.elapsed.total_seconds(),
+                immediate=True,
             )
             time_stamp = now()
-            data = json.loads(r.text)
-            insert_data = []
-            for item in data.get("PricePackage"):
-                insert_data.append(
-                    (
-                        frappe.generate_hash("", 20),
-                        facility_code,
-                        time_stamp,
-                        log_name,
-                        item.get("ItemCode"),
-                        item.get("PriceCode"),
-                        item.get("LevelPriceCode"),
-                        item.get("OldItemCode"),
-                        item.get("ItemTypeID"),
-                        item.get("ItemName"),
-                        item.get("Strength"),
-                        item.get("Dosage"),
-                        item.get("PackageID"),
-                        item.get("SchemeID"),
-                        item.get("FacilityLevelCode"),
-                        item.get("UnitPrice"),
-                        item.get("IsRestricted"),
-                        item.get("MaximumQuantity"),
-                        item.get("AvailableInLevels"),
-                        item.get("PractitionerQualifications"),
-                        item.get("IsActive"),
-                        time_stamp,
-                        time_stamp,
-                        user,
-                        user,
-                        company,
-                    )
-                )
-            frappe.db.sql(
-                """
-                INSERT INTO `tabNHIF Price Package`
-                (
-                    `name`, `facilitycode`, `time_stamp`, `log_name`, `itemcode`, `pricecode`,
-                    `levelpricecode`, `olditemcode`, `itemtypeid`, `itemname`, `strength`, 
-                    `dosage`, `packageid`, `schemeid`, `facilitylevelcode`, `unitprice`, 
-                    `isrestricted`, `maximumquantity`, `availableinlevels`, 
-                    `practitionerqualifications`, `IsActive`, `creation`, `modified`,
-                    `modified_by`, `owner`,`company`
-                )
-                VALUES {}
-            """.format(
-                    ", ".join(["%s"] * len(insert_data))
+            summary = {
+                "price_package": sync_nhif_records(
+                    "NHIF Price Package",
+                    PRICE_PACKAGE_FIELDS,
+                    PRICE_PACKAGE_KEY,
+                    data.get("PricePackage") or [],
+                    company,
+                    facility_code,
+                    log_name,
+                    time_stamp,
                 ),
-                tuple(insert_data),
-            )
-            insert_data = []
-            for item in data.get("ExcludedServices"):
-                insert_data.append(
-                    (
-                        frappe.generate_hash("", 20),
-                        facility_code,
-                        time_stamp,
-                        log_name,
-                        item.get("ItemCode"),
-                        item.get("SchemeID"),
-                        item.get("SchemeName"),
-                        item.get("ExcludedForProducts"),
-                        time_stamp,
-                        time_stamp,
-                        user,
-                        user,
-                        company,
-                    )
-                )
-            frappe.db.sql(
-                """
-                INSERT INTO `tabNHIF Excluded Services`
-                (
-                    `name`, `facilitycode`, `time_stamp`, `log_name`, `itemcode`, `schemeid`,
-                    `schemename`, `excludedforproducts`, `creation`, `modified`,
-                    `modified_by`, `owner`, `company`
-                )
-                VALUES {}
-            """.format(
-                    ", ".join(["%s"] * len(insert_data))
+                "excluded_services": sync_nhif_records(
+                    "NHIF Excluded Services",
+                    EXCLUDED_SERVICES_FIELDS,
+                    EXCLUDED_SERVICES_KEY,
+                    data.get("ExcludedServices") or [],
+                    company,
+                    facility_code,
+                    log_name,
+                    time_stamp,
                 ),
-                tuple(insert_data),
-            )
+            }
+            save_snapshot(company, facility_code, data, log_name, time_stamp)
             set_nhif_diff_records(facility_code)
             frappe.db.commit()
-            frappe.msgprint(_("Received data from NHIF"))
-            return insert_data
+            summary["time_taken"] = round(perf_counter() - start_time, 3)
+            frappe.logger().info({"nhif_price_package_sync": summary})
+            frappe.msgprint(
+                _(
+                    "Received data from NHIF: Price Package {0} inserted, {1} updated, {2} deleted; "
+                    "Excluded Services {3} inserted, {4} updated, {5} deleted in {6} seconds"
+                ).format(
+                    summary["price_package"]["inserted"],
+                    summary["price_package"]["updated"],
+                    summary["price_package"]["deleted"],
+                    summary["excluded_services"]["inserted"],
+                    summary["excluded_services"]["updated"],
+                    summary["excluded_services"]["deleted"],
+                    summary["time_taken"],
+                )
+            )
+            return summary
+
+
+def get_record_hash(record, fields):
+    values = [record.get(key) for key, column in fields]
+    return hashlib.md5(json.dumps(values, default=str).encode()).hexdigest()
+
+
+def get_record_keys(rows, key_fields):
+    """Stable identity per row, numbering repeated keys so duplicates
+    coming from NHIF are kept as separate rows"""
+    seen = {}
+    keys = []
+    for row in rows:
+        key = tuple(cstr(row.get(field)) for field in key_fields)
+        seen[key] = seen.get(key, 0) + 1
+        keys.append(key + (seen[key],))
+    return keys
+
+
+def sync_nhif_records(
+    doctype, fields, key_fields, records, company, facility_code, log_name, time_stamp
+):
+    """Upsert the downloaded NHIF records into `doctype` and delete the ones
+    no longer sent, touching only rows whose content hash has changed.
+
+    Nothing is committed here, so readers never see a half synced table.
+    Returns the inserted, updated, deleted and unchanged counts."""
+    user = frappe.session.user
+    columns = [column for key, column in fields]
+    key_columns = [dict(fields)[key] for key in key_fields]
+
+    existing_rows = frappe.db.sql(
+        """
+            SELECT name, record_hash, {0} FROM `tab{1}`
+            WHERE company = %s
+            ORDER BY creation, name
+        """.format(", ".join("`{0}`".format(c) for c in key_columns), doctype),
+        (company,),
+        as_dict=1,
+    )
+    existing = dict(zip(get_record_keys(existing_rows, key_columns), existing_rows))
+
+    upsert_data = []
+    counts = {"inserted": 0, "updated": 0, "deleted": 0, "unchanged": 0}
+    for key, record in zip(get_record_keys(records, key_fields), records):
+        record_hash = get_record_hash(record, fields)
+        row = existing.pop(key, None)
+        if row:
+            if row.record_hash == record_hash:
+                counts["unchanged"] += 1
+                continue
+            name = row.name
+            counts["updated"] += 1
+        else:
+            name = frappe.generate_hash("", 20)
+            counts["inserted"] += 1
+
+        upsert_data.append(
+            (name, facility_code, time_stamp, log_name, record_hash)
+            + tuple(record.get(key) for key, column in fields)
+            + (time_stamp, time_stamp, user, user, company)
+        )
+
+    insert_columns = (
+        ["name", "facilitycode", "time_stamp", "log_name", "record_hash"]
+        + columns
+        + ["creation", "modified", "modified_by", "owner", "company"]
+    )
+    update_columns = (
+        ["facilitycode", "time_stamp", "log_name", "record_hash"]
+        + columns
+        + ["modified", "modified_by"]
+    )
+    for i in range(0, len(upsert_data), SYNC_BATCH_SIZE):
+        batch = upsert_data[i : i + SYNC_BATCH_SIZE]
+        frappe.db.sql(
+            """
+                INSERT INTO `tab{doctype}` ({columns})
+                VALUES {values}
+                ON DUPLICATE KEY UPDATE {updates}
+            """.format(
+                doctype=doctype,
+                columns=", ".join("`{0}`".format(c) for c in insert_columns),
+                values=", ".join(["%s"] * len(batch)),
+                updates=", ".join(
+                    "`{0}` = VALUES(`{0}`)".format(c) for c in update_columns
+                ),
+            ),
+            tuple(batch),
+        )
+
+    deleted_names = [row.name for row in existing.values()]
+    counts["deleted"] = len(deleted_names)
+    for i in range(0, len(deleted_names), SYNC_BATCH_SIZE):
+        batch = deleted_names[i : i + SYNC_BATCH_SIZE]
+        frappe.db.sql(
+            "DELETE FROM `tab{0}` WHERE name IN ({1})".format(
+                doctype, ", ".join(["%s"] * len(batch))
+            ),
+            tuple(batch),
+        )
+
+    return counts
 
 
 @frappe.whitelist()
@@ -186,25 +285,38 @@ def process_nhif_records(company):
     frappe.msgprint(_("Queued Processing NHIF Insurance Coverages"), alert=True)
 
 
-def process_prices_list(kwargs):
+@frappe.whitelist()
+def get_prices_list_dry_run(company):
+    return process_prices_list(company, dry_run=True)
+
+
+def process_prices_list(kwargs, dry_run=False):
+    """Reconcile the `NHIF-<package>-<facility>` Item Prices with the NHIF
+    Price Package in bulk: load the winning package per item/scheme and the
+    existing Item Prices once, work out the inserts, updates and deletes in
+    memory and write only those, through the Item Price document.
+
+    With `dry_run` nothing is written and the planned changes are returned."""
     company = kwargs
+    start_time = perf_counter()
     facility_code = frappe.get_cached_value("Company NHIF Settings", company, "facility_code")
     currency = frappe.get_cached_value("Company", company, "default_currency")
     schemeid_list = frappe.db.sql(
         """
             SELECT packageid, schemeid from `tabNHIF Price Package`
-                WHERE facilitycode = {0}
-                AND company = '{1}'
+                WHERE facilitycode = %s
+                AND company = %s
                 GROUP BY packageid, schemeid
-        """.format(
-            facility_code, company
-        ),
+        """,
+        (facility_code, company),
         as_dict=1,
     )
 
+    price_list_names = set()
     for scheme in schemeid_list:
         price_list_name = "NHIF-" + scheme.packageid + "-" + facility_code
-        if not frappe.db.exists("Price List", price_list_name):
+        price_list_names.add(price_list_name)
+        if not dry_run and not frappe.db.exists("Price List", price_list_name):
             price_list_doc = frappe.new_doc("Price List")
             price_list_doc.price_list_name = price_list_name
             price_list_doc.currency = currency
@@ -222,74 +334,124 @@ def process_prices_list(kwargs):
         as_dict=1,
     )
 
+    # lowest facility level package per (schemeid, itemcode)
+    packages = {}
+    for package in frappe.db.sql(
+        """
+            SELECT schemeid, itemcode, unitprice, isactive, facilitylevelcode
+            FROM `tabNHIF Price Package`
+            WHERE facilitycode = %s
+        """,
+        (facility_code,),
+        as_dict=1,
+    ):
+        key = (cstr(package.schemeid), cstr(package.itemcode))
+        if key not in packages or cstr(package.facilitylevelcode) < cstr(
+            packages[key].facilitylevelcode
+        ):
+            packages[key] = package
+
+    item_prices = {}
+    if price_list_names:
+        for price in frappe.db.sql(
+            """
+                SELECT name, item_code, price_list, price_list_rate
+                FROM `tabItem Price`
+                WHERE price_list IN %(price_lists)s
+                AND currency = %(currency)s
+                AND selling = 1
+            """,
+            {"price_lists": tuple(price_list_names), "currency": currency},
+            as_dict=1,
+        ):
+            item_prices.setdefault((price.price_list, price.item_code), []).append(price)
+
+    # keyed so an item mapped through several ref codes is written once
+    to_insert = {}
+    to_update = {}
+    to_delete = set()
     for item in item_list:
         for scheme in schemeid_list:
-            schemeid = scheme.schemeid
-            if item.schemeid != schemeid:
+            if item.schemeid != scheme.schemeid:
+                continue
+            package = packages.get((cstr(scheme.schemeid), cstr(item.ref_code)))
+            if not package:
                 continue
             price_list_name = "NHIF-" + scheme.packageid + "-" + facility_code
-            package_list = frappe.db.sql(
-                """
-                    SELECT schemeid, itemcode, unitprice, isactive
-                    FROM `tabNHIF Price Package` 
-                    WHERE facilitycode = {0} and schemeid = {1} and itemcode = {2}
-                    GROUP BY itemcode, schemeid, facilitylevelcode
-                    ORDER BY facilitylevelcode
-                    LIMIT 1
-                """.format(
-                    facility_code, schemeid, item.ref_code
-                ),
-                as_dict=1,
-            )
-            if len(package_list) > 0:
-                for package in package_list:
-                    item_price_list = frappe.get_all(
-                        "Item Price",
-                        filters={
-                            "price_list": price_list_name,
-                            "item_code": item.item_code,
-                            "currency": currency,
-                            "selling": 1,
-                        },
-                        fields=["name", "item_code", "price_list_rate"],
-                    )
-                    if len(item_price_list) > 0:
-                        for price in item_price_list:
-                            if package.isactive and int(package.isactive) == 1:
-                                if float(price.price_list_rate) != float(
-                                    package.unitprice
-                                ):
-                                    # delete Item Price if no package.unitprice or it is 0
-                                    if (
-                                        not float(package.unitprice)
-                                        or float(package.unitprice) == 0
-                                    ):
-                                        frappe.delete_doc("Item Price", price.name)
-                                    else:
-                                        frappe.set_value(
-                                            "Item Price",
-                                            price.name,
-                                            "price_list_rate",
-                                            float(package.unitprice),
-                                        )
-                            else:
-                                frappe.delete_doc("Item Price", price.name)
-
-                    elif package.isactive and int(package.isactive) == 1:
-                        item_price_doc = frappe.new_doc("Item Price")
-                        item_price_doc.update(
-                            {
-                                "item_code": item.item_code,
-                                "price_list": price_list_name,
-                                "currency": currency,
-                                "price_list_rate": float(package.unitprice),
-                                "buying": 0,
-                                "selling": 1,
-                            }
-                        )
-                        item_price_doc.insert(ignore_permissions=True)
-                        item_price_doc.save(ignore_permissions=True)
-    frappe.db.commit()
+            is_active = package.isactive and int(package.isactive) == 1
+            prices = item_prices.get((price_list_name, item.item_code))
+            if prices:
+                for price in prices:
+                    if not is_active:
+                        to_delete.add(price.name)
+                    elif flt(price.price_list_rate) != flt(package.unitprice):
+                        # delete Item Price if no package.unitprice or it is 0
+                        if not flt(package.unitprice):
+                            to_delete.add(price.name)
+                        else:
+                            to_update[price.name] = flt(package.unitprice)
+            elif is_active:
+                to_insert[(item.item_code, price_list_name)] = flt(package.unitprice)
+
+    to_insert = [key + (rate,) for key, rate in to_insert.items()]
+    to_update = [
+        (name, rate) for name, rate in to_update.items() if name not in to_delete
+    ]
+    to_delete = list(to_delete)
+
+    if not dry_run:
+        insert_item_prices(to_insert, currency)
+        update_item_prices(to_update)
+        delete_item_prices(to_delete)
+        frappe.db.commit()
+
+    summary = {
+        "dry_run": dry_run,
+        "inserted": len(to_insert),
+        "updated": len(to_update),
+        "deleted": len(to_delete),
+        "time_taken": round(perf_counter() - start_time, 3),
+    }
+    if dry_run:
+        summary.update(
+            {"to_insert": to_insert, "to_update": to_update, "to_delete": to_delete}
+        )
+    frappe.logger().info({"nhif_process_prices_list": summary})
+    return summary
+
+
+# Item Prices are written through the document so its validation (the
+# duplicate and valid_from checks, the price list details) and version
+# trail apply, only the reading and diffing above is done in bulk
+def insert_item_prices(to_insert, currency):
+    for item_code, price_list, rate in to_insert:
+        try:
+            frappe.get_doc(
+                {
+                    "doctype": "Item Price",
+                    "item_code": item_code,
+                    "price_list": price_list,
+                    "currency": currency,
+                    "price_list_rate": rate,
+                    "buying": 0,
+                    "selling": 1,
+                }
+            ).insert(ignore_permissions=True)
+        except ItemPriceDuplicateItem:
+            # created by another sync since the prices were read
+            frappe.clear_messages()
+
+
+def update_item_prices(to_update):
+    for name, rate in to_update:
+        doc = frappe.get_doc("Item Price", name)
+        doc.price_list_rate = rate
+        doc.save(ignore_permissions=True)
+
+
+def delete_item_prices(to_delete):
+    for name in to_delete:
+        frappe.delete_doc("Item Price", name, ignore_permissions=True)
 
 
 def get_insurance_coverage_items(company):
@@ -363,33 +525,76 @@ def get_insurance_coverage_items(company):
     return items_list
 
 
-def get_excluded_services(itemcode, company):
-    excluded_services = None
-    excluded_services_list = frappe.get_all(
+def get_excluded_services_map(company):
+    excluded_services_map = {}
+    for row in frappe.get_all(
         "NHIF Excluded Services",
-        filters={"itemcode": itemcode, "company": company},
-        fields=["excludedforproducts", "schemeid"],
-    )
-    if len(excluded_services_list) > 0:
-        excluded_services = excluded_services_list[0]
-    return excluded_services
+        filters={"company": company},
+        fields=["itemcode", "schemeid", "excludedforproducts"],
+    ):
+        excluded_services_map.setdefault((cstr(row.itemcode), cstr(row.schemeid)), row)
+    return excluded_services_map
 
 
-def get_price_package(itemcode, schemeid, company):
-    price_package = ""
-    price_package_list = frappe.get_all(
+def get_custom_excluded_services_map(company):
+    custom_excluded_services_map = {}
+    for row in frappe.get_all(
+        "NHIF Custom Excluded Services",
+        filters={"company": company},
+        fields=["itemcode", "excludedforproducts"],
+    ):
+        custom_excluded_services_map.setdefault(
+            cstr(row.itemcode), row.excludedforproducts
+        )
+    return custom_excluded_services_map
+
+
+def get_price_package_map(company):
+    price_package_map = {}
+    for row in frappe.get_all(
         "NHIF Price Package",
-        filters={"itemcode": itemcode, "schemeid": schemeid, "company": company},
-        fields=["maximumquantity", "isrestricted"],
+        filters={"company": company},
+        fields=["itemcode", "schemeid", "maximumquantity", "isrestricted"],
+    ):
+        price_package_map.setdefault((cstr(row.itemcode), cstr(row.schemeid)), row)
+    return price_package_map
+
+
+def get_bulk_names(naming_series, count):
+    """Reserve `count` consecutive names of `naming_series` with a single
+    update of its series counter"""
+    prefix = parse_naming_series(naming_series)
+    current = frappe.db.sql(
+        "SELECT `current` FROM `tabSeries` WHERE `name` = %s FOR UPDATE", (prefix,)
     )
-    if len(price_package_list) > 0:
-        price_package = price_package_list[0]
-    return price_package
+    if current and current[0][0] is not None:
+        current = cint(current[0][0])
+        frappe.db.sql(
+            "UPDATE `tabSeries` SET `current` = `current` + %s WHERE `name` = %s",
+            (count, prefix),
+        )
+    else:
+        current = 0
+        frappe.db.sql(
+            "INSERT INTO `tabSeries` (`name`, `current`) VALUES (%s, %s)",
+            (prefix, count),
+        )
+    return ["{0}{1:05d}".format(prefix, current + i + 1) for i in range(count)]
 
 
 def process_insurance_coverages(kwargs):
+    """Regenerate the auto generated Healthcare Service Insurance Coverage
+    rows of every active NHIF coverage plan.
+
+    Exclusions and price packages are loaded once up front, and each plan's
+    rows are swapped by a delete and insert committed together so a plan is
+    never left without coverage."""
     company = kwargs
+    start_time = perf_counter()
     items_list = get_insurance_coverage_items(company)
+    excluded_services_map = get_excluded_services_map(company)
+    custom_excluded_services_map = get_custom_excluded_services_map(company)
+    price_package_map = get_price_package_map(company)
 
     coverage_plan_list = frappe.get_all(
         "Healthcare Insurance Coverage Plan",
@@ -401,6 +606,7 @@ def process_insurance_coverages(kwargs):
         },
     )
 
+    summary = {}
     for plan in coverage_plan_list:
         insert_data = []
         time_stamp = now()
@@ -408,7 +614,9 @@ def process_insurance_coverages(kwargs):
         for item in items_list:
             if plan.nhif_scheme_id != item.schemeid:
                 continue
-            excluded_services = get_excluded_services(item.ref_code, company)
+            excluded_services = excluded_services_map.get(
+                (cstr(item.ref_code), cstr(item.schemeid))
+            )
             if (
                 excluded_services
                 and excluded_services.excludedforproducts
@@ -419,8 +627,8 @@ def process_insurance_coverages(kwargs):
                     in excluded_services.excludedforproducts
                 ):
                     continue
-            
-            user_excluded_products = get_custom_excluded_services(company, item.ref_code)
+
+            user_excluded_products = custom_excluded_services_map.get(cstr(item.ref_code))
             if (
                 user_excluded_products and 
                 plan.code_for_nhif_excluded_services and 
@@ -428,19 +636,9 @@ def process_insurance_coverages(kwargs):
             ):
                 continue
 
-            doc = frappe.new_doc("Healthcare Service Insurance Coverage")
-            doc.healthcare_service = item.dt
-            doc.healthcare_service_template = item.healthcare_service_template
-            doc.healthcare_insurance_coverage_plan = plan.name
-            doc.company = company
-            doc.coverage = 100
-            doc.end_date = "2099-12-31"
-            doc.is_active = 1
-            doc.discount = 0
-
             maximumquantity = 0
             isrestricted = 0
-            price_package = get_price_package(item.ref_code, item.schemeid, company)
+            price_package = price_package_map.get((cstr(item.ref_code), cstr(item.schemeid)))
             if price_package:
                 if (
                     price_package.maximumquantity
@@ -450,216 +648,178 @@ def process_insurance_coverages(kwargs):
                 if price_package.isrestricted:
                     isrestricted = int(price_package.isrestricted)
 
-            set_new_name(doc)
-
             insert_data.append(
-                (
-                    isrestricted,  # doc.approval_mandatory_for_claim,
-                    doc.coverage,
+                [
+                    isrestricted,  # approval_mandatory_for_claim,
+                    100,  # coverage
                     time_stamp,
-                    doc.discount,
-                    doc.end_date,
-                    doc.healthcare_insurance_coverage_plan,
-                    doc.healthcare_service,
-                    doc.healthcare_service_template,
-                    doc.is_active,
-                    isrestricted,  # doc.manual_approval_only,
-                    maximumquantity,  # doc.maximum_number_of_claims,
+                    0,  # discount
+                    "2099-12-31",  # end_date
+                    plan.name,
+                    item.dt,
+                    item.healthcare_service_template,
+                    1,  # is_active
+                    isrestricted,  # manual_approval_only,
+                    maximumquantity,  # maximum_number_of_claims,
                     time_stamp,
                     user,
-                    doc.name,
-                    doc.naming_series,
+                    None,  # name
+                    HSIC_NAMING_SERIES,
                     user,
-                    doc.start_date,
+                    nowdate(),  # start_date
                     1,
-                    doc.company,
-                )
+                    company,
+                ]
             )
 
         if insert_data:
-            if plan.name:
-                frappe.db.sql(
-                        "DELETE FROM `tabHealthcare Service Insurance Coverage` WHERE is_auto_generated = 1 AND healthcare_insurance_coverage_plan = '{0}'".format(
-                            plan.name
-                        )
-                    )
-                frappe.db.commit()
-                
-            # wait for 60 seconds before creating HSIC records again
-            sleep(60)
+            for row, name in zip(
+                insert_data, get_bulk_names(HSIC_NAMING_SERIES, len(insert_data))
+            ):
+                row[13] = name
 
+            # delete and insert in one transaction, readers keep seeing the
+            # previous rows until the commit below
             frappe.db.sql(
-                """
-                INSERT INTO `tabHealthcare Service Insurance Coverage`
-                (
-                    `approval_mandatory_for_claim`, 
-                    `coverage`, 
-                    `creation`, 
-                    `discount`, 
-                    `end_date`, 
-                    `healthcare_insurance_coverage_plan`, 
-                    `healthcare_service`, 
-                    `healthcare_service_template`, 
-                    `is_active`, 
-                    `manual_approval_only`, 
-                    `maximum_number_of_claims`, 
-                    `modified`, 
-                    `modified_by`, 
-                    `name`, 
-                    `naming_series`, 
-                    `owner`, 
-                    `start_date`,
-                    `is_auto_generated`,
-                    `company`
-                )
-                VALUES {}
-            """.format(
-                    ", ".join(["%s"] * len(insert_data))
-                ),
-                tuple(insert_data),
+                "DELETE FROM `tabHealthcare Service Insurance Coverage` WHERE is_auto_generated = 1 AND healthcare_insurance_coverage_plan = %s",
+                (plan.name,),
             )
-    frappe.db.commit()
-
-
-def set_nhif_diff_records(FacilityCode):
-    logs = frappe.get_all(
-        "NHIF Response Log",
-        filters={
-            "request_type": "GetPricePackageWithExcludedServices",
-            "response_data": ["not in", ["", None]],
-            "request_url": ["like", "%" + FacilityCode + "%"],
-        },
-        order_by="creation desc",
-        page_length=2,
-    )
-    if len(logs) > 1:
-        current = logs[0].name
-        previous = logs[1].name
-    else:
-        frappe.throw(_("There are not enough records in NHIF Response Log"))
+            for i in range(0, len(insert_data), SYNC_BATCH_SIZE):
+                batch = [tuple(row) for row in insert_data[i : i + SYNC_BATCH_SIZE]]
+                frappe.db.sql(
+                    """
+                    INSERT INTO `tabHealthcare Service Insurance Coverage`
+                    (
+                        `approval_mandatory_for_claim`, 
+                        `coverage`, 
+                        `creation`, 
+                        `discount`, 
+                        `end_date`, 
+                        `healthcare_insurance_coverage_plan`, 
+                        `healthcare_service`, 
+                        `healthcare_service_template`, 
+                        `is_active`, 
+                        `manual_approval_only`, 
+                        `maximum_number_of_claims`, 
+                        `modified`, 
+                        `modified_by`, 
+                        `name`, 
+                        `naming_series`, 
+                        `owner`, 
+                        `start_date`,
+                        `is_auto_generated`,
+                        `company`
+                    )
+                    VALUES {}
+                """.format(
+                        ", ".join(["%s"] * len(batch))
+                    ),
+                    tuple(batch),
+                )
+            frappe.db.commit()
+            summary[plan.name] = len(insert_data)
 
-    current_rec = json.loads(
-        frappe.get_cached_value("NHIF Response Log", current, "response_data")
-    )
-    previous_rec = json.loads(
-        frappe.get_cached_value("NHIF Response Log", previous, "response_data")
+    frappe.db.commit()
+    frappe.logger().info(
+        {
+            "nhif_process_insurance_coverages": summary,
+            "time_taken": round(perf_counter() - start_time, 3),
+        }
     )
-    current_price_packages = current_rec.get("PricePackage")
-    previousـprice_packages = previous_rec.get("PricePackage")
+    return summary
 
-    diff_price_packages_from_current = [
-        i for i in current_price_packages if i not in previousـprice_packages
-    ]
-    diff_price_packages_from_previous = [
-        i for i in previousـprice_packages if i not in current_price_packages
-    ]
 
-    changed_price_packages = []
-    new_price_packages = []
+def set_nhif_diff_records(FacilityCode):
+    snapshots = get_latest_snapshots(FacilityCode)
+    if len(snapshots) < 2:
+        # the first download of the facility has nothing to compare with
+        return
+    current = snapshots[0]
+    previous = snapshots[1]
 
-    for e in diff_price_packages_from_current:
-        exist_rec = next(
-            (
-                item
-                for item in diff_price_packages_from_previous
-                if item.get("PriceCode") == e.get("PriceCode")
-            ),
-            None,
+    doc = frappe.new_doc("NHIF Update")
+    for section, key_fields in SNAPSHOT_SECTIONS.items():
+        new_keys, changed_keys, deleted_keys = get_snapshot_diff(
+            current.name, previous.name, section
         )
-        if exist_rec:
-            changed_price_packages.append(exist_rec)
-        else:
-            new_price_packages.append(e)
-
-    deleted_price_packages = []
-
-    for z in diff_price_packages_from_previous:
-        exist_rec = next(
-            (
-                item
-                for item in diff_price_packages_from_current
-                if item.get("PriceCode") == z.get("PriceCode")
-            ),
-            None,
+        if not (new_keys or changed_keys or deleted_keys):
+            continue
+
+        # only the records that differ are read from the data files
+        new_records, changed_records, deleted_records = get_nhif_diff(
+            get_snapshot_records(current.name, section, new_keys | changed_keys),
+            get_snapshot_records(previous.name, section, changed_keys | deleted_keys),
+            key_fields,
         )
-        if not exist_rec:
-            deleted_price_packages.append(z)
+        if section == "PricePackage":
+            add_records = add_price_packages_records
+        else:
+            add_records = add_excluded_services_records
+        add_records(doc, changed_records, "Changed")
+        add_records(doc, new_records, "New")
+        add_records(doc, deleted_records, "Deleted")
 
-    doc = frappe.new_doc("NHIF Update")
-    if (
-        len(changed_price_packages)
-        or len(new_price_packages)
-        or len(deleted_price_packages)
+    if (doc.get("price_package") and len(doc.price_package)) or (
+        doc.get("excluded_services") and (doc.excluded_services)
     ):
-        add_price_packages_records(doc, changed_price_packages, "Changed")
-        add_price_packages_records(doc, new_price_packages, "New")
-        add_price_packages_records(doc, deleted_price_packages, "Deleted")
+        doc.current_log = current.log_name
+        doc.previous_log = previous.log_name
+        doc.save(ignore_permissions=True)
 
-    current_excluded_services = current_rec.get("ExcludedServices")
-    previous_excluded_services = previous_rec.get("ExcludedServices")
 
-    diff_current_excluded_services = [
-        i for i in current_excluded_services if i not in previous_excluded_services
-    ]
-    diff_previous_excluded_services = [
-        i for i in previous_excluded_services if i not in previous_excluded_services
+def get_nhif_diff(current, previous, key_fields):
+    """Compare two NHIF snapshots indexed by `key_fields` in a single pass.
+
+    Returns the new and deleted records, and the changed ones as
+    (current record, changed fields) pairs where changed fields maps each
+    field to its (previous, current) values."""
+    def get_key(record):
+        return tuple(cstr(record.get(field)) for field in key_fields)
+
+    previous_map = {get_key(record): record for record in previous}
+    current_keys = set()
+
+    new_records = []
+    changed_records = []
+    for record in current:
+        key = get_key(record)
+        current_keys.add(key)
+        previous_record = previous_map.get(key)
+        if previous_record is None:
+            new_records.append(record)
+        elif previous_record != record:
+            changed_fields = {
+                field: (previous_record.get(field), record.get(field))
+                for field in set(record) | set(previous_record)
+                if previous_record.get(field) != record.get(field)
+            }
+            changed_records.append((record, changed_fields))
+
+    deleted_records = [
+        record for key, record in previous_map.items() if key not in current_keys
     ]
+    return new_records, changed_records, deleted_records
 
-    changed_excluded_services = []
-    new_excluded_services = []
-
-    for e in diff_current_excluded_services:
-        exist_rec = next(
-            (
-                item
-                for item in diff_previous_excluded_services
-                if item.get("ItemCode") == e.get("ItemCode")
-            ),
-            None,
-        )
-        if exist_rec:
-            changed_excluded_services.append(exist_rec)
-        else:
-            new_excluded_services.append(e)
-
-    deleted_excluded_services = []
-
-    for z in diff_previous_excluded_services:
-        exist_rec = next(
-            (
-                item
-                for item in diff_current_excluded_services
-                if item.get("ItemCode") == z.get("ItemCode")
-            ),
-            None,
-        )
-        if not exist_rec:
-            deleted_excluded_services.append(z)
 
-    if (
-        len(changed_excluded_services)
-        or len(new_excluded_services)
-        or len(deleted_excluded_services)
-    ):
-        add_excluded_services_records(doc, changed_excluded_services, "Changed")
-        add_excluded_services_records(doc, new_excluded_services, "New")
-        add_excluded_services_records(doc, deleted_excluded_services, "Deleted")
-
-    if (doc.get("price_package") and len(doc.price_package)) or (
-        doc.get("excluded_services") and (doc.excluded_services)
-    ):
-        doc.current_log = current
-        doc.previous_log = previous
-        doc.save(ignore_permissions=True)
+def get_changed_fields_text(changed_fields):
+    return "\n".join(
+        "{0}: {1} -> {2}".format(field, *changed_fields[field])
+        for field in sorted(changed_fields)
+    )
 
 
 def add_price_packages_records(doc, rec, type):
     if not len(rec) > 0:
         return
     for e in rec:
+        changed_fields = None
+        if type == "Changed":
+            e, changed_fields = e
         price_row = doc.append("price_package", {})
         price_row.itemcode = e.get("ItemCode")
         price_row.type = type
+        if changed_fields:
+            price_row.changed_fields = get_changed_fields_text(changed_fields)
         price_row.facilitycode = e.get("FacilityCode")
         price_row.package_item_id = e.get("PackageItemID")
         price_row.pricecode = e.get("PriceCode")
@@ -686,8 +846,13 @@ def add_excluded_services_records(doc, rec, type):
     if not len(rec) > 0:
         return
     for e in rec:
+        changed_fields = None
+        if type == "Changed":
+            e, changed_fields = e
         price_row = doc.append("excluded_services", {})
         price_row.type = type
+        if changed_fields:
+            price_row.changed_fields = get_changed_fields_text(changed_fields)
         price_row.itemcode = e.get("ItemCode")
         price_row.schemeid = e.get("SchemeID")
         price_row.schemename = e.get("SchemeName")
@@ -10,8 +10,21 @@ from hms_tz.nhif.api.healthcare_utils import (
     get_restricted_LRPT,
 )
 from frappe.utils import getdate
+from collections import OrderedDict
 import dateutil
 
+REFERENCE_RANGE_FIELDS = [
+    "{0}_{1}".format(band, field)
+    for band in ("i", "c", "m", "f")
+    for field in ("min_range", "max_range", "text")
+]
+REFERENCE_RANGES_CACHE_SIZE = 2048
+REFERENCE_RANGES_VERSION_KEY = "lab_reference_ranges_version"
+
+# process local LRU of {(site, lab_test_name): reference ranges}
+_reference_ranges = OrderedDict()
+_reference_ranges_version = {}
+
 
 def validate(doc, method):
     if not doc.prescribe:
@@ -22,10 +35,12 @@ def validate(doc, method):
 def set_normals(doc):
     dob = frappe.get_cached_value("Patient", doc.patient, "dob")
     age = dateutil.relativedelta.relativedelta(getdate(), dob).years
-    for row in doc.normal_test_items:
-        if not row.result_value:
-            continue
-        normals = get_normals(row.lab_test_name, age, doc.patient_sex)
+    rows = [row for row in doc.normal_test_items if row.result_value]
+    reference_ranges = get_reference_ranges([row.lab_test_name for row in rows])
+    for row in rows:
+        normals = get_normals_from_ranges(
+            reference_ranges.get(row.lab_test_name), age, doc.patient_sex
+        )
         if normals:
             row.min_normal = normals.get("min")
             row.max_normal = normals.get("max")
@@ -74,38 +89,119 @@ def calc_data_normals(data, value):
 
 @frappe.whitelist()
 def get_normals(lab_test_name, patient_age, patient_sex):
+    return get_normals_from_ranges(
+        get_reference_ranges([lab_test_name]).get(lab_test_name), patient_age, patient_sex
+    )
+
+
+def get_normals_from_ranges(ranges, patient_age, patient_sex):
     data = {}
-    doc = get_lab_test_template(lab_test_name)
-    if not doc:
+    if not ranges:
         return data
     if float(patient_age) < 3:
-        data["min"] = doc.i_min_range
-        data["max"] = doc.i_max_range
-        data["text"] = doc.i_text
+        band = "i"
     elif float(patient_age) < 12:
-        data["min"] = doc.c_min_range
-        data["max"] = doc.c_max_range
-        data["text"] = doc.c_text
+        band = "c"
+    elif patient_sex == "Male":
+        band = "m"
+    elif patient_sex == "Female":
+        band = "f"
     else:
-        if patient_sex == "Male":
-            data["min"] = doc.m_min_range
-            data["max"] = doc.m_max_range
-            data["text"] = doc.m_text
-        elif patient_sex == "Female":
-            data["min"] = doc.f_min_range
-            data["max"] = doc.f_max_range
-            data["text"] = doc.f_text
+        return data
 
+    data["min"] = ranges[band + "_min_range"]
+    data["max"] = ranges[band + "_max_range"]
+    data["text"] = ranges[band + "_text"]
     return data
 
 
-def get_lab_test_template(lab_test_name):
-    template_id = frappe.db.exists(
-        "Lab Test Template", {"lab_test_name": lab_test_name}
-    )
-    if template_id:
-        return frappe.get_cached_doc("Lab Test Template", template_id)
-    return False
+@frappe.whitelist()
+def get_normals_bulk(lab_test_names, patient_age, patient_sex):
+    """Normals of several tests for one patient, {lab_test_name: normals}"""
+    lab_test_names = frappe.parse_json(lab_test_names)
+    reference_ranges = get_reference_ranges(lab_test_names)
+    return {
+        name: get_normals_from_ranges(reference_ranges.get(name), patient_age, patient_sex)
+        for name in lab_test_names
+    }
+
+
+@frappe.whitelist()
+def classify_results(results, patient_age, patient_sex):
+    """Normals and result status for a list of {lab_test_name, result_value},
+    for analyser imports and reports that classify outside a Lab Test save"""
+    results = frappe.parse_json(results)
+    reference_ranges = get_reference_ranges([r.get("lab_test_name") for r in results])
+    classified = []
+    for result in results:
+        row = frappe._dict(result)
+        normals = get_normals_from_ranges(
+            reference_ranges.get(row.lab_test_name), patient_age, patient_sex
+        )
+        if normals and row.result_value:
+            row.update(
+                {
+                    "min_normal": normals.get("min"),
+                    "max_normal": normals.get("max"),
+                    "text_normal": normals.get("text"),
+                }
+            )
+            row.update(calc_data_normals(normals, row.result_value))
+        classified.append(row)
+    return classified
+
+
+def get_reference_ranges(lab_test_names):
+    """Age and sex bands of the templates named `lab_test_names`, from the
+    process local LRU with the missing ones loaded in a single query"""
+    cache = get_reference_ranges_cache()
+    site = frappe.local.site
+    ranges = {}
+    missing = []
+    for name in set(lab_test_names):
+        if not name:
+            continue
+        key = (site, name)
+        if key in cache:
+            cache.move_to_end(key)
+            ranges[name] = cache[key]
+        else:
+            missing.append(name)
+
+    if missing:
+        loaded = {}
+        for template in frappe.get_all(
+            "Lab Test Template",
+            filters={"lab_test_name": ["in", missing]},
+            fields=["lab_test_name"] + REFERENCE_RANGE_FIELDS,
+            order_by="modified desc",
+        ):
+            loaded.setdefault(template.pop("lab_test_name"), template)
+        for name in missing:
+            # templates that do not exist are cached as well
+            ranges[name] = cache[(site, name)] = loaded.get(name)
+        while len(cache) > REFERENCE_RANGES_CACHE_SIZE:
+            cache.popitem(last=False)
+
+    return ranges
+
+
+def get_reference_ranges_cache():
+    """The LRU is dropped once per request when any worker has updated a
+    Lab Test Template since it was filled"""
+    if not getattr(frappe.local, "lab_reference_ranges_checked", False):
+        version = frappe.cache().get_value(REFERENCE_RANGES_VERSION_KEY)
+        if _reference_ranges_version.get(frappe.local.site) != version:
+            for key in [key for key in _reference_ranges if key[0] == frappe.local.site]:
+                del _reference_ranges[key]
+            _reference_ranges_version[frappe.local.site] = version
+        frappe.local.lab_reference_ranges_checked = True
+    return _reference_ranges
+
+
+def clear_reference_ranges_cache(doc=None, method=None):
+    frappe.cache().set_value(REFERENCE_RANGES_VERSION_KEY, frappe.generate_hash(length=10))
+    frappe.local.lab_reference_ranges_checked = False
 
 
 def on_submit(doc, methd):
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022, Aakvatech and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+import requests
+from time import perf_counter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from six.moves.urllib.parse import urlparse
+from frappe.utils import cint, flt
+from hms_tz.nhif.doctype.nhif_response_log.nhif_response_log import add_log
+
+
+# (connect, read) timeouts in seconds, the read timeout is raised per call
+# for the heavy endpoints (price packages, folio submission, claim lists)
+CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+LONG_READ_TIMEOUT = 300
+
+# retry connection errors on every method, gateway errors only on GET
+MAX_RETRIES = 3
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = [502, 503, 504]
+POOL_MAXSIZE = 10
+
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+# one keep-alive session per NHIF base url per worker process
+_sessions = {}
+
+
+def get_base_url(url):
+    parsed = urlparse(url)
+    return "{0}://{1}".format(parsed.scheme, parsed.netloc)
+
+
+def get_session(url):
+    base_url = get_base_url(url)
+    session = _sessions.get(base_url)
+    if not session:
+        retry = Retry(
+            total=MAX_RETRIES,
+            connect=MAX_RETRIES,
+            read=0,
+            status=MAX_RETRIES,
+            backoff_factor=RETRY_BACKOFF_FACTOR,
+            status_forcelist=RETRY_STATUS_CODES,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=POOL_MAXSIZE, max_retries=retry
+        )
+        session = requests.Session()
+        session.mount(base_url, adapter)
+        _sessions[base_url] = session
+    return session
+
+
+def nhif_request(method, url, request_type, read_timeout=DEFAULT_READ_TIMEOUT, **kwargs):
+    """Send a request to NHIF over the pooled session for its base url.
+
+    The latency is recorded against `request_type`. Requests that get no
+    response at all are written to NHIF Response Log here, responses are
+    logged by the caller as before."""
+    start_time = perf_counter()
+    try:
+        r = get_session(url).request(
+            method, url, timeout=(CONNECT_TIMEOUT, read_timeout), **kwargs
+        )
+    except requests.exceptions.RequestException as e:
+        duration = perf_counter() - start_time
+        record_latency(request_type, duration, "error")
+        add_log(
+            request_type=request_type,
+            request_url=url,
+            request_header=kwargs.get("headers"),
+            response_data=repr(e),
+            status_code="NO RESPONSE",
+            duration=duration,
+        )
+        raise
+
+    record_latency(request_type, perf_counter() - start_time, r.status_code)
+    return r
+
+
+def get_latency_key(request_type):
+    return frappe.cache().make_key("nhif_latency|{0}".format(request_type))
+
+
+def record_latency(request_type, duration, status):
+    """Histogram of latencies per request type, kept in a redis hash"""
+    bucket = next(
+        (str(le) for le in LATENCY_BUCKETS if duration <= le), "+Inf"
+    )
+    try:
+        key = get_latency_key(request_type)
+        pipe = frappe.cache().pipeline()
+        pipe.hincrby(key, "le_" + bucket, 1)
+        pipe.hincrby(key, "count", 1)
+        pipe.hincrbyfloat(key, "sum", duration)
+        pipe.hincrby(key, "status_{0}".format(status), 1)
+        pipe.execute()
+    except Exception:
+        # metrics must never break the NHIF call itself
+        frappe.logger().debug({"nhif_latency_error": request_type})
+
+
+@frappe.whitelist()
+def get_latency_histogram(request_type):
+    frappe.only_for("System Manager")
+    # raw redis read, the cache wrapper would re-prefix the key and unpickle
+    pipe = frappe.cache().pipeline()
+    pipe.hgetall(get_latency_key(request_type))
+    data = {
+        frappe.safe_decode(k): frappe.safe_decode(v)
+        for k, v in (pipe.execute()[0] or {}).items()
+    }
+    count = cint(data.get("count"))
+    return {
+        "request_type": request_type,
+        "count": count,
+        "average": flt(data.get("sum")) / count if count else 0,
+        "buckets": {
+            str(le): cint(data.get("le_" + str(le)))
+            for le in LATENCY_BUCKETS + ["+Inf"]
+        },
+        "status": {
+            k[len("status_"):]: cint(v)
+            for k, v in data.items()
+            if k.startswith("status_")
+        },
+    }
@@ -14,10 +14,10 @@ from erpnext.healthcare.doctype.healthcare_settings.healthcare_settings import (
 from frappe.model.mapper import get_mapped_doc
 from hms_tz.nhif.api.token import get_nhifservice_token
 import json
-import requests
 from hms_tz.nhif.doctype.nhif_product.nhif_product import add_product
 from hms_tz.nhif.doctype.nhif_scheme.nhif_scheme import add_scheme
 from hms_tz.nhif.doctype.nhif_response_log.nhif_response_log import add_log
+from hms_tz.nhif.api.nhif_client import nhif_request
 from hms_tz.nhif.api.healthcare_utils import get_item_rate
 from frappe.utils import date_diff, getdate, nowdate
 from csf_tz import console
@@ -332,7 +332,7 @@ def get_authorization_num(
         + remarks
     )
 
-    r = requests.get(url, headers=headers, timeout=5)
+    r = nhif_request("GET", url, "AuthorizeCard", headers=headers)
     r.raise_for_status()
     frappe.logger().debug({"webhook_success": r.text})
     if json.loads(r.text):
@@ -341,7 +341,8 @@ def get_authorization_num(
             request_url=url,
             request_header=headers,
             response_data=json.loads(r.text),
-            status_code = r.status_code
+            status_code = r.status_code,
+            duration=r.elapsed.total_seconds(),
         )
         card = json.loads(r.text)
         # console(card)
@@ -357,7 +358,8 @@ def get_authorization_num(
             request_type="AuthorizeCard",
             request_url=url,
             request_header=headers,
-            status_code = r.status_code
+            status_code = r.status_code,
+            duration=r.elapsed.total_seconds(),
         )
         frappe.throw(json.loads(r.text))
 
@@ -5,7 +5,7 @@
 from __future__ import unicode_literals
 import frappe
 from frappe import _
-from frappe.utils import nowdate, getdate, nowtime, add_to_date, cint, cstr, add_days
+from frappe.utils import nowdate, getdate, nowtime, add_to_date, cint, cstr, add_days, flt
 from hms_tz.nhif.api.healthcare_utils import (
     get_item_rate,
     get_warehouse_from_service_unit,
@@ -30,6 +30,9 @@ from hms_tz.nhif.api.patient_appointment import (
 )
 from erpnext.accounts.utils import get_balance_on
 
+# seconds a patient's last prescribed lookups stay cached
+LAST_PRESCRIBED_CACHE_TTL = 24 * 60 * 60
+
 
 def on_trash(doc, method):
     pmr_list = frappe.get_all(
@@ -89,11 +92,19 @@ def on_submit_validation(doc, method):
             "item": "therapy_type",
         },
     ]
+    templates_info = get_templates_info(doc, childs_map)
     for child in childs_map:
         for row in doc.get(child.get("table")):
-            healthcare_doc = frappe.get_doc(
-                child.get("doctype"), row.get(child.get("item"))
+            healthcare_doc = templates_info[child.get("doctype")].get(
+                row.get(child.get("item"))
             )
+            if not healthcare_doc:
+                frappe.throw(
+                    _("{0} {1} not found").format(
+                        child.get("doctype"), row.get(child.get("item"))
+                    ),
+                    frappe.DoesNotExistError,
+                )
             if healthcare_doc.disabled:
                 msgThrow(
                     _(
@@ -141,6 +152,7 @@ def on_submit_validation(doc, method):
         doc.practitioner = submitting_healthcare_practitioner
 
     # Run on_submit?
+    stock_data = get_stock_validation_data(doc, child_tables)
     prescribed_list = ""
     for key, value in child_tables.items():
         table = doc.get(key)
@@ -181,10 +193,10 @@ def on_submit_validation(doc, method):
                 old_method = method
                 if doc.insurance_subscription and not row.prescribe:
                     method='validate'
-                validate_stock_item(
+                validate_prefetched_stock_item(
+                    stock_data,
                     row.get(value),
                     quantity,
-                    doc.company,
                     healthcare_service_unit=row.get("healthcare_service_unit"),
                     method=method,
                 )
@@ -263,6 +275,7 @@ def on_submit_validation(doc, method):
         healthcare_insurance_coverage_plan,
         ["coverage_plan_name", "is_exclusions"],
     )
+    limited_coverages = {}
     for template in healthcare_service_templates:
         if not is_exclusions:
             if template not in hsic_map:
@@ -300,7 +313,9 @@ def on_submit_validation(doc, method):
         if coverage_info.maximum_number_of_claims == 0:
             continue
 
-        validate_maximum_number_of_claims_per_month(coverage_info, insurance_subscription, template, today, method)
+        limited_coverages[template] = coverage_info
+
+    validate_maximum_number_of_claims_per_month(limited_coverages, insurance_subscription, today, method)
 
     if not doc.patient_age:
         doc.patient_age = calculate_patient_age(doc.patient)
@@ -309,6 +324,52 @@ def on_submit_validation(doc, method):
     validate_totals(doc)
 
 
+def get_templates_info(doc, childs_map):
+    """Disabled flag, inpatient flag and the company option of every template
+    used on the encounter, with one query per template doctype.
+
+    Returns {doctype: {template: {"disabled", "is_inpatient", "company_options"}}}"""
+    templates_info = {}
+    for child in childs_map:
+        doctype = child.get("doctype")
+        templates_info[doctype] = {}
+        templates = list(
+            {row.get(child.get("item")) for row in doc.get(child.get("table"))}
+        )
+        if not templates:
+            continue
+        is_inpatient = (
+            "t.is_inpatient" if doctype == "Clinical Procedure Template" else "0"
+        )
+        for info in frappe.db.sql(
+            """
+                SELECT t.name, t.disabled, {is_inpatient} AS is_inpatient,
+                    hco.company, hco.service_unit
+                FROM `tab{doctype}` t
+                LEFT JOIN `tabHealthcare Company Option` hco
+                    ON hco.parent = t.name AND hco.parenttype = %(doctype)s
+                    AND hco.company = %(company)s
+                WHERE t.name IN %(templates)s
+                ORDER BY hco.idx
+            """.format(is_inpatient=is_inpatient, doctype=doctype),
+            {"doctype": doctype, "company": doc.company, "templates": templates},
+            as_dict=1,
+        ):
+            template = templates_info[doctype].setdefault(
+                info.name,
+                frappe._dict(
+                    disabled=info.disabled,
+                    is_inpatient=info.is_inpatient,
+                    company_options=[],
+                ),
+            )
+            if info.company:
+                template.company_options.append(
+                    frappe._dict(company=info.company, service_unit=info.service_unit)
+                )
+    return templates_info
+
+
 def checkـforـduplicate(doc, method):
     items = []
     for item in doc.drug_prescription:
@@ -421,6 +482,97 @@ def get_stock_availability(item_code, warehouse):
     return sle_qty
 
 
+def get_stock_validation_data(doc, child_tables):
+    """Medication items, service unit warehouses and Bin quantities needed by
+    validate_prefetched_stock_item for all rows, in one query per table"""
+    templates = set()
+    service_units = set()
+    for key, value in child_tables.items():
+        for row in doc.get(key):
+            if row.is_not_available_inhouse or not row.get("healthcare_service_unit"):
+                continue
+            templates.add(row.get(value))
+            service_units.add(row.get("healthcare_service_unit"))
+
+    stock_data = frappe._dict(items={}, warehouses={}, stock={})
+    if not templates:
+        return stock_data
+
+    for item in frappe.db.sql(
+        """
+            SELECT m.name, m.item AS item_code, i.is_stock_item AS is_stock
+            FROM `tabMedication` m
+            INNER JOIN `tabItem` i ON i.name = m.item
+            WHERE m.name IN %(templates)s
+        """,
+        {"templates": list(templates)},
+        as_dict=1,
+    ):
+        stock_data.items[item.name] = item
+
+    stock_data.warehouses = dict(
+        frappe.db.sql(
+            """
+                SELECT name, warehouse FROM `tabHealthcare Service Unit`
+                WHERE name IN %(service_units)s
+            """,
+            {"service_units": list(service_units)},
+        )
+    )
+
+    stock_items = [item.item_code for item in stock_data.items.values() if item.is_stock]
+    warehouses = [warehouse for warehouse in stock_data.warehouses.values() if warehouse]
+    if stock_items and warehouses:
+        for item_code, warehouse, actual_qty in frappe.db.sql(
+            """
+                SELECT item_code, warehouse, actual_qty FROM `tabBin`
+                WHERE item_code IN %(items)s AND warehouse IN %(warehouses)s
+            """,
+            {"items": stock_items, "warehouses": warehouses},
+        ):
+            stock_data.stock[(item_code, warehouse)] = actual_qty
+    return stock_data
+
+
+def validate_prefetched_stock_item(
+    stock_data, healthcare_service, qty, healthcare_service_unit=None, method="throw"
+):
+    """validate_stock_item for rows whose data was loaded with
+    get_stock_validation_data"""
+    if not healthcare_service_unit:
+        return
+
+    qty = float(qty or 0)
+    if qty == 0:
+        qty = 1
+
+    item_info = stock_data.items.get(healthcare_service) or {}
+    warehouse = stock_data.warehouses.get(healthcare_service_unit)
+    if not warehouse:
+        frappe.throw(
+            _("Warehouse is missing in Healthcare Service Unit {0}").format(
+                healthcare_service_unit
+            )
+        )
+    if item_info.get("is_stock") and item_info.get("item_code"):
+        stock_qty = stock_data.stock.get((item_info.get("item_code"), warehouse)) or 0
+        if float(qty) > float(stock_qty):
+            msgThrow(
+                _(
+                    "Available quantity for item: <h4 style='background-color:"
+                    " LightCoral'>{0} is {3}</h4>In {1}/{2}."
+                ).format(
+                    item_info.get("item_code"),
+                    warehouse,
+                    healthcare_service_unit,
+                    stock_qty,
+                ),
+                method,
+            )
+            return False
+    return True
+
+
 @frappe.whitelist()
 def validate_stock_item(
     healthcare_service,
@@ -1216,26 +1368,80 @@ def inpatient_billing(patient_encounter_doc, method):
     create_delivery_note(patient_encounter_doc, method)
 
 
+def get_last_prescribed_cache_key(patient):
+    return "hms_tz_last_prescribed|{0}".format(patient)
+
+
+def clear_last_prescribed_cache(doc, method=None):
+    """Hooked on the documents the last prescribed lookups read from"""
+    if doc.get("patient"):
+        frappe.cache().delete_value(get_last_prescribed_cache_key(doc.patient))
+
+
+def get_last_prescribed(patient, category, items, fetch):
+    """Last prescription of each item for the patient, cached per patient.
+
+    `fetch(items)` loads the missing items in one query and returns
+    {item: value}; items without a previous prescription are cached as None."""
+    key = get_last_prescribed_cache_key(patient)
+    cached = frappe.cache().get_value(key) or {}
+    category_cache = cached.setdefault(category, {})
+    missing = [item for item in set(items) if item and item not in category_cache]
+    if missing:
+        fetched = fetch(missing)
+        for item in missing:
+            category_cache[item] = fetched.get(item)
+        frappe.cache().set_value(key, cached, expires_in_sec=LAST_PRESCRIBED_CACHE_TTL)
+    return {item: category_cache.get(item) for item in items}
+
+
 def show_last_prescribed(doc, method):
     if doc.is_new():
         return
     if method == "validate":
-        msg = None
-        for row in doc.drug_prescription:
-            medication_list = frappe.db.sql(
+        def fetch(items):
+            medications = {}
+            for medication in frappe.db.sql(
                 """
-            select dn.posting_date, dni.item_code, dni.stock_qty, dni.uom from `tabDelivery Note` dn
-            inner join `tabDelivery Note Item` dni on dni.parent = dn.name
-                            where dni.item_code = %s
-                            and dn.patient = %s
-                            and dn.docstatus = 1
-                            order by posting_date desc
-                            limit 1"""
-                % ("%s", "%s"),
-                (row.drug_code, doc.patient),
+                    select last.item_code, last.posting_date, (
+                        select dni.stock_qty from `tabDelivery Note` dn
+                        inner join `tabDelivery Note Item` dni on dni.parent = dn.name
+                        where dni.item_code = last.item_code
+                        and dn.patient = %(patient)s
+                        and dn.docstatus = 1
+                        and dn.posting_date = last.posting_date
+                        order by dn.posting_time desc, dni.idx
+                        limit 1
+                    ) as stock_qty
+                    from (
+                        select dni.item_code, max(dn.posting_date) as posting_date
+                        from `tabDelivery Note` dn
+                        inner join `tabDelivery Note Item` dni on dni.parent = dn.name
+                        where dni.item_code in %(items)s
+                        and dn.patient = %(patient)s
+                        and dn.docstatus = 1
+                        group by dni.item_code
+                    ) last
+                """,
+                {"items": items, "patient": doc.patient},
                 as_dict=1,
-            )
-            if len(medication_list) > 0:
+            ):
+                medications[medication.item_code] = {
+                    "posting_date": medication.posting_date,
+                    "stock_qty": medication.stock_qty,
+                }
+            return medications
+
+        last_prescribed = get_last_prescribed(
+            doc.patient,
+            "Delivery Note",
+            [row.drug_code for row in doc.drug_prescription],
+            fetch,
+        )
+        msg = None
+        for row in doc.drug_prescription:
+            medication = last_prescribed.get(row.drug_code)
+            if medication:
                 msg = (
                     (msg or "")
                     + _(
@@ -1243,9 +1449,9 @@ def show_last_prescribed(doc, method):
                         + row.drug_code
                         + "</strong>"
                         + " qty: <strong>"
-                        + str(medication_list[0].get("stock_qty"))
+                        + str(medication.get("stock_qty"))
                         + "</strong>, prescribed last on: <strong>"
-                        + str(medication_list[0].get("posting_date"))
+                        + str(medication.get("posting_date"))
                     )
                     + "</strong><br>"
                 )
@@ -1418,24 +1624,30 @@ def show_last_prescribed_for_lrpt(doc):
 
     msg = ""
     for child in childs_map:
-        msg_print = ""
-        for entry in doc.get(child.get("table")):
-            conditions = {
-                "patient": doc.patient,
-                child.get("field_name"): entry.get(child.get("item")),
-            }
-
-            item_doc = frappe.get_all(
-                child.get("ref_doc"),
-                filters=conditions,
-                fields=[child.get("field_name"), "creation"],
-                order_by="creation DESC",
-                limit=1,
+        def fetch(items):
+            return dict(
+                frappe.db.sql(
+                    """
+                        SELECT `{field_name}`, DATE(MAX(creation)) FROM `tab{ref_doc}`
+                        WHERE patient = %(patient)s AND `{field_name}` IN %(items)s
+                        GROUP BY `{field_name}`
+                    """.format(
+                        field_name=child.get("field_name"), ref_doc=child.get("ref_doc")
+                    ),
+                    {"patient": doc.patient, "items": items},
+                )
             )
 
-            if len(item_doc) > 0:
-                date = item_doc[0]["creation"].strftime("%Y-%m-%d")
-
+        last_prescribed = get_last_prescribed(
+            doc.patient,
+            child.get("ref_doc"),
+            [entry.get(child.get("item")) for entry in doc.get(child.get("table"))],
+            fetch,
+        )
+        msg_print = ""
+        for entry in doc.get(child.get("table")):
+            date = last_prescribed.get(entry.get(child.get("item")))
+            if date:
                 msg_print += _("{0} prescribed last on: {1}".format(
                         frappe.bold(entry.get(child.get("item"))), frappe.bold(date)
                     )
@@ -1444,21 +1656,28 @@ def show_last_prescribed_for_lrpt(doc):
 
         msg += msg_print
 
-    for plan in doc.therapies:
-        items = frappe.db.sql(
-            """ 
-            SELECT tpd.therapy_type, Date(tpd.creation) AS date FROM `tabTherapy Plan Detail` tpd
-            INNER JOIN `tabTherapy Plan` tp ON tpd.parent = tp.name WHERE tp.patient = %s 
-            AND tpd.therapy_type = %s """
-            % (frappe.db.escape(doc.patient), frappe.db.escape(plan.therapy_type)),
-            as_dict=1,
+    # Therapy Plans have no hooks to clear the cache, always read them
+    therapy_types = list({plan.therapy_type for plan in doc.therapies})
+    last_therapies = {}
+    if therapy_types:
+        last_therapies = dict(
+            frappe.db.sql(
+                """
+                SELECT tpd.therapy_type, DATE(MAX(tpd.creation)) AS date FROM `tabTherapy Plan Detail` tpd
+                INNER JOIN `tabTherapy Plan` tp ON tpd.parent = tp.name WHERE tp.patient = %(patient)s
+                AND tpd.therapy_type IN %(therapy_types)s
+                GROUP BY tpd.therapy_type
+                """,
+                {"patient": doc.patient, "therapy_types": therapy_types},
+            )
         )
-
-        if items:
+    for plan in doc.therapies:
+        if last_therapies.get(plan.therapy_type):
             msg = _(
                 msg
                 + "{0} prescribed last on: {1}".format(
-                    frappe.bold(items[0]["therapy_type"]), frappe.bold(items[0]["date"])
+                    frappe.bold(plan.therapy_type),
+                    frappe.bold(last_therapies[plan.therapy_type]),
                 )
                 + "<br>"
             )
@@ -1534,63 +1753,65 @@ def validate_admission_encounter(encounter):
         ))
         return True
 
-def validate_maximum_number_of_claims_per_month(coverage_info, insurance_subscription, template, today, method):
-    days = 30
-
-    lrpt_names_sql = """
-        SELECT hsi.name FROM `tabLab Prescription` hsi
-        INNER JOIN `tabPatient Encounter` pe ON hsi.parent = pe.name
-        WHERE pe.insurance_subscription = "{0}"
-        AND hsi.lab_test_code = "{1}"
-        AND hsi.prescribe = 0
-        AND DATE(pe.creation) BETWEEN "{2}" AND "{3}"
-        UNION ALL
-        SELECT hsi.name FROM `tabRadiology Procedure Prescription` hsi
-        INNER JOIN `tabPatient Encounter` pe ON hsi.parent = pe.name
-        WHERE pe.insurance_subscription = "{0}"
-        AND hsi.radiology_examination_template = "{1}"
-        AND hsi.prescribe = 0
-        AND DATE(pe.creation) BETWEEN "{2}" AND "{3}"
-        UNION ALL
-        SELECT hsi.name FROM `tabProcedure Prescription` hsi
-        INNER JOIN `tabPatient Encounter` pe ON hsi.parent = pe.name
-        WHERE pe.insurance_subscription = "{0}"
-        AND hsi.procedure = "{1}"
-        AND hsi.prescribe = 0
-        AND DATE(pe.creation) BETWEEN "{2}" AND "{3}"
-        UNION ALL
-        SELECT hsi.name FROM `tabTherapy Plan Detail` hsi
-        INNER JOIN `tabPatient Encounter` pe ON hsi.parent = pe.name
-        WHERE pe.insurance_subscription = "{0}"
-        AND hsi.therapy_type = "{1}"
-        AND hsi.prescribe = 0
-        AND DATE(pe.creation) BETWEEN "{2}" AND "{3}"
-    """.format(
-        insurance_subscription, template, add_days(today, days=-days), today
+def get_claims_usage(insurance_subscription, templates, today, days=30):
+    """Claims made on the subscription within the last `days` days for each
+    template: number of prescription rows for lab, radiology, procedure and
+    therapy templates, total quantity for medications"""
+    if not templates:
+        return {}
+
+    values = {
+        "insurance_subscription": insurance_subscription,
+        "templates": list(templates),
+        "from_date": getdate(add_days(today, days=-days)),
+        "to_date": getdate(add_days(today, days=1)),
+    }
+    tables = [
+        ("Lab Prescription", "lab_test_code", "1"),
+        ("Radiology Procedure Prescription", "radiology_examination_template", "1"),
+        ("Procedure Prescription", "procedure", "1"),
+        ("Therapy Plan Detail", "therapy_type", "1"),
+        ("Drug Prescription", "drug_code", "hsi.quantity"),
+    ]
+    usage_sql = " UNION ALL ".join(
+        """
+            SELECT hsi.{field} AS template, {qty} AS qty FROM `tab{table}` hsi
+            INNER JOIN `tabPatient Encounter` pe ON hsi.parent = pe.name
+            WHERE pe.insurance_subscription = %(insurance_subscription)s
+            AND hsi.{field} IN %(templates)s
+            AND hsi.prescribe = 0
+            AND pe.creation >= %(from_date)s AND pe.creation < %(to_date)s
+        """.format(table=table, field=field, qty=qty)
+        for table, field, qty in tables
     )
-    lrpt_names = frappe.db.sql(lrpt_names_sql)
-    lrpt_count = len(lrpt_names) or 0
-    
+    return {
+        template: flt(count)
+        for template, count in frappe.db.sql(
+            """
+                SELECT usage_rows.template, SUM(usage_rows.qty)
+                FROM ({0}) usage_rows
+                GROUP BY usage_rows.template
+            """.format(usage_sql),
+            values,
+        )
+    }
 
-    drug_count_sql = """
-        SELECT SUM(hsi.quantity) FROM `tabDrug Prescription` hsi
-        INNER JOIN `tabPatient Encounter` pe ON hsi.parent = pe.name
-        WHERE pe.insurance_subscription = "{0}"
-        AND hsi.drug_code = "{1}"
-        AND hsi.prescribe = 0
-        AND DATE(pe.creation) BETWEEN "{2}" AND "{3}"
-    """.format(
-        insurance_subscription, template, add_days(today, days=-days), today
-    )
-    drug_count = (
-        frappe.db.sql(drug_count_sql, as_dict=0,)[0][0] or 0
-    )
 
-    if (lrpt_count + drug_count) > coverage_info.maximum_number_of_claims:
-        msgThrow(
-            _(
-                "Maximum Number of Claims for {0} per month is exceeded within the"
-                " last {1} days. The allowed count is {2} where as past prescription count is {3}"
-            ).format(template, days,coverage_info.maximum_number_of_claims, coverage_info.number_of_claims),
-            "validate",
-        )
+def validate_maximum_number_of_claims_per_month(limited_coverages, insurance_subscription, today, method):
+    """limited_coverages is like {"CBC": HSIC_object_for_CBC} for the templates
+    that have a maximum number of claims"""
+    days = 30
+
+    claims_usage = get_claims_usage(
+        insurance_subscription, list(limited_coverages), today, days=days
+    )
+    for template, coverage_info in limited_coverages.items():
+        claims_count = claims_usage.get(template) or 0
+        if claims_count > coverage_info.maximum_number_of_claims:
+            msgThrow(
+                _(
+                    "Maximum Number of Claims for {0} per month is exceeded within the"
+                    " last {1} days. The allowed count is {2} where as past prescription count is {3}"
+                ).format(template, days, coverage_info.maximum_number_of_claims, claims_count),
+                "validate",
+            )
@@ -8,103 +8,248 @@ from frappe.utils import get_url_to_form, get_url
 from frappe import _
 from frappe.utils.password import get_decrypted_password
 import json
-import requests
 from time import sleep
-from frappe.utils import now, add_to_date, now_datetime, cstr
+from frappe.utils import add_to_date, now_datetime, cstr, get_datetime, cint
 from hms_tz.nhif.doctype.nhif_response_log.nhif_response_log import add_log
+from hms_tz.nhif.api.nhif_client import nhif_request
 
 
-def make_token_request(doc, url, headers, payload, fields):
-    for i in range(3):
-        try:
-            r = requests.request("POST", url, headers=headers, data=payload, timeout=5)
-            r.raise_for_status()
-            frappe.logger().debug({"webhook_success": r.text})
-            if json.loads(r.text):
-                add_log(
-                    request_type="Token",
-                    request_url=url,
-                    request_header=headers,
-                    request_body=payload,
-                    response_data=json.loads(r.text),
-                    status_code=r.status_code,
-                )
-            
-            if json.loads(r.text)["token_type"] == "bearer":
-                token = json.loads(r.text)["access_token"]
-                expired = json.loads(r.text)["expires_in"]
-                expiry_date = add_to_date(now(), seconds=(expired - 1000))
-                doc.update({
-                    fields["token"]: token,
-                    fields["expiry"]: expiry_date
-                })
-
-                doc.db_update()
-                frappe.db.commit()
-                return token
-            else:
-                add_log(
-                    request_type="Token",
-                    request_url=url,
-                    request_header=headers,
-                    request_body=payload,
-                    status_code=r.status_code
+# Tokens are shared by all workers through redis, keyed by company and
+# service. Only the worker holding the refresh lock calls /Token, the others
+# keep using the current token or wait for the new one.
+TOKEN_SERVICES = {
+    "nhifservice": {
+        "url": "nhifservice_url",
+        "path": "/nhifservice/Token",
+        "token": "nhifservice_token",
+        "expiry": "nhifservice_expiry",
+    },
+    "claimsserver": {
+        "url": "claimsserver_url",
+        "path": "/claimsserver/Token",
+        "token": "claimsserver_token",
+        "expiry": "claimsserver_expiry",
+    },
+    "nhifform": {
+        "url": "nhifform_url",
+        "path": "/formposting/Token",
+        "token": "nhifform_token",
+        "expiry": "nhifform_expiry",
+    },
+}
+
+# start refreshing this many seconds before the token expires, at most a
+# fifth of the token lifetime so short lived tokens are still reused
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_REFRESH_FRACTION = 5
+# the lock outlives the connection retries of the token request
+TOKEN_LOCK_TIMEOUT = 60
+TOKEN_WAIT_TIMEOUT = 10
+TOKEN_WAIT_INTERVAL = 0.5
+
+
+def make_token_request(url, headers, payload):
+    """Request a new token, return the token and its lifetime in seconds"""
+    # connection retries are handled by the NHIF client
+    r = nhif_request("POST", url, "Token", headers=headers, data=payload)
+    r.raise_for_status()
+    frappe.logger().debug({"webhook_success": r.text})
+    if json.loads(r.text):
+        add_log(
+            request_type="Token",
+            request_url=url,
+            request_header=headers,
+            request_body=payload,
+            response_data=json.loads(r.text),
+            status_code=r.status_code,
+            duration=r.elapsed.total_seconds(),
+        )
+
+    if json.loads(r.text)["token_type"] == "bearer":
+        token = json.loads(r.text)["access_token"]
+        expires_in = cint(json.loads(r.text)["expires_in"])
+        return token, expires_in
+    else:
+        add_log(
+            request_type="Token",
+            request_url=url,
+            request_header=headers,
+            request_body=payload,
+            status_code=r.status_code,
+            duration=r.elapsed.total_seconds(),
+        )
+        frappe.throw(json.loads(r.text))
+
+
+def get_refresh_margin(lifetime):
+    return min(TOKEN_REFRESH_MARGIN, cint(lifetime) // TOKEN_REFRESH_FRACTION)
+
+
+def get_token_cache_key(company, service):
+    return "nhif_token|{0}|{1}".format(company, service)
+
+
+def get_cached_token(company, service):
+    """Return the cached (token, expiry, refresh_after) for the service,
+    falling back to the values stored on Company NHIF Settings when redis
+    has none"""
+    cached = frappe.cache().get_value(get_token_cache_key(company, service))
+    if cached:
+        return (
+            cached.get("token"),
+            get_datetime(cached.get("expiry")),
+            get_datetime(cached.get("refresh_after")),
+        )
+
+    fields = TOKEN_SERVICES[service]
+    token, expiry = frappe.db.get_value(
+        "Company NHIF Settings", company, [fields["token"], fields["expiry"]]
+    ) or (None, None)
+    if token and expiry and get_datetime(expiry) > now_datetime():
+        expiry = get_datetime(expiry)
+        lifetime = (expiry - now_datetime()).total_seconds()
+        set_cached_token(company, service, token, expiry, lifetime)
+        return token, expiry, add_to_date(expiry, seconds=-get_refresh_margin(lifetime))
+    return None, None, None
+
+
+def set_cached_token(company, service, token, expiry, lifetime):
+    ttl = cint((get_datetime(expiry) - now_datetime()).total_seconds())
+    if ttl > 0:
+        frappe.cache().set_value(
+            get_token_cache_key(company, service),
+            {
+                "token": token,
+                "expiry": cstr(expiry),
+                "refresh_after": cstr(
+                    add_to_date(expiry, seconds=-get_refresh_margin(lifetime))
+                ),
+            },
+            expires_in_sec=ttl,
+        )
+
+
+def save_token(company, service, token, expiry):
+    """Keep the token on Company NHIF Settings for when redis is flushed"""
+    fields = TOKEN_SERVICES[service]
+    frappe.db.set_value(
+        "Company NHIF Settings",
+        company,
+        {fields["token"]: token, fields["expiry"]: expiry},
+        update_modified=False,
+    )
+
+
+def clear_token_cache(company):
+    for service in TOKEN_SERVICES:
+        frappe.cache().delete_value(get_token_cache_key(company, service))
+
+
+def count_token_request(company, service, result):
+    frappe.cache().incr(
+        frappe.cache().make_key("nhif_token_{0}|{1}|{2}".format(result, company, service))
+    )
+
+
+def get_token_cache_stats(company):
+    stats = {}
+    for service in TOKEN_SERVICES:
+        stats[service] = {
+            result: cint(
+                frappe.cache().get(
+                    frappe.cache().make_key(
+                        "nhif_token_{0}|{1}|{2}".format(result, company, service)
+                    )
                 )
-                frappe.throw(json.loads(r.text))
-        
-        except Exception as e:
-            frappe.logger().debug({"webhook_error": e, "try": i + 1})
-            sleep(3 * i + 1)
-            if i != 2:
-                continue
-            else:
-                raise e
+            )
+            for result in ("hit", "miss", "refresh")
+        }
+    return stats
 
 
-def get_nhifservice_token(company):
-    setting_doc = frappe.get_cached_doc("Company NHIF Settings", company)
-    if (
-        setting_doc.nhifservice_expiry
-        and setting_doc.nhifservice_expiry > now_datetime()
-    ):
-        return setting_doc.nhifservice_token
+def acquire_token_lock(company, service):
+    return frappe.cache().set(
+        frappe.cache().make_key(get_token_cache_key(company, service) + "|lock"),
+        frappe.local.site,
+        nx=True,
+        ex=TOKEN_LOCK_TIMEOUT,
+    )
 
+
+def release_token_lock(company, service):
+    frappe.cache().delete(
+        frappe.cache().make_key(get_token_cache_key(company, service) + "|lock")
+    )
+
+
+def refresh_token(company, service):
+    fields = TOKEN_SERVICES[service]
+    setting_doc = frappe.get_cached_doc("Company NHIF Settings", company)
     username = setting_doc.username
     password = get_decrypted_password("Company NHIF Settings", company, "password")
     payload = "grant_type=password&username={0}&password={1}".format(username, password)
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    url = str(setting_doc.nhifservice_url) + "/nhifservice/Token"
+    url = cstr(setting_doc.get(fields["url"])) + fields["path"]
 
-    nhifservice_fields = {
-        "token": "nhifservice_token",
-        "expiry": "nhifservice_expiry",
-    }
+    token, expires_in = make_token_request(url, headers, payload)
+    count_token_request(company, service, "refresh")
+    expiry = add_to_date(now_datetime(), seconds=expires_in)
+    set_cached_token(company, service, token, expiry, expires_in)
+    # stored by a job, the caller's transaction is neither written to nor
+    # committed by a token refresh
+    frappe.enqueue(
+        save_token,
+        queue="short",
+        enqueue_after_commit=True,
+        company=company,
+        service=service,
+        token=token,
+        expiry=expiry,
+    )
+    return token
 
-    return make_token_request(setting_doc, url, headers, payload, nhifservice_fields)
 
+def get_token(company, service):
+    token, expiry, refresh_after = get_cached_token(company, service)
+    now_time = now_datetime()
+    if token and refresh_after > now_time:
+        count_token_request(company, service, "hit")
+        return token
 
-def get_claimsservice_token(company):
-    setting_doc = frappe.get_cached_doc("Company NHIF Settings", company)
-    if (
-        setting_doc.claimsserver_expiry
-        and setting_doc.claimsserver_expiry > now_datetime()
-    ):
-        return setting_doc.claimsserver_token
+    count_token_request(company, service, "miss")
+    if acquire_token_lock(company, service):
+        try:
+            return refresh_token(company, service)
+        except Exception:
+            # still valid token is better than failing the caller
+            if token and expiry > now_datetime():
+                return token
+            raise
+        finally:
+            release_token_lock(company, service)
 
-    username = setting_doc.username
-    password = get_decrypted_password("Company NHIF Settings", company, "password")
-    payload = "grant_type=password&username={0}&password={1}".format(username, password)
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    url = str(setting_doc.claimsserver_url) + "/claimsserver/Token"
+    # another worker is refreshing, keep using the current token while it
+    # is valid, otherwise wait for the new one
+    if token and expiry > now_time:
+        return token
 
+    waited = 0
+    while waited < TOKEN_WAIT_TIMEOUT:
+        sleep(TOKEN_WAIT_INTERVAL)
+        waited += TOKEN_WAIT_INTERVAL
+        token, expiry, refresh_after = get_cached_token(company, service)
+        if token and expiry > now_datetime():
+            return token
+
+    return refresh_token(company, service)
+
+
+def get_nhifservice_token(company):
+    return get_token(company, "nhifservice")
 
-    claimserver_fields = {
-        "token": "claimsserver_token",
-        "expiry": "claimsserver_expiry",
-    }
-    
-    return make_token_request(setting_doc, url, headers, payload, claimserver_fields)
-    
+
+def get_claimsservice_token(company):
+    return get_token(company, "claimsserver")
 
 
 def get_formservice_token(company):
@@ -113,26 +258,5 @@ def get_formservice_token(company):
         frappe.throw(
             _("Company {0} not enabled for NHIF Integration".format(company))
         )
-    
-    if (
-        company_nhif_doc.nhifform_expiry
-        and company_nhif_doc.nhifform_expiry > now_datetime()
-    ):
-        return company_nhif_doc.nhifform_token
-
-    username = company_nhif_doc.username
-    password = get_decrypted_password("Company NHIF Settings", company, "password")
-    payload = "grant_type=password&username={0}&password={1}".format(username, password)
-
-    headers = {
-    'Content-Type': 'application/x-www-form-urlencoded'
-    }
-    url = cstr(company_nhif_doc.nhifform_url) + "/formposting/Token"
-
-    nhifform_fields = {
-        "token": "nhifform_token",
-        "expiry": "nhifform_expiry",
-    }
 
-    return make_token_request(company_nhif_doc, url, headers, payload, nhifform_fields)
-    
\ No newline at end of file
+    return get_token(company, "nhifform")
@@ -19,5 +19,27 @@ frappe.ui.form.on('Company NHIF Settings', {
 			}).then(r => {
 				// do nothing
 			})
+	},
+	refresh_stale_claims: (frm) => {
+		if (!frm.doc.submit_claim_year || !frm.doc.submit_claim_month) {
+			frappe.msgprint("Please set submit claim year or submit claim month");
+			return
+		}
+		frappe.call("hms_tz.nhif.doctype.nhif_patient_claim.nhif_patient_claim.enqueue_refresh_stale_claims", {
+				company: frm.doc.name,
+				claim_year: frm.doc.submit_claim_year,
+				claim_month: frm.doc.submit_claim_month
+			})
+	},
+	prerender_claim_files: (frm) => {
+		if (!frm.doc.submit_claim_year || !frm.doc.submit_claim_month) {
+			frappe.msgprint("Please set submit claim year or submit claim month");
+			return
+		}
+		frappe.call("hms_tz.nhif.doctype.nhif_patient_claim.nhif_patient_claim.enqueue_prerender_claims", {
+				company: frm.doc.name,
+				claim_year: frm.doc.submit_claim_year,
+				claim_month: frm.doc.submit_claim_month
+			})
 	}
 });
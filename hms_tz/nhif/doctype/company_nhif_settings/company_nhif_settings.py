@@ -5,6 +5,9 @@
 from __future__ import unicode_literals
 # import frappe
 from frappe.model.document import Document
+from hms_tz.nhif.api.token import clear_token_cache
 
 class CompanyNHIFSettings(Document):
-	pass
+	def on_update(self):
+		# credentials or urls may have changed, fetch fresh tokens
+		clear_token_cache(self.name)
@@ -2,7 +2,17 @@
 // For license information, please see license.txt
 
 frappe.ui.form.on('Lab Machine Message', {
-	// refresh: function(frm) {
-
-	// }
+	refresh: function (frm) {
+		if (['Unmatched', 'Failed'].includes(frm.doc.status)) {
+			frm.add_custom_button(__('Reprocess'), function () {
+				frappe.call({
+					method: 'hms_tz.nhif.doctype.lab_machine_message.lab_machine_message.reprocess',
+					args: { names: [frm.doc.name] },
+					callback: function () {
+						frm.reload_doc();
+					}
+				});
+			});
+		}
+	}
 });
@@ -4,58 +4,253 @@
 
 from __future__ import unicode_literals
 import frappe
+from frappe import _
 from frappe.model.document import Document
+from frappe.utils import cint, flt
+from time import perf_counter
+
+
+# Messages are stored as Queued and applied to their Lab Test by a
+# background job, all queued messages of one Lab Test in a single save.
+# Messages that cannot be matched stay as Unmatched until reprocessed.
+PROCESS_BATCH_SIZE = 100
+PROCESS_SCHEDULED_KEY = "lab_machine_message_process_scheduled"
+# seconds a scheduled run covers before a new message schedules another
+PROCESS_INTERVAL = 30
+METRICS_KEY = "lab_machine_message_metrics"
 
 
 class LabMachineMessage(Document):
     def validate(self):
         self.set_missing_fields()
-        self.update_lab_test()
 
     def after_insert(self):
-        self.update_lab_test()
+        schedule_processing()
 
     def set_missing_fields(self):
         if not self.message:
             return
-        msg_lines = self.message.splitlines()
-        self.machine_make = msg_lines[0].split('|')[2]
-        self.machine_model = msg_lines[0].split('|')[3]
-        self.lab_test_name = msg_lines[3].split('|')[3]
+        segments = parse_hl7_message(self.message)
+        self.machine_make = get_hl7_field(segments, 0, 2) or self.machine_make
+        self.machine_model = get_hl7_field(segments, 0, 3) or self.machine_model
+        self.lab_test_name = get_hl7_field(segments, 3, 3) or self.lab_test_name
 
-    def update_lab_test(self):
-        if not self.message:
-            return
-        if not self.machine_model or not self.machine_make or not self.lab_test_name:
-            return
 
-        profile_name = self.machine_model + "-" + self.machine_make
-        profile_exists = frappe.db.exists("Lab Machine Profile", profile_name)
-        if not profile_exists:
-            return
-        profile = frappe.get_doc("Lab Machine Profile", profile_name)
+def parse_hl7_message(message):
+    """Split the message once into segments (lines) of fields"""
+    return [line.split("|") for line in (message or "").splitlines()]
 
-        lab_test_name = profile.lab_test_prefix + self.lab_test_name
-        lab_test_exists = frappe.db.exists("Lab Test", lab_test_name)
-        if not lab_test_exists:
-            return
 
-        lab_test = frappe.get_doc("Lab Test", lab_test_name)
-        if lab_test.docstatus != 0:
-            return
+def get_hl7_field(segments, segment, field):
+    try:
+        return segments[segment][field]
+    except IndexError:
+        return None
+
+
+def get_machine_profile(machine_model, machine_make):
+    try:
+        return frappe.get_cached_doc(
+            "Lab Machine Profile", machine_model + "-" + machine_make
+        )
+    except frappe.DoesNotExistError:
+        frappe.clear_messages()
+        return None
+
+
+def get_obx_results(segments, profile):
+    """(test name, result) of the OBX lines the profile points at"""
+    results = []
+    for fields in segments[profile.obx_nm_start : profile.obx_nm_end]:
+        try:
+            test_name = fields[3].split("^")[1].replace("*", "")
+            results.append((test_name, fields[5]))
+        except IndexError:
+            continue
+    return results
+
+
+def schedule_processing():
+    if frappe.cache().set(
+        frappe.cache().make_key(PROCESS_SCHEDULED_KEY),
+        1,
+        nx=True,
+        ex=PROCESS_INTERVAL,
+    ):
+        frappe.enqueue(
+            "hms_tz.nhif.doctype.lab_machine_message.lab_machine_message.process_queued_messages",
+            queue="short",
+            enqueue_after_commit=True,
+        )
+
+
+def process_queued_messages():
+    """Apply the queued messages to their Lab Tests, also run by the
+    scheduler to pick up messages a failed run left behind"""
+    frappe.cache().delete(frappe.cache().make_key(PROCESS_SCHEDULED_KEY))
+    while True:
+        messages = frappe.get_all(
+            "Lab Machine Message",
+            filters={"status": "Queued"},
+            fields=["name", "message", "machine_make", "machine_model", "lab_test_name"],
+            order_by="creation",
+            page_length=PROCESS_BATCH_SIZE,
+        )
+        if not messages:
+            break
+        process_messages(messages)
+        if len(messages) < PROCESS_BATCH_SIZE:
+            break
+
 
-        msg_lines = self.message.splitlines()
-        for line in msg_lines[profile.obx_nm_start:profile.obx_nm_end]:
-            test_name = line.split('|')[3].split('^')[1].replace("*", "")
-            test_result = line.split('|')[5]
-            lab_test_row = ""
-            for row in lab_test.normal_test_items:
-                if row.lab_test_name == test_name:
-                    lab_test_row = row
-                    break
-            if lab_test_row:
-                lab_test_row.result_value = test_result
-
-        self.lab_test = lab_test_name
+def process_messages(messages):
+    start_time = perf_counter()
+    stats = {"messages": len(messages), "Processed": 0, "Unmatched": 0, "Failed": 0}
+
+    # group the burst by Lab Test, keeping the arrival order per test
+    lab_tests = {}
+    for message in messages:
+        profile = None
+        if message.machine_model and message.machine_make and message.lab_test_name:
+            profile = get_machine_profile(message.machine_model, message.machine_make)
+        if not profile:
+            set_message_status(
+                [message.name], "Unmatched", error=_("No Lab Machine Profile for the message")
+            )
+            stats["Unmatched"] += 1
+            continue
+        lab_test_name = (profile.lab_test_prefix or "") + message.lab_test_name
+        lab_tests.setdefault(lab_test_name, []).append((message, profile))
+
+    for lab_test_name, lab_test_messages in lab_tests.items():
+        names = [message.name for message, profile in lab_test_messages]
+        try:
+            statuses = apply_messages_to_lab_test(lab_test_name, lab_test_messages)
+            for name, (status, error) in statuses.items():
+                set_message_status([name], status, lab_test_name, error)
+            frappe.db.commit()
+            for status, error in statuses.values():
+                stats[status] += 1
+        except Exception:
+            frappe.db.rollback()
+            set_message_status(names, "Failed", lab_test_name, frappe.get_traceback())
+            frappe.db.commit()
+            stats["Failed"] += len(names)
+
+    frappe.db.commit()
+    record_metrics(stats, perf_counter() - start_time)
+
+
+def apply_messages_to_lab_test(lab_test_name, lab_test_messages):
+    """Apply the messages to the Lab Test, saving it once, and return the
+    (status, error) of every message"""
+    names = [message.name for message, profile in lab_test_messages]
+    if not frappe.db.exists("Lab Test", lab_test_name):
+        error = _("Lab Test {0} not found").format(lab_test_name)
+        return {name: ("Unmatched", error) for name in names}
+
+    lab_test = frappe.get_doc("Lab Test", lab_test_name)
+    if lab_test.docstatus != 0:
+        error = _("Lab Test {0} is not in draft").format(lab_test_name)
+        return {name: ("Unmatched", error) for name in names}
+
+    rows = {}
+    for row in lab_test.normal_test_items:
+        # the first row wins for repeated names
+        rows.setdefault(row.lab_test_name, row)
+
+    statuses = {}
+    for message, profile in lab_test_messages:
+        matched = 0
+        for test_name, test_result in get_obx_results(
+            parse_hl7_message(message.message), profile
+        ):
+            row = rows.get(test_name)
+            if row:
+                row.result_value = test_result
+                matched += 1
+        if matched:
+            statuses[message.name] = ("Processed", None)
+        else:
+            statuses[message.name] = (
+                "Unmatched",
+                _("No result of the message matches Lab Test {0}").format(lab_test_name),
+            )
+
+    if any(status == "Processed" for status, error in statuses.values()):
         lab_test.save(ignore_permissions=True)
-        frappe.db.commit()
+    return statuses
+
+
+def set_message_status(names, status, lab_test=None, error=None):
+    values = {"status": status, "error": error, "names": names}
+    lab_test_update = ""
+    if lab_test and frappe.db.exists("Lab Test", lab_test):
+        lab_test_update = ", lab_test = %(lab_test)s"
+        values["lab_test"] = lab_test
+    frappe.db.sql(
+        """
+        UPDATE `tabLab Machine Message`
+        SET status = %(status)s, error = %(error)s{0}
+        WHERE name IN %(names)s
+    """.format(
+            lab_test_update
+        ),
+        values,
+    )
+
+
+def record_metrics(stats, duration):
+    try:
+        key = frappe.cache().make_key(METRICS_KEY)
+        pipe = frappe.cache().pipeline()
+        for field, count in stats.items():
+            pipe.hincrby(key, field, count)
+        pipe.hincrby(key, "runs", 1)
+        pipe.hincrbyfloat(key, "seconds", duration)
+        pipe.execute()
+    except Exception:
+        frappe.logger().debug({"lab_machine_message_metrics_error": stats})
+
+
+@frappe.whitelist()
+def get_metrics():
+    frappe.only_for("System Manager")
+    # raw redis read, the cache wrapper would re-prefix the key and unpickle
+    pipe = frappe.cache().pipeline()
+    pipe.hgetall(frappe.cache().make_key(METRICS_KEY))
+    data = {
+        frappe.safe_decode(k): frappe.safe_decode(v)
+        for k, v in (pipe.execute()[0] or {}).items()
+    }
+    messages = cint(data.get("messages"))
+    seconds = flt(data.get("seconds"))
+    return {
+        "messages": messages,
+        "processed": cint(data.get("Processed")),
+        "unmatched": cint(data.get("Unmatched")),
+        "failed": cint(data.get("Failed")),
+        "runs": cint(data.get("runs")),
+        "messages_per_second": messages / seconds if seconds else 0,
+        "dead_letter": frappe.db.count(
+            "Lab Machine Message", {"status": ["in", ["Unmatched", "Failed"]]}
+        ),
+    }
+
+
+@frappe.whitelist()
+def reprocess(names):
+    """Queue Unmatched or Failed messages again, e.g. once the Lab Test or
+    machine profile they were missing exists"""
+    frappe.has_permission("Lab Machine Message", "write", throw=True)
+    names = frappe.parse_json(names)
+    if isinstance(names, str):
+        names = [names]
+    frappe.db.sql(
+        """
+        UPDATE `tabLab Machine Message` SET status = 'Queued', error = NULL
+        WHERE name IN %(names)s AND status IN ('Unmatched', 'Failed')
+    """,
+        {"names": names},
+    )
+    schedule_processing()
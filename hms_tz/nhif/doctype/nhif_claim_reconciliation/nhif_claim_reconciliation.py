@@ -3,11 +3,11 @@
 
 import frappe
 import json
-import requests
 from frappe.utils import nowdate, flt
 from frappe.model.document import Document
 from hms_tz.nhif.api.token import get_claimsservice_token
 from hms_tz.nhif.doctype.nhif_response_log.nhif_response_log import add_log
+from hms_tz.nhif.api.nhif_client import nhif_request, LONG_READ_TIMEOUT
 
 class NHIFClaimReconciliation(Document):
 	def validate(self):
@@ -54,7 +54,9 @@ def get_submitted_claims(self):
 
 def make_request(url, headers, payload):
 	try:
-		response = requests.get(url, headers=headers)
+		response = nhif_request(
+			"GET", url, "GetSubmittedClaims", read_timeout=LONG_READ_TIMEOUT, headers=headers
+		)
 		if response.status_code == 200:
 			data = json.loads(response.text)
 			add_log(
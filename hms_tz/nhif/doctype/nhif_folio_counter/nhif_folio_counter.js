@@ -2,7 +2,36 @@
 // For license information, please see license.txt
 
 frappe.ui.form.on('NHIF Folio Counter', {
-	// refresh: function(frm) {
-
-	// }
+	refresh: function(frm) {
+		if (frm.doc.__islocal) {
+			return;
+		}
+		frm.add_custom_button(__("Check Folio Numbers"), function () {
+			frappe.call({
+				method: "hms_tz.nhif.doctype.nhif_folio_counter.nhif_folio_counter.check_folio_numbers",
+				args: {
+					company: frm.doc.company,
+					claim_year: frm.doc.claim_year,
+					claim_month: frm.doc.claim_month
+				},
+				callback: function (r) {
+					if (!r.message) {
+						return;
+					}
+					let data = r.message;
+					let duplicates = data.duplicates.map(d => `${d.folio_no}: ${d.claims}`);
+					frappe.msgprint({
+						title: __("Folio Numbers"),
+						indicator: (data.gaps.length || duplicates.length) ? "orange" : "green",
+						message: `
+							<p>${__("Counter")}: <b>${data.counter_folio_no}</b>, ${__("Claims")}: <b>${data.claims}</b></p>
+							<p>${__("Gaps")}: ${data.gaps.join(", ") || __("None")}</p>
+							<p>${__("Duplicates")}: ${duplicates.join("<br>") || __("None")}</p>
+							<p>${__("Ahead of Counter")}: ${data.ahead_of_counter.join(", ") || __("None")}</p>
+						`
+					});
+				}
+			});
+		});
+	}
 });
@@ -1,8 +1,99 @@
 # Copyright (c) 2022, Aakvatech and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
+from frappe.utils import cint, now_datetime
+
 
 class NHIFFolioCounter(Document):
 	pass
+
+
+def on_doctype_update():
+	# one counter per month, allocate_folio_numbers relies on it
+	frappe.db.add_unique(
+		"NHIF Folio Counter",
+		["company", "claim_year", "claim_month"],
+		constraint_name="company_claim_month_unique",
+	)
+
+
+def allocate_folio_numbers(company, claim_year, claim_month, count=1):
+	"""Reserve `count` consecutive folio numbers of the month and return the
+	first one. The counter row is created or advanced in a single statement
+	and stays locked until the caller's transaction ends, so concurrent
+	claims never get the same number"""
+	now = now_datetime()
+	# LAST_INSERT_ID(expr) hands the new folio_no back to this connection,
+	# both when the month's counter is created and when it is advanced
+	frappe.db.sql(
+		"""
+		INSERT INTO `tabNHIF Folio Counter`
+			(name, creation, modified, modified_by, owner, docstatus, idx,
+			company, claim_year, claim_month, folio_no, posting_date)
+		VALUES
+			(%(name)s, %(now)s, %(now)s, %(user)s, %(user)s, 0, 0,
+			%(company)s, %(claim_year)s, %(claim_month)s, LAST_INSERT_ID(%(count)s), %(now)s)
+		ON DUPLICATE KEY UPDATE
+			folio_no = LAST_INSERT_ID(folio_no + %(count)s),
+			posting_date = %(now)s,
+			modified = %(now)s
+	""",
+		{
+			"name": frappe.generate_hash(length=10),
+			"now": now,
+			"user": frappe.session.user,
+			"company": company,
+			"claim_year": cint(claim_year),
+			"claim_month": cint(claim_month),
+			"count": cint(count),
+		},
+	)
+	last_folio_no = cint(frappe.db.sql("SELECT LAST_INSERT_ID()")[0][0])
+	return last_folio_no - cint(count) + 1
+
+
+def reserve_folio_numbers(company, claim_year, claim_month, count):
+	"""Folio numbers for a batch of claims, taken from the counter at once.
+	Pass one to each claim as `flags.folio_no` before inserting it"""
+	first_folio_no = allocate_folio_numbers(company, claim_year, claim_month, count)
+	return list(range(first_folio_no, first_folio_no + cint(count)))
+
+
+@frappe.whitelist()
+def check_folio_numbers(company, claim_year, claim_month):
+	"""Gaps and duplicates among the folio numbers of the month's claims"""
+	frappe.has_permission("NHIF Patient Claim", "read", throw=True)
+	claims = frappe.db.sql(
+		"""
+		SELECT folio_no, GROUP_CONCAT(name ORDER BY name SEPARATOR ', ') AS claims,
+			COUNT(*) AS count
+		FROM `tabNHIF Patient Claim`
+		WHERE company = %s AND claim_year = %s AND claim_month = %s
+		AND IFNULL(folio_no, 0) > 0
+		GROUP BY folio_no
+	""",
+		(company, cint(claim_year), cint(claim_month)),
+		as_dict=True,
+	)
+	used = {cint(row.folio_no) for row in claims}
+	counter_folio_no = cint(
+		frappe.db.get_value(
+			"NHIF Folio Counter",
+			{"company": company, "claim_year": cint(claim_year), "claim_month": cint(claim_month)},
+			"max(folio_no)",
+		)
+	)
+	last_folio_no = max(used | {counter_folio_no}) if used else counter_folio_no
+	return {
+		"counter_folio_no": counter_folio_no,
+		"claims": sum(cint(row.count) for row in claims),
+		"duplicates": [
+			{"folio_no": row.folio_no, "claims": row.claims}
+			for row in claims
+			if cint(row.count) > 1
+		],
+		"gaps": [folio_no for folio_no in range(1, last_folio_no + 1) if folio_no not in used],
+		"ahead_of_counter": [folio_no for folio_no in sorted(used) if folio_no > counter_folio_no],
+	}
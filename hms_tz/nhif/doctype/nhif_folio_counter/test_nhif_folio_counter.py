@@ -1,8 +1,55 @@
 # Copyright (c) 2022, Aakvatech and Contributors
 # See license.txt
 
-# import frappe
+import frappe
 import unittest
+from hms_tz.nhif.doctype.nhif_folio_counter.nhif_folio_counter import (
+	allocate_folio_numbers,
+	reserve_folio_numbers,
+)
+
+TEST_COMPANY = "_Test Folio Counter Company"
+
 
 class TestNHIFFolioCounter(unittest.TestCase):
-	pass
+	def setUp(self):
+		frappe.db.sql("DELETE FROM `tabNHIF Folio Counter` WHERE company = %s", TEST_COMPANY)
+
+	def tearDown(self):
+		frappe.db.rollback()
+
+	def test_allocate_consecutive_numbers(self):
+		self.assertEqual(allocate_folio_numbers(TEST_COMPANY, 2022, 11), 1)
+		self.assertEqual(allocate_folio_numbers(TEST_COMPANY, 2022, 11), 2)
+		self.assertEqual(allocate_folio_numbers(TEST_COMPANY, 2022, 11), 3)
+		self.assertEqual(get_counter_folio_no(2022, 11), 3)
+
+	def test_reserve_batch(self):
+		allocate_folio_numbers(TEST_COMPANY, 2022, 11)
+		self.assertEqual(reserve_folio_numbers(TEST_COMPANY, 2022, 11, 3), [2, 3, 4])
+		self.assertEqual(allocate_folio_numbers(TEST_COMPANY, 2022, 11), 5)
+
+	def test_months_are_counted_apart(self):
+		allocate_folio_numbers(TEST_COMPANY, 2022, 11, 5)
+		self.assertEqual(allocate_folio_numbers(TEST_COMPANY, 2022, 12), 1)
+		self.assertEqual(allocate_folio_numbers(TEST_COMPANY, 2023, 11), 1)
+		self.assertEqual(allocate_folio_numbers(TEST_COMPANY, 2022, 11), 6)
+
+	def test_one_counter_per_month(self):
+		for i in range(3):
+			allocate_folio_numbers(TEST_COMPANY, 2022, 11)
+		self.assertEqual(
+			frappe.db.count(
+				"NHIF Folio Counter",
+				{"company": TEST_COMPANY, "claim_year": 2022, "claim_month": 11},
+			),
+			1,
+		)
+
+
+def get_counter_folio_no(claim_year, claim_month):
+	return frappe.db.get_value(
+		"NHIF Folio Counter",
+		{"company": TEST_COMPANY, "claim_year": claim_year, "claim_month": claim_month},
+		"folio_no",
+	)
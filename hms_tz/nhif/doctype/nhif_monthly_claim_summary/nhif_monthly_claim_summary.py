@@ -0,0 +1,193 @@
+# Copyright (c) 2026, Aakvatech and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import flt
+
+# Submitted NHIF Patient Claims rolled up per company and claim month, kept
+# current by claim submit and cancel and read by the Monthly NHIF Summary.
+CATEGORY_FIELDS = [
+    "consultation",
+    "diagnostic_examination",
+    "surgical_produceral_charge",
+    "medicine",
+    "inpatient_charges",
+]
+SUMMARY_FIELDS = ["male", "female", "amount_claimed"] + CATEGORY_FIELDS
+
+CATEGORY_SQL = """
+    SUM(CASE WHEN i.ref_doctype = 'Patient Appointment' THEN i.amount_claimed ELSE 0 END) AS consultation,
+    SUM(CASE WHEN i.ref_doctype IN ('Lab Prescription', 'Radiology Procedure Prescription')
+        THEN i.amount_claimed ELSE 0 END) AS diagnostic_examination,
+    SUM(CASE WHEN i.ref_doctype IN ('Procedure Prescription', 'Therapy Plan Detail')
+        THEN i.amount_claimed ELSE 0 END) AS surgical_produceral_charge,
+    SUM(CASE WHEN i.ref_doctype = 'Drug Prescription' THEN i.amount_claimed ELSE 0 END) AS medicine,
+    SUM(CASE WHEN IFNULL(i.ref_doctype, '') NOT IN ('Patient Appointment', 'Drug Prescription',
+        'Lab Prescription', 'Radiology Procedure Prescription', 'Procedure Prescription',
+        'Therapy Plan Detail') THEN i.amount_claimed ELSE 0 END) AS inpatient_charges
+"""
+
+
+class NHIFMonthlyClaimSummary(Document):
+    pass
+
+
+def get_summary_name(company, claim_year, claim_month):
+    return "{0}-{1}-{2}".format(company, claim_year, claim_month)
+
+
+def get_category(ref_doctype):
+    if ref_doctype == "Patient Appointment":
+        return "consultation"
+    elif ref_doctype == "Drug Prescription":
+        return "medicine"
+    elif ref_doctype in ("Lab Prescription", "Radiology Procedure Prescription"):
+        return "diagnostic_examination"
+    elif ref_doctype in ("Procedure Prescription", "Therapy Plan Detail"):
+        return "surgical_produceral_charge"
+    return "inpatient_charges"
+
+
+def get_claim_summaries(company, periods):
+    """Aggregate the submitted claims of `company` for the (year, month)
+    `periods` in SQL, {(year, month): summary}"""
+    conditions = " OR ".join(
+        ["(c.claim_year = %s AND c.claim_month = %s)"] * len(periods)
+    )
+    values = [company] + [value for period in periods for value in period]
+
+    summaries = {}
+    for row in frappe.db.sql(
+        """
+        SELECT c.claim_year, c.claim_month, MAX(c.facility_code) AS facility_code,
+            SUM(IFNULL(c.gender, '') = 'Male') AS male,
+            SUM(IFNULL(c.gender, '') != 'Male') AS female
+        FROM `tabNHIF Patient Claim` c
+        WHERE c.docstatus = 1 AND c.company = %s AND ({0})
+        GROUP BY c.claim_year, c.claim_month
+    """.format(
+            conditions
+        ),
+        values,
+        as_dict=1,
+    ):
+        summaries[(row.claim_year, row.claim_month)] = row
+
+    for row in frappe.db.sql(
+        """
+        SELECT c.claim_year, c.claim_month, {0}
+        FROM `tabNHIF Patient Claim Item` i
+        INNER JOIN `tabNHIF Patient Claim` c ON c.name = i.parent
+        WHERE i.parenttype = 'NHIF Patient Claim'
+        AND c.docstatus = 1 AND c.company = %s AND ({1})
+        GROUP BY c.claim_year, c.claim_month
+    """.format(
+            CATEGORY_SQL, conditions
+        ),
+        values,
+        as_dict=1,
+    ):
+        summary = summaries.get((row.claim_year, row.claim_month))
+        if summary:
+            summary.update({field: flt(row.get(field)) for field in CATEGORY_FIELDS})
+
+    for summary in summaries.values():
+        for field in CATEGORY_FIELDS:
+            summary[field] = flt(summary.get(field))
+        summary.amount_claimed = sum(summary[field] for field in CATEGORY_FIELDS)
+    return summaries
+
+
+def update_claim_summary(doc, sign):
+    """Add (sign=1) or remove (sign=-1) a claim from its month's rollup"""
+    amounts = dict.fromkeys(CATEGORY_FIELDS, 0)
+    for item in doc.nhif_patient_claim_item:
+        amounts[get_category(item.ref_doctype)] += flt(item.amount_claimed)
+
+    delta = dict(amounts)
+    delta["amount_claimed"] = sum(amounts.values())
+    delta["male"] = 1 if doc.gender == "Male" else 0
+    delta["female"] = 0 if doc.gender == "Male" else 1
+
+    time_stamp = frappe.utils.now()
+    columns = [
+        "name",
+        "creation",
+        "modified",
+        "owner",
+        "modified_by",
+        "company",
+        "facility_code",
+        "claim_year",
+        "claim_month",
+    ] + SUMMARY_FIELDS
+    values = [
+        get_summary_name(doc.company, doc.claim_year, doc.claim_month),
+        time_stamp,
+        time_stamp,
+        frappe.session.user,
+        frappe.session.user,
+        doc.company,
+        doc.facility_code,
+        doc.claim_year,
+        doc.claim_month,
+    ] + [sign * delta[field] for field in SUMMARY_FIELDS]
+
+    frappe.db.sql(
+        """
+        INSERT INTO `tabNHIF Monthly Claim Summary` ({0}) VALUES ({1})
+        ON DUPLICATE KEY UPDATE modified = VALUES(modified), {2}
+    """.format(
+            ", ".join("`{0}`".format(column) for column in columns),
+            ", ".join(["%s"] * len(columns)),
+            ", ".join(
+                "`{0}` = `{0}` + VALUES(`{0}`)".format(field) for field in SUMMARY_FIELDS
+            ),
+        ),
+        values,
+    )
+
+
+@frappe.whitelist()
+def rebuild_claim_summaries(company, claim_year=None, claim_month=None):
+    """Recompute the rollup rows of `company` from the claims, for one month
+    or for every month with submitted claims"""
+    frappe.only_for("System Manager")
+    build_claim_summaries(company, claim_year, claim_month)
+
+
+def build_claim_summaries(company, claim_year=None, claim_month=None):
+    filters = {"company": company, "docstatus": 1}
+    if claim_year and claim_month:
+        filters.update({"claim_year": claim_year, "claim_month": claim_month})
+    periods = frappe.get_all(
+        "NHIF Patient Claim",
+        filters=filters,
+        fields=["claim_year", "claim_month"],
+        group_by="claim_year, claim_month",
+    )
+    if claim_year and claim_month:
+        frappe.db.delete(
+            "NHIF Monthly Claim Summary",
+            {"company": company, "claim_year": claim_year, "claim_month": claim_month},
+        )
+    else:
+        frappe.db.delete("NHIF Monthly Claim Summary", {"company": company})
+    if not periods:
+        return
+
+    summaries = get_claim_summaries(
+        company, [(p.claim_year, p.claim_month) for p in periods]
+    )
+    for (claim_year, claim_month), summary in summaries.items():
+        doc = frappe.get_doc(
+            dict(
+                summary,
+                doctype="NHIF Monthly Claim Summary",
+                company=company,
+                claim_year=claim_year,
+                claim_month=claim_month,
+            )
+        )
+        doc.insert(ignore_permissions=True)
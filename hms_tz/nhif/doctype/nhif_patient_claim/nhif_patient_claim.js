@@ -25,6 +25,14 @@ frappe.ui.form.on('NHIF Patient Claim', {
 				});
 			});
 		}
+		if (frm.doc.docstatus === 0 && !frm.doc.__islocal && !frm.doc.allow_changes) {
+			frm.add_custom_button(__("Rebuild Claim"), function () {
+				frm.call('rebuild_claim')
+				.then(r => {
+					frm.reload_doc()
+				});
+			});
+		}
 	},
 
 	onload: function(frm) {
@@ -7,9 +7,10 @@ import frappe
 from frappe import _
 from frappe.model.document import Document
 import uuid
+import hashlib
 from hms_tz.nhif.api.token import get_claimsservice_token
 import json
-import requests
+from hms_tz.nhif.api.nhif_client import nhif_request, LONG_READ_TIMEOUT
 from frappe.utils.background_jobs import enqueue
 from frappe.utils import (
     getdate,
@@ -17,20 +18,52 @@ from frappe.utils import (
     nowdate,
     get_datetime,
     time_diff_in_seconds,
-    now_datetime,
     cint
 )
 from hms_tz.nhif.doctype.nhif_response_log.nhif_response_log import add_log
+from hms_tz.nhif.doctype.nhif_monthly_claim_summary.nhif_monthly_claim_summary import (
+    update_claim_summary,
+)
+from hms_tz.nhif.doctype.nhif_folio_counter.nhif_folio_counter import (
+    allocate_folio_numbers,
+)
 from hms_tz.nhif.api.healthcare_utils import (
     get_item_rate,
     to_base64,
-    get_approval_number_from_LRPMT,
 )
-import os
+import io
+import base64
 from frappe.utils.pdf import get_pdf
 from PyPDF2 import PdfFileWriter
 import html2text
 
+# prescription tables whose linked documents carry the approval numbers
+CLAIM_REFERENCED_DOCS = (
+    ("Lab Prescription", "lab_test", "Lab Test"),
+    ("Radiology Procedure Prescription", "radiology_examination", "Radiology Examination"),
+    ("Procedure Prescription", "clinical_procedure", "Clinical Procedure"),
+    ("Drug Prescription", "dn_detail", "Delivery Note Item"),
+)
+
+# claim print renders are reused while the claim content hashes the same
+CLAIM_PDF_IGNORED_FIELDS = {
+    "name",
+    "parent",
+    "creation",
+    "modified",
+    "modified_by",
+    "owner",
+    "docstatus",
+    "source_fingerprint",
+    "claim_pdf_file",
+    "claim_pdf_hash",
+    "_comments",
+    "_assign",
+    "_liked_by",
+    "_user_tags",
+    "_seen",
+}
+
 
 class NHIFPatientClaim(Document):
     def validate(self):
@@ -89,6 +122,16 @@ class NHIFPatientClaim(Document):
             "Total time to complete the process in seconds = " + str(time_in_seconds)
         )
     
+    def on_update(self):
+        if self.docstatus == 0 and self.get("is_ready_for_auto_submission"):
+            enqueue_claim_pdf(self.name)
+
+    def on_submit(self):
+        update_claim_summary(self, 1)
+
+    def on_cancel(self):
+        update_claim_summary(self, -1)
+
     def validate_multiple_appointments_per_authorization_no(self):
         """Validate if patient gets multiple appointments with same authorization number"""
 
@@ -216,8 +259,69 @@ class NHIFPatientClaim(Document):
             self.claim_month = int(self.attendance_date.strftime("%m"))
         self.patient_file_no = self.get_patient_file_no()
         if not self.allow_changes:
+            self.rebuild_claim_if_stale()
+
+    def rebuild_claim_if_stale(self):
+        # rebuild the diseases and items only when what they are built
+        # from has changed, keeping the folio item ids of unchanged claims
+        if (
+            self.flags.rebuild_claim
+            or self.get_source_fingerprint() != self.source_fingerprint
+            or not self.nhif_patient_claim_item
+            or self.has_value_changed("allow_changes")
+        ):
             self.set_patient_claim_disease()
             self.set_patient_claim_item()
+            # the fingerprint covers the ref codes of the claimed items,
+            # so take it again from the rebuilt items
+            self.source_fingerprint = self.get_source_fingerprint()
+
+    def get_source_fingerprint(self):
+        """Hash of the encounters, appointments and inpatient record the
+        claim is built from, including the rows of their child tables, the
+        LRPMT documents holding the approval numbers and the NHIF ref codes
+        and Item Prices of the claimed items"""
+        encounters = [encounter.name for encounter in self.patient_encounters]
+        if not self.hms_tz_claim_appointment_list:
+            appointments = [self.patient_appointment]
+        else:
+            appointments = json.loads(self.hms_tz_claim_appointment_list)
+
+        sources = [
+            frappe.get_all(
+                "Patient Encounter",
+                filters={"name": ["in", encounters]},
+                fields=["name", "modified"],
+                order_by="name",
+                as_list=True,
+            ),
+            get_child_rows_state("Patient Encounter", encounters),
+            get_referenced_docs_state(encounters),
+            get_claim_items_state([item.item_code for item in self.nhif_patient_claim_item]),
+            frappe.get_all(
+                "Patient Appointment",
+                filters={"name": ["in", appointments]},
+                fields=["name", "modified"],
+                order_by="name",
+                as_list=True,
+            ),
+        ]
+        inpatient_record = self.final_patient_encounter.inpatient_record
+        if inpatient_record:
+            sources += [
+                frappe.db.get_value("Inpatient Record", inpatient_record, "modified"),
+                get_child_rows_state("Inpatient Record", [inpatient_record]),
+            ]
+        return hashlib.md5(json.dumps(sources, default=str).encode()).hexdigest()
+
+    @frappe.whitelist()
+    def rebuild_claim(self):
+        """Rebuild the diseases and items even if their sources are unchanged,
+        e.g. after NHIF ref codes or prices were corrected"""
+        if self.allow_changes:
+            frappe.throw(_("Untick Allow Changes to rebuild the claim"))
+        self.flags.rebuild_claim = True
+        self.save()
 
     @frappe.whitelist()
     def get_appointments(self):
@@ -392,55 +496,40 @@ class NHIFPatientClaim(Document):
         final_patient_encounter = self.final_patient_encounter
         inpatient_record = final_patient_encounter.inpatient_record
         # is_inpatient = True if inpatient_record else False
+
+        # the claim lines are collected as dicts first, so the item ref codes,
+        # approval numbers and user names of all of them are read in bulk
+        encounter_rows = get_encounter_claim_rows(
+            childs_map, [encounter.name for encounter in self.patient_encounters]
+        )
+        item_rates = {}
+        claim_items = []
         if not inpatient_record:
             for encounter in self.patient_encounters:
-                encounter_doc = frappe.get_doc("Patient Encounter", encounter.name)
-                for child in childs_map:
-                    for row in encounter_doc.get(child.get("table")):
-                        if row.prescribe or row.is_cancelled:
-                            continue
-                        item_code = frappe.get_value(
-                            child.get("doctype"), row.get(child.get("item")), "item"
-                        )
-
-                        delivered_quantity = (row.get("quantity") or 0) - (
-                            row.get("quantity_returned") or 0
-                        )
-
-                        new_row = self.append("nhif_patient_claim_item", {})
-                        new_row.item_name = row.get(child.get("item_name"))
-                        new_row.item_code = get_item_refcode(item_code)
-                        new_row.item_quantity = delivered_quantity or 1
-                        new_row.unit_price = row.get("amount")
-                        new_row.amount_claimed = (
-                            new_row.unit_price * new_row.item_quantity
+                for child, row in encounter_rows.get(encounter.name, []):
+                    claim_items.append(
+                        get_prescription_claim_item(
+                            child, row, encounter.name, row.get(child.get("item_name"))
                         )
-                        new_row.approval_ref_no = get_approval_number_from_LRPMT(
-                            child["ref_doctype"], row.get(child["ref_docname"])
-                        )
-
-                        if child["doctype"] == "Therapy Type" or row.get(
-                            child["ref_docname"]
-                        ):
-                            new_row.status = "Submitted"
-                        else:
-                            new_row.status = "Draft"
-
-                        new_row.patient_encounter = encounter.name
-                        new_row.ref_doctype = row.doctype
-                        new_row.ref_docname = row.name
-                        new_row.folio_item_id = str(uuid.uuid1())
-                        new_row.folio_id = self.folio_id
-                        new_row.date_created = row.modified.strftime("%Y-%m-%d")
-                        new_row.item_crt_by = get_fullname(row.modified_by)
+                    )
         else:
             dates = []
             occupancy_list = []
             record_doc = frappe.get_doc("Inpatient Record", inpatient_record)
 
-            admission_encounter_doc = frappe.get_doc(
-                "Patient Encounter", record_doc.admission_encounter
+            admission_encounter = frappe.db.get_value(
+                "Patient Encounter",
+                record_doc.admission_encounter,
+                ["name", "insurance_subscription", "insurance_company"],
+                as_dict=True,
             )
+            if not admission_encounter:
+                frappe.throw(
+                    _("Admission Encounter {0} of Inpatient Record {1} not found").format(
+                        record_doc.admission_encounter, inpatient_record
+                    ),
+                    frappe.DoesNotExistError,
+                )
             for occupancy in record_doc.inpatient_occupancies:
                 if not occupancy.is_confirmed:
                     continue
@@ -476,26 +565,26 @@ class NHIFPatientClaim(Document):
                     dates.append(checkin_date)
                     occupancy_list.append(occupancy)
 
-                item_rate = get_item_rate(
+                item_rate = self.get_claim_item_rate(
+                    item_rates,
                     item_code,
-                    self.company,
-                    admission_encounter_doc.insurance_subscription,
-                    admission_encounter_doc.insurance_company,
+                    admission_encounter.insurance_subscription,
+                    admission_encounter.insurance_company,
+                )
+                claim_items.append(
+                    {
+                        "item_name": occupancy.service_unit,
+                        "item": item_code,
+                        "item_quantity": 1,
+                        "unit_price": item_rate,
+                        "amount_claimed": item_rate,
+                        "patient_encounter": admission_encounter.name,
+                        "ref_doctype": occupancy.doctype,
+                        "ref_docname": occupancy.name,
+                        "date_created": occupancy.modified.strftime("%Y-%m-%d"),
+                        "modified_by": occupancy.modified_by,
+                    }
                 )
-                new_row = self.append("nhif_patient_claim_item", {})
-                new_row.item_name = occupancy.service_unit
-                new_row.item_code = get_item_refcode(item_code)
-                new_row.item_quantity = 1
-                new_row.unit_price = item_rate
-                new_row.amount_claimed = new_row.unit_price * new_row.item_quantity
-                new_row.approval_ref_no = ""
-                new_row.patient_encounter = admission_encounter_doc.name
-                new_row.ref_doctype = occupancy.doctype
-                new_row.ref_docname = occupancy.name
-                new_row.folio_item_id = str(uuid.uuid1())
-                new_row.folio_id = self.folio_id
-                new_row.date_created = occupancy.modified.strftime("%Y-%m-%d")
-                new_row.item_crt_by = get_fullname(occupancy.modified_by)
 
             for occupancy in occupancy_list:
                 if not occupancy.is_confirmed:
@@ -509,84 +598,35 @@ class NHIFPatientClaim(Document):
                             and str(row_item.date) == checkin_date
                             and row_item.rate
                         ):
-                            item_code = row_item.consultation_item
-                            new_row = self.append("nhif_patient_claim_item", {})
-                            new_row.item_name = row_item.consultation_item
-                            new_row.item_code = get_item_refcode(item_code)
-                            new_row.item_quantity = 1
-                            new_row.unit_price = row_item.rate
-                            new_row.amount_claimed = row_item.rate
-                            new_row.approval_ref_no = ""
-                            new_row.patient_encounter = (
-                                row_item.encounter or record_doc.admission_encounter
+                            claim_items.append(
+                                {
+                                    "item_name": row_item.consultation_item,
+                                    "item": row_item.consultation_item,
+                                    "item_quantity": 1,
+                                    "unit_price": row_item.rate,
+                                    "amount_claimed": row_item.rate,
+                                    "patient_encounter": row_item.encounter
+                                    or record_doc.admission_encounter,
+                                    "ref_doctype": row_item.doctype,
+                                    "ref_docname": row_item.name,
+                                    "date_created": row_item.modified.strftime(
+                                        "%Y-%m-%d"
+                                    ),
+                                    "modified_by": row_item.modified_by,
+                                }
                             )
-                            new_row.ref_doctype = row_item.doctype
-                            new_row.ref_docname = row_item.name
-                            new_row.folio_item_id = str(uuid.uuid1())
-                            new_row.folio_id = self.folio_id
-                            new_row.date_created = row_item.modified.strftime(
-                                "%Y-%m-%d"
-                            )
-                            new_row.item_crt_by = get_fullname(row_item.modified_by)
                 if occupancy.is_service_chargeable:
                     for encounter in self.patient_encounters:
                         if str(encounter.encounter_date) != checkin_date:
                             continue
-                        encounter_doc = frappe.get_doc(
-                            "Patient Encounter", encounter.name
-                        )
-                        for child in childs_map:
-                            for row in encounter_doc.get(child.get("table")):
-                                if row.prescribe or row.is_cancelled:
-                                    continue
-                                item_code = frappe.get_value(
-                                    child.get("doctype"),
-                                    row.get(child.get("item")),
-                                    "item",
-                                )
-
-                                delivered_quantity = (row.get("quantity") or 0) - (
-                                    row.get("quantity_returned") or 0
-                                )
-
-                                new_row = self.append("nhif_patient_claim_item", {})
-                                new_row.item_name = row.get(child.get("item"))
-                                new_row.item_code = get_item_refcode(item_code)
-                                new_row.item_quantity = delivered_quantity or 1
-                                new_row.unit_price = row.get("amount")
-                                new_row.amount_claimed = (
-                                    new_row.unit_price * new_row.item_quantity
-                                )
-                                new_row.approval_ref_no = (
-                                    get_approval_number_from_LRPMT(
-                                        child["ref_doctype"],
-                                        row.get(child["ref_docname"]),
-                                    )
+                        for child, row in encounter_rows.get(encounter.name, []):
+                            claim_items.append(
+                                get_prescription_claim_item(
+                                    child, row, encounter.name, row.get(child.get("item"))
                                 )
+                            )
 
-                                if child["doctype"] == "Therapy Type" or row.get(
-                                    child["ref_docname"]
-                                ):
-                                    new_row.status = "Submitted"
-                                else:
-                                    new_row.status = "Draft"
-
-                                new_row.patient_encounter = encounter.name
-                                new_row.ref_doctype = row.doctype
-                                new_row.ref_docname = row.name
-                                new_row.folio_item_id = str(uuid.uuid1())
-                                new_row.folio_id = self.folio_id
-                                new_row.date_created = row.modified.strftime("%Y-%m-%d")
-                                new_row.item_crt_by = get_fullname(row.modified_by)
-
-        sorted_patient_claim_item = sorted(
-            self.nhif_patient_claim_item, key=lambda k: k.get("ref_doctype")
-        )
-        idx = 2
-        for row in sorted_patient_claim_item:
-            row.idx = idx
-            idx += 1
-        self.nhif_patient_claim_item = sorted_patient_claim_item
+        claim_items.sort(key=lambda k: k.get("ref_doctype"))
 
         patient_appointment_list = []
         if not self.hms_tz_claim_appointment_list:
@@ -594,38 +634,90 @@ class NHIFPatientClaim(Document):
         else:
             patient_appointment_list = json.loads(self.hms_tz_claim_appointment_list)
 
-        for appointment_no in patient_appointment_list:
-            patient_appointment_doc = frappe.get_doc(
-                "Patient Appointment", appointment_no
-            )
-
-            if patient_appointment_doc.get("appointment_type") in ["Investigation Only", "Medicine Only", "Other Visit"]:
-                continue
-
-            if not inpatient_record and not patient_appointment_doc.follow_up:
-                item_code = patient_appointment_doc.billing_item
-                item_rate = get_item_rate(
-                    item_code,
-                    self.company,
-                    patient_appointment_doc.insurance_subscription,
-                    patient_appointment_doc.insurance_company,
+        appointment_items = []
+        if not inpatient_record:
+            for appointment in frappe.get_all(
+                "Patient Appointment",
+                filters={
+                    "name": ["in", patient_appointment_list],
+                    "appointment_type": [
+                        "not in",
+                        ["Investigation Only", "Medicine Only", "Other Visit"],
+                    ],
+                    "follow_up": 0,
+                },
+                fields=[
+                    "name",
+                    "billing_item",
+                    "insurance_subscription",
+                    "insurance_company",
+                    "modified",
+                    "modified_by",
+                ],
+            ):
+                item_rate = self.get_claim_item_rate(
+                    item_rates,
+                    appointment.billing_item,
+                    appointment.insurance_subscription,
+                    appointment.insurance_company,
                 )
-                new_row = self.append("nhif_patient_claim_item", {})
-                new_row.item_name = patient_appointment_doc.billing_item
-                new_row.item_code = get_item_refcode(item_code)
-                new_row.item_quantity = 1
-                new_row.unit_price = item_rate
-                new_row.amount_claimed = item_rate
-                new_row.approval_ref_no = ""
-                new_row.ref_doctype = patient_appointment_doc.doctype
-                new_row.ref_docname = patient_appointment_doc.name
-                new_row.folio_item_id = str(uuid.uuid1())
-                new_row.folio_id = self.folio_id
-                new_row.date_created = patient_appointment_doc.modified.strftime(
-                    "%Y-%m-%d"
+                appointment_items.append(
+                    {
+                        "item_name": appointment.billing_item,
+                        "item": appointment.billing_item,
+                        "item_quantity": 1,
+                        "unit_price": item_rate,
+                        "amount_claimed": item_rate,
+                        "ref_doctype": "Patient Appointment",
+                        "ref_docname": appointment.name,
+                        "date_created": appointment.modified.strftime("%Y-%m-%d"),
+                        "modified_by": appointment.modified_by,
+                        "idx": 1,
+                    }
                 )
-                new_row.item_crt_by = get_fullname(patient_appointment_doc.modified_by)
-                new_row.idx = 1
+
+        claim_items += appointment_items
+        refcodes = get_item_refcodes([item["item"] for item in claim_items])
+        approval_numbers = get_approval_numbers(
+            [item["approval_ref"] for item in claim_items if item.get("approval_ref")]
+        )
+        set_fullnames([item["modified_by"] for item in claim_items])
+
+        idx = 2
+        for item in claim_items:
+            new_row = self.append("nhif_patient_claim_item", {})
+            new_row.item_name = item["item_name"]
+            new_row.item_code = refcodes[item["item"]]
+            new_row.item_quantity = item["item_quantity"]
+            new_row.unit_price = item["unit_price"]
+            new_row.amount_claimed = item["amount_claimed"]
+            new_row.approval_ref_no = approval_numbers.get(
+                item.get("approval_ref"), item.get("approval_ref_no", "")
+            )
+            if item.get("status"):
+                new_row.status = item["status"]
+            new_row.patient_encounter = item.get("patient_encounter")
+            new_row.ref_doctype = item["ref_doctype"]
+            new_row.ref_docname = item["ref_docname"]
+            new_row.folio_item_id = str(uuid.uuid1())
+            new_row.folio_id = self.folio_id
+            new_row.date_created = item["date_created"]
+            new_row.item_crt_by = get_fullname(item["modified_by"])
+            if item.get("idx"):
+                new_row.idx = item["idx"]
+            else:
+                new_row.idx = idx
+                idx += 1
+
+    def get_claim_item_rate(
+        self, item_rates, item_code, insurance_subscription, insurance_company
+    ):
+        key = (item_code, insurance_subscription, insurance_company)
+        if key not in item_rates:
+            item_rates[key] = get_item_rate(
+                item_code, self.company, insurance_subscription, insurance_company
+            )
+        return item_rates[key]
 
     def get_final_patient_encounter(self):
         patient_encounter_list = frappe.get_all(
@@ -723,7 +815,14 @@ class NHIFPatientClaim(Document):
         url = str(claimsserver_url) + "/claimsserver/api/v1/Claims/SubmitFolios"
         r = None
         try:
-            r = requests.post(url, headers=headers, data=json_data, timeout=300)
+            r = nhif_request(
+                "POST",
+                url,
+                "SubmitFolios",
+                read_timeout=LONG_READ_TIMEOUT,
+                headers=headers,
+                data=json_data,
+            )
 
             if r.status_code != 200:
                 if str(r) and r.status_code == 500 and "A claim with Similar" in r.text:
@@ -764,6 +863,7 @@ class NHIFPatientClaim(Document):
                         request_body=json_data_wo_files,
                         response_data=r.text,
                         status_code=r.status_code,
+                        duration=r.elapsed.total_seconds(),
                     )
                 frappe.msgprint(_("The claim has been sent successfully"), alert=True)
 
@@ -836,30 +936,151 @@ class NHIFPatientClaim(Document):
 
 
     def after_insert(self):
-        folio_counter = frappe.get_all("NHIF Folio Counter", filters={
-            "company": self.company, "claim_year": self.claim_year, "claim_month": self.claim_month
-        }, fields=["name"], page_length=1)
-
-        folio_no = 1
-        if not folio_counter:
-            new_folio_doc = frappe.get_doc({
-                "doctype": "NHIF Folio Counter",
-                "company": self.company,
-                "claim_year": self.claim_year,
-                "claim_month": self.claim_month,
-                "posting_date": now_datetime(),
-                "folio_no": folio_no
-            }).insert(ignore_permissions=True)
-            new_folio_doc.reload()
-        else:
-            folio_doc = frappe.get_doc("NHIF Folio Counter", folio_counter[0].name)
-            folio_no = cint(folio_doc.folio_no) + 1
+        # a batch of claims may bring a number from reserve_folio_numbers
+        folio_no = self.flags.folio_no or allocate_folio_numbers(
+            self.company, self.claim_year, self.claim_month
+        )
+        self.db_set("folio_no", folio_no, update_modified=False)
+
+
+def get_child_rows_state(parenttype, parents):
+    """Row count and last modified of every child table of the parents, in
+    one query, so row changes that leave the parent untouched are seen"""
+    if not parents:
+        return []
+    doctypes = sorted({df.options for df in frappe.get_meta(parenttype).get_table_fields()})
+    return frappe.db.sql(
+        " UNION ALL ".join(
+            """
+            SELECT '{0}', COUNT(*), MAX(modified) FROM `tab{0}`
+            WHERE parenttype = %(parenttype)s AND parent IN %(parents)s
+        """.format(
+                doctype
+            )
+            for doctype in doctypes
+        ),
+        {"parenttype": parenttype, "parents": parents},
+    )
+
 
-            folio_doc.folio_no += 1
-            folio_doc.posting_date = now_datetime()
-            folio_doc.save(ignore_permissions=True)
-        frappe.set_value(self.doctype, self.name, "folio_no", folio_no)
-        self.reload()
+def get_referenced_docs_state(encounters):
+    """Count and last modified of the Lab Tests, Radiology Examinations,
+    Clinical Procedures and Delivery Note Items the prescriptions of the
+    encounters point to, as the claim rows take their approval numbers"""
+    if not encounters:
+        return []
+    return frappe.db.sql(
+        " UNION ALL ".join(
+            """
+            SELECT '{0}', COUNT(*), MAX(ref.modified) FROM `tab{0}` ref
+            WHERE ref.name IN (
+                SELECT {2} FROM `tab{1}`
+                WHERE parenttype = 'Patient Encounter' AND parent IN %(encounters)s
+            )
+        """.format(
+                ref_doctype, child_doctype, ref_docname
+            )
+            for child_doctype, ref_docname, ref_doctype in CLAIM_REFERENCED_DOCS
+        ),
+        {"encounters": encounters},
+    )
+
+
+def get_claim_items_state(ref_codes):
+    """NHIF ref code rows of the claimed items and the count and last
+    modified of their Item Prices, so corrected codes or rates are seen"""
+    if not ref_codes:
+        return []
+    ref_code_rows = frappe.db.sql(
+        """
+        SELECT parent, ref_code, modified FROM `tabItem Customer Detail`
+        WHERE customer_name = 'NHIF' AND ref_code IN %(ref_codes)s
+        ORDER BY parent, ref_code
+    """,
+        {"ref_codes": list(set(ref_codes))},
+    )
+    items = list({row[0] for row in ref_code_rows})
+    if not items:
+        return [ref_code_rows]
+    return [
+        ref_code_rows,
+        frappe.db.sql(
+            """
+            SELECT COUNT(*), MAX(modified) FROM `tabItem Price`
+            WHERE item_code IN %(items)s
+        """,
+            {"items": items},
+        ),
+    ]
+
+
+def refresh_stale_claims(company=None, claim_year=None, claim_month=None):
+    """Rebuild the draft claims of the month whose sources changed since they
+    were built, by default the submit month of every NHIF enabled company"""
+    if company:
+        settings = [
+            frappe._dict(
+                company=company,
+                submit_claim_year=cint(claim_year),
+                submit_claim_month=cint(claim_month),
+            )
+        ]
+    else:
+        settings = frappe.get_all(
+            "Company NHIF Settings",
+            filters={"enable": 1},
+            fields=["company", "submit_claim_year", "submit_claim_month"],
+        )
+
+    refreshed = 0
+    for setting in settings:
+        if not (setting.submit_claim_year and setting.submit_claim_month):
+            continue
+        for name in frappe.get_all(
+            "NHIF Patient Claim",
+            filters={
+                "company": setting.company,
+                "claim_year": setting.submit_claim_year,
+                "claim_month": setting.submit_claim_month,
+                "docstatus": 0,
+                "allow_changes": 0,
+            },
+            pluck="name",
+        ):
+            try:
+                doc = frappe.get_doc("NHIF Patient Claim", name)
+                doc.patient_encounters = doc.get_patient_encounters()
+                if not doc.patient_encounters:
+                    continue
+                doc.final_patient_encounter = doc.get_final_patient_encounter()
+                if doc.get_source_fingerprint() == doc.source_fingerprint:
+                    continue
+                doc.save(ignore_permissions=True)
+                frappe.db.commit()
+                refreshed += 1
+            except Exception:
+                frappe.db.rollback()
+                frappe.log_error(
+                    frappe.get_traceback(),
+                    "Refresh of NHIF Patient Claim {0} failed".format(name),
+                )
+    return refreshed
+
+
+@frappe.whitelist()
+def enqueue_refresh_stale_claims(company, claim_year, claim_month):
+    frappe.has_permission("NHIF Patient Claim", "write", throw=True)
+    frappe.enqueue(
+        "hms_tz.nhif.doctype.nhif_patient_claim.nhif_patient_claim.refresh_stale_claims",
+        queue="long",
+        timeout=3600,
+        company=company,
+        claim_year=claim_year,
+        claim_month=claim_month,
+    )
+    frappe.msgprint(_("Stale claims of {0}-{1} are being refreshed in the background").format(
+        claim_year, claim_month
+    ))
 
 
 def get_missing_patient_signature(self):
@@ -913,18 +1134,135 @@ def validate_item_status(self):
             )
 
 
-def get_item_refcode(item_code):
-    code_list = frappe.get_all(
-        "Item Customer Detail",
-        filters={"parent": item_code, "customer_name": "NHIF"},
-        fields=["ref_code"],
-    )
-    if len(code_list) == 0:
-        frappe.throw(_("Item {0} has not NHIF Code Reference").format(item_code))
-    ref_code = code_list[0].ref_code
-    if not ref_code:
-        frappe.throw(_("Item {0} has not NHIF Code Reference").format(item_code))
-    return ref_code
+def get_encounter_claim_rows(childs_map, encounters):
+    """Claimable prescription rows of the encounters, read with one query per
+    child table, {encounter: [(child, row), ...]} in the order of the tables
+    and rows on the encounter"""
+    encounter_rows = {}
+    if not encounters:
+        return encounter_rows
+
+    meta = frappe.get_meta("Patient Encounter")
+    template_items = {}
+    for child in childs_map:
+        child_doctype = meta.get_field(child["table"]).options
+        rows = frappe.db.sql(
+            """
+            SELECT * FROM `tab{0}`
+            WHERE parenttype = 'Patient Encounter' AND parentfield = %(table)s
+            AND parent IN %(encounters)s
+            ORDER BY idx
+        """.format(
+                child_doctype
+            ),
+            {"table": child["table"], "encounters": encounters},
+            as_dict=True,
+        )
+        rows = [row for row in rows if not (row.prescribe or row.is_cancelled)]
+        templates = list({row.get(child["item"]) for row in rows if row.get(child["item"])})
+        if templates:
+            template_items[child["doctype"]] = dict(
+                frappe.get_all(
+                    child["doctype"],
+                    filters={"name": ["in", templates]},
+                    fields=["name", "item"],
+                    as_list=True,
+                )
+            )
+        for row in rows:
+            row.doctype = child_doctype
+            row.item_code = template_items.get(child["doctype"], {}).get(
+                row.get(child["item"])
+            )
+            encounter_rows.setdefault(row.parent, []).append((child, row))
+
+    # keep the tables in the order of childs_map for every encounter
+    order = {child["table"]: i for i, child in enumerate(childs_map)}
+    for rows in encounter_rows.values():
+        rows.sort(key=lambda d: (order[d[0]["table"]], d[1].idx))
+    return encounter_rows
+
+
+def get_prescription_claim_item(child, row, encounter, item_name):
+    delivered_quantity = (row.get("quantity") or 0) - (row.get("quantity_returned") or 0)
+    item_quantity = delivered_quantity or 1
+    item = {
+        "item_name": item_name,
+        "item": row.item_code,
+        "item_quantity": item_quantity,
+        "unit_price": row.get("amount"),
+        "amount_claimed": row.get("amount") * item_quantity,
+        "approval_ref_no": None,
+        "status": "Submitted"
+        if child["doctype"] == "Therapy Type" or row.get(child["ref_docname"])
+        else "Draft",
+        "patient_encounter": encounter,
+        "ref_doctype": row.doctype,
+        "ref_docname": row.name,
+        "date_created": row.modified.strftime("%Y-%m-%d"),
+        "modified_by": row.modified_by,
+    }
+    if child["ref_doctype"] and row.get(child["ref_docname"]):
+        item["approval_ref"] = (child["ref_doctype"], row.get(child["ref_docname"]))
+    return item
+
+
+def get_item_refcodes(item_codes):
+    """NHIF ref codes of the items in one query, throwing for items without one"""
+    refcodes = {}
+    if item_codes:
+        for row in frappe.get_all(
+            "Item Customer Detail",
+            filters={
+                "parent": ["in", list({code for code in item_codes if code})],
+                "customer_name": "NHIF",
+            },
+            fields=["parent", "ref_code"],
+        ):
+            refcodes.setdefault(row.parent, row.ref_code)
+    for item_code in item_codes:
+        if not refcodes.get(item_code):
+            frappe.throw(_("Item {0} has not NHIF Code Reference").format(item_code))
+    return refcodes
+
+
+def get_approval_numbers(references):
+    """Approval numbers of (ref_doctype, ref_docname) references, one query
+    per doctype, as get_approval_number_from_LRPMT"""
+    names = {}
+    for ref_doctype, ref_docname in references:
+        names.setdefault(ref_doctype, set()).add(ref_docname)
+
+    approval_numbers = {}
+    for ref_doctype, ref_docnames in names.items():
+        for name, approval_number in frappe.get_all(
+            ref_doctype,
+            filters={"name": ["in", list(ref_docnames)]},
+            fields=["name", "approval_number"],
+            as_list=True,
+        ):
+            approval_numbers[(ref_doctype, name)] = approval_number
+    # references to missing documents have no approval number
+    for reference in references:
+        approval_numbers.setdefault(reference, None)
+    return approval_numbers
+
+
+def set_fullnames(users):
+    """Load the full names of the users in one query into the request cache
+    get_fullname reads from"""
+    if not hasattr(frappe.local, "fullnames"):
+        frappe.local.fullnames = {}
+    fullnames = frappe.local.fullnames
+    users = list({user for user in users if user and user not in fullnames})
+    if not users:
+        return
+    for user in frappe.get_all(
+        "User", filters={"name": ["in", users]}, fields=["name", "first_name", "last_name"]
+    ):
+        fullnames[user.name] = (
+            " ".join(filter(None, [user.first_name, user.last_name])) or user.name
+        )
 
 
 def generate_pdf(doc):
@@ -938,8 +1276,7 @@ def generate_pdf(doc):
     if file_list:
         patientfile = frappe.get_doc("File", file_list[0].name)
         if patientfile:
-            pdf = patientfile.get_content()
-            return to_base64(pdf)
+            return get_file_base64(patientfile)
 
     data_list = []
     data = doc.patient_encounters
@@ -1000,63 +1337,175 @@ def download_multi_pdf(doctype, name, print_format=None, no_letterhead=0):
 
 
 def read_multi_pdf(output):
-    fname = os.path.join("/tmp", "frappe-pdf-{0}.pdf".format(frappe.generate_hash()))
-    output.write(open(fname, "wb"))
+    filedata = io.BytesIO()
+    output.write(filedata)
+    return filedata.getvalue()
 
-    with open(fname, "rb") as fileobj:
-        filedata = fileobj.read()
 
-    return filedata
+def get_claim_print_format():
+    return (
+        frappe.db.get_value(
+            "Property Setter",
+            dict(property="default_print_format", doc_type="NHIF Patient Claim"),
+            "value",
+        )
+        or "NHIF Form 2A & B"
+    )
 
 
-def get_claim_pdf_file(doc):
-    file_list = frappe.get_all(
+def get_claim_pdf_hash(doc, print_format):
+    """Hash of what the claim print is rendered from, the claim and its rows
+    without the fields that change on every save"""
+
+    def strip(data):
+        if isinstance(data, dict):
+            return {
+                key: strip(value)
+                for key, value in data.items()
+                if key not in CLAIM_PDF_IGNORED_FIELDS
+            }
+        if isinstance(data, (list, tuple)):
+            return [strip(value) for value in data]
+        return data
+
+    return hashlib.md5(
+        json.dumps(
+            [
+                doc.name,
+                print_format,
+                frappe.db.get_value("Print Format", print_format, "modified"),
+                strip(doc.as_dict()),
+            ],
+            sort_keys=True,
+            default=str,
+        ).encode()
+    ).hexdigest()
+
+
+def get_claim_pdf(doc):
+    """File of the claim print, rendered again only when the claim content or
+    the print format changed since the last render"""
+    print_format = get_claim_print_format()
+    claim_pdf_hash = get_claim_pdf_hash(doc, print_format)
+    if (
+        doc.claim_pdf_hash == claim_pdf_hash
+        and doc.claim_pdf_file
+        and frappe.db.exists("File", doc.claim_pdf_file)
+    ):
+        return frappe.get_doc("File", doc.claim_pdf_file)
+
+    if doc.claim_pdf_file:
+        # unlink the stale render first, the link would block its deletion
+        doc.db_set({"claim_pdf_file": None, "claim_pdf_hash": None}, update_modified=False)
+
+    filename = "{name}-claim".format(name=doc.name.replace(" ", "-").replace("/", "-"))
+    for file in frappe.get_all(
         "File",
         filters={
             "attached_to_doctype": "NHIF Patient Claim",
-            "file_name": str(doc.name + "-claim.pdf"),
+            "file_name": filename + ".pdf",
         },
+    ):
+        frappe.delete_doc("File", file.name, ignore_permissions=True)
+
+    html = frappe.get_print(doc.doctype, doc.name, print_format, doc=None, no_letterhead=1)
+    pdf = get_pdf(html)
+    if not pdf:
+        frappe.throw(_("Failed to generate pdf"))
+
+    file_doc = frappe.get_doc(
+        {
+            "doctype": "File",
+            "attached_to_doctype": doc.doctype,
+            "attached_to_name": doc.name,
+            "folder": "Home/Attachments",
+            "file_name": filename + ".pdf",
+            "file_url": "/private/files/" + filename + ".pdf",
+            "content": pdf,
+            "is_private": 1,
+        }
     )
-    if file_list:
-        for file in file_list:
-            frappe.delete_doc("File", file.name, ignore_permissions=True)
+    file_doc.insert(ignore_permissions=True)
+    doc.db_set(
+        {"claim_pdf_file": file_doc.name, "claim_pdf_hash": claim_pdf_hash},
+        update_modified=False,
+    )
+    return file_doc
 
-    doctype = doc.doctype
-    docname = doc.name
-    default_print_format = frappe.db.get_value(
-        "Property Setter",
-        dict(property="default_print_format", doc_type=doctype),
-        "value",
+
+def get_file_base64(file_doc):
+    """Base64 of the file read from disk. SubmitFolios takes the file as a
+    string inside the folio JSON, so the whole encoded file is held in
+    memory while the folio is sent"""
+    with open(file_doc.get_full_path(), "rb") as f:
+        return base64.b64encode(f.read()).decode()
+
+
+def get_claim_pdf_file(doc):
+    # rendered from the stored claim, the same way the background job does
+    claim = frappe.get_doc(doc.doctype, doc.name)
+    file_doc = get_claim_pdf(claim)
+    # keep the submit from writing back the values of the in-memory claim
+    doc.claim_pdf_file = claim.claim_pdf_file
+    doc.claim_pdf_hash = claim.claim_pdf_hash
+    return get_file_base64(file_doc)
+
+
+def enqueue_claim_pdf(name):
+    frappe.enqueue(
+        "hms_tz.nhif.doctype.nhif_patient_claim.nhif_patient_claim.render_claim_pdf",
+        queue="long",
+        enqueue_after_commit=True,
+        name=name,
     )
-    if default_print_format:
-        print_format = default_print_format
-    else:
-        print_format = "NHIF Form 2A & B"
 
-    # print_format = "NHIF Form 2A & B"
 
-    html = frappe.get_print(doctype, docname, print_format, doc=None, no_letterhead=1)
+def render_claim_pdf(name):
+    """Pre-render the print of a draft claim so its submit only reads the file"""
+    doc = frappe.get_doc("NHIF Patient Claim", name)
+    if doc.docstatus != 0:
+        return
+    get_claim_pdf(doc)
+    frappe.db.commit()
 
-    filename = "{name}-claim".format(name=docname.replace(" ", "-").replace("/", "-"))
-    pdf = get_pdf(html)
-    if pdf:
-        ret = frappe.get_doc(
-            {
-                "doctype": "File",
-                "attached_to_doctype": doc.doctype,
-                "attached_to_name": docname,
-                "folder": "Home/Attachments",
-                "file_name": filename + ".pdf",
-                "file_url": "/private/files/" + filename + ".pdf",
-                "content": pdf,
-                "is_private": 1,
-            }
+
+def prerender_claims(company, claim_year, claim_month):
+    rendered = 0
+    for name in frappe.get_all(
+        "NHIF Patient Claim",
+        filters={
+            "company": company,
+            "claim_year": cint(claim_year),
+            "claim_month": cint(claim_month),
+            "docstatus": 0,
+        },
+        pluck="name",
+    ):
+        try:
+            render_claim_pdf(name)
+            rendered += 1
+        except Exception:
+            frappe.db.rollback()
+            frappe.log_error(
+                frappe.get_traceback(),
+                "Pre-render of NHIF Patient Claim {0} failed".format(name),
+            )
+    return rendered
+
+
+@frappe.whitelist()
+def enqueue_prerender_claims(company, claim_year, claim_month):
+    frappe.has_permission("NHIF Patient Claim", "write", throw=True)
+    frappe.enqueue(
+        "hms_tz.nhif.doctype.nhif_patient_claim.nhif_patient_claim.prerender_claims",
+        queue="long",
+        timeout=14400,
+        company=company,
+        claim_year=claim_year,
+        claim_month=claim_month,
+    )
+    frappe.msgprint(
+        _("Claim files of {0}-{1} are being rendered in the background").format(
+            claim_year, claim_month
         )
-        ret.insert(ignore_permissions=True)
-        ret.db_update()
-        if not ret.name:
-            frappe.throw("ret name not exist")
-        base64_data = to_base64(pdf)
-        return base64_data
-    else:
-        frappe.throw(_("Failed to generate pdf"))
+    )
@@ -3,8 +3,157 @@
 # See license.txt
 from __future__ import unicode_literals
 
-# import frappe
+import frappe
 import unittest
+from unittest.mock import MagicMock, call, patch
+from hms_tz.nhif.doctype.nhif_patient_claim.nhif_patient_claim import get_claim_pdf
+
+CLAIM_MODULE = "hms_tz.nhif.doctype.nhif_patient_claim.nhif_patient_claim"
+
+
+def make_claim(source_fingerprint="fingerprint"):
+	claim = frappe.new_doc("NHIF Patient Claim")
+	claim.patient_appointment = "_Test Appointment"
+	claim.append("patient_encounters", {"name": "_Test Encounter"})
+	claim.append("nhif_patient_claim_item", {"item_code": "_Test Ref Code"})
+	claim.source_fingerprint = source_fingerprint
+	claim.final_patient_encounter = frappe._dict(inpatient_record=None)
+	return claim
+
+
+def make_rendered_claim():
+	claim = MagicMock()
+	claim.doctype = "NHIF Patient Claim"
+	claim.name = "NHIF-CLM-00001"
+	claim.claim_pdf_file = "_Test Claim File"
+	claim.claim_pdf_hash = "pdf hash"
+	return claim
+
 
 class TestNHIFPatientClaim(unittest.TestCase):
-	pass
+	def test_unchanged_sources_skip_rebuild(self):
+		claim = make_claim()
+		with patch.object(claim, "get_source_fingerprint", return_value="fingerprint"), patch.object(
+			claim, "has_value_changed", return_value=False
+		), patch.object(claim, "set_patient_claim_disease") as set_disease, patch.object(
+			claim, "set_patient_claim_item"
+		) as set_item:
+			claim.rebuild_claim_if_stale()
+
+		set_disease.assert_not_called()
+		set_item.assert_not_called()
+		self.assertEqual(claim.source_fingerprint, "fingerprint")
+
+	def test_changed_sources_rebuild(self):
+		claim = make_claim()
+		with patch.object(claim, "get_source_fingerprint", return_value="changed"), patch.object(
+			claim, "has_value_changed", return_value=False
+		), patch.object(claim, "set_patient_claim_disease") as set_disease, patch.object(
+			claim, "set_patient_claim_item"
+		) as set_item:
+			claim.rebuild_claim_if_stale()
+
+		set_disease.assert_called_once()
+		set_item.assert_called_once()
+		self.assertEqual(claim.source_fingerprint, "changed")
+
+	def test_rebuild_flag_forces_rebuild(self):
+		claim = make_claim()
+		claim.flags.rebuild_claim = True
+		with patch.object(claim, "get_source_fingerprint", return_value="fingerprint"), patch.object(
+			claim, "has_value_changed", return_value=False
+		), patch.object(claim, "set_patient_claim_disease"), patch.object(
+			claim, "set_patient_claim_item"
+		) as set_item:
+			claim.rebuild_claim_if_stale()
+
+		set_item.assert_called_once()
+
+	def test_fingerprint_covers_approval_documents_and_ref_codes(self):
+		claim = make_claim()
+		with patch(CLAIM_MODULE + ".frappe.get_all", return_value=[]), patch(
+			CLAIM_MODULE + ".get_child_rows_state", return_value=[]
+		), patch(
+			CLAIM_MODULE + ".get_referenced_docs_state", return_value=[("Lab Test", 1, "2022-01-01")]
+		) as referenced_docs_state, patch(
+			CLAIM_MODULE + ".get_claim_items_state", return_value=[]
+		) as claim_items_state:
+			fingerprint = claim.get_source_fingerprint()
+			self.assertEqual(claim.get_source_fingerprint(), fingerprint)
+
+			# an approval number set on the Lab Test
+			referenced_docs_state.return_value = [("Lab Test", 1, "2022-01-02")]
+			self.assertNotEqual(claim.get_source_fingerprint(), fingerprint)
+			fingerprint = claim.get_source_fingerprint()
+
+			# a corrected NHIF ref code of a claimed item
+			claim_items_state.return_value = [[("_Test Item", "_Test New Ref Code", "2022-01-02")]]
+			self.assertNotEqual(claim.get_source_fingerprint(), fingerprint)
+
+		claim_items_state.assert_called_with(["_Test Ref Code"])
+
+	def test_claim_pdf_reused_while_unchanged(self):
+		claim = make_rendered_claim()
+		with patch(CLAIM_MODULE + ".get_claim_print_format", return_value="NHIF Form 2A"), patch(
+			CLAIM_MODULE + ".get_claim_pdf_hash", return_value="pdf hash"
+		), patch(CLAIM_MODULE + ".frappe.db.exists", return_value=True), patch(
+			CLAIM_MODULE + ".frappe.get_doc"
+		) as get_doc, patch(CLAIM_MODULE + ".get_pdf") as get_pdf:
+			file_doc = get_claim_pdf(claim)
+
+		self.assertEqual(file_doc, get_doc.return_value)
+		get_doc.assert_called_once_with("File", "_Test Claim File")
+		get_pdf.assert_not_called()
+		claim.db_set.assert_not_called()
+
+	def test_claim_pdf_rendered_when_changed(self):
+		claim = make_rendered_claim()
+		events = []
+		claim.db_set.side_effect = lambda values, **kwargs: events.append(("db_set", values))
+		new_file = MagicMock()
+		new_file.name = "_Test New Claim File"
+		with patch(CLAIM_MODULE + ".get_claim_print_format", return_value="NHIF Form 2A"), patch(
+			CLAIM_MODULE + ".get_claim_pdf_hash", return_value="new pdf hash"
+		), patch(
+			CLAIM_MODULE + ".frappe.get_all", return_value=[frappe._dict(name="_Test Claim File")]
+		), patch(
+			CLAIM_MODULE + ".frappe.delete_doc",
+			side_effect=lambda doctype, name, **kwargs: events.append(("delete_doc", name)),
+		), patch(
+			CLAIM_MODULE + ".frappe.get_print", return_value="<p>claim</p>"
+		), patch(
+			CLAIM_MODULE + ".get_pdf", return_value=b"%PDF"
+		) as get_pdf, patch(
+			CLAIM_MODULE + ".frappe.get_doc", return_value=new_file
+		):
+			file_doc = get_claim_pdf(claim)
+
+		self.assertEqual(file_doc, new_file)
+		get_pdf.assert_called_once_with("<p>claim</p>")
+		new_file.insert.assert_called_once_with(ignore_permissions=True)
+		# the stale file is unlinked before it is deleted
+		self.assertEqual(
+			events,
+			[
+				("db_set", {"claim_pdf_file": None, "claim_pdf_hash": None}),
+				("delete_doc", "_Test Claim File"),
+				("db_set", {"claim_pdf_file": "_Test New Claim File", "claim_pdf_hash": "new pdf hash"}),
+			],
+		)
+		self.assertEqual(claim.db_set.call_args_list[-1], call(
+			{"claim_pdf_file": "_Test New Claim File", "claim_pdf_hash": "new pdf hash"},
+			update_modified=False,
+		))
+
+	def test_claim_pdf_rendered_when_file_is_missing(self):
+		claim = make_rendered_claim()
+		with patch(CLAIM_MODULE + ".get_claim_print_format", return_value="NHIF Form 2A"), patch(
+			CLAIM_MODULE + ".get_claim_pdf_hash", return_value="pdf hash"
+		), patch(CLAIM_MODULE + ".frappe.db.exists", return_value=False), patch(
+			CLAIM_MODULE + ".frappe.get_all", return_value=[]
+		), patch(CLAIM_MODULE + ".frappe.get_print", return_value="<p>claim</p>"), patch(
+			CLAIM_MODULE + ".get_pdf", return_value=b"%PDF"
+		) as get_pdf, patch(CLAIM_MODULE + ".frappe.get_doc"):
+			get_claim_pdf(claim)
+
+		get_pdf.assert_called_once()
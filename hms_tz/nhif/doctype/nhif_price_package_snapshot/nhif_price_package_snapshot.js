@@ -0,0 +1,8 @@
+// Copyright (c) 2026, Aakvatech and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('NHIF Price Package Snapshot', {
+	// refresh: function(frm) {
+
+	// }
+});
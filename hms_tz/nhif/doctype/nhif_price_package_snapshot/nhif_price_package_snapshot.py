@@ -0,0 +1,194 @@
+# Copyright (c) 2026, Aakvatech and contributors
+# For license information, please see license.txt
+
+import frappe
+import gzip
+import hashlib
+import json
+from frappe import _
+from frappe.model.document import Document
+from frappe.utils import cstr, get_datetime, getdate, add_to_date
+
+# Every price package download is kept as two gzipped private files:
+#   index: {section: {record key: record hash}}, small and enough to tell
+#          which records are new, changed or deleted
+#   data:  {section: {"columns": [...], "rows": [[...], ...]}}, read only
+#          when the records themselves are needed
+# A PriceCode repeats across schemes and packages, so it is keyed together
+# with them
+SNAPSHOT_SECTIONS = {
+    "PricePackage": ("PriceCode", "SchemeID", "PackageID"),
+    "ExcludedServices": ("ItemCode", "SchemeID"),
+}
+
+
+class NHIFPricePackageSnapshot(Document):
+    pass
+
+
+def get_record_key(record, key_fields):
+    return "|".join(cstr(record.get(field)) for field in key_fields)
+
+
+def normalize_record(record):
+    return {field: value for field, value in record.items() if value is not None}
+
+
+def get_record_hash(record):
+    return hashlib.md5(
+        json.dumps(record, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def save_snapshot(company, facility_code, data, log_name, time_stamp):
+    index = {}
+    columnar = {}
+    for section, key_fields in SNAPSHOT_SECTIONS.items():
+        records = [normalize_record(record) for record in data.get(section) or []]
+        columns = sorted({field for record in records for field in record})
+        # the last of repeated keys wins, as in get_nhif_diff
+        index[section] = {
+            get_record_key(record, key_fields): get_record_hash(record)
+            for record in records
+        }
+        columnar[section] = {
+            "columns": columns,
+            "rows": [[record.get(column) for column in columns] for record in records],
+        }
+
+    doc = frappe.get_doc(
+        {
+            "doctype": "NHIF Price Package Snapshot",
+            "company": company,
+            "facility_code": facility_code,
+            "time_stamp": time_stamp,
+            "log_name": log_name,
+            "price_package_count": len(columnar["PricePackage"]["rows"]),
+            "excluded_services_count": len(columnar["ExcludedServices"]["rows"]),
+        }
+    )
+    doc.insert(ignore_permissions=True)
+    index["key_fields"] = {
+        section: list(key_fields) for section, key_fields in SNAPSHOT_SECTIONS.items()
+    }
+    doc.db_set("index_file", save_snapshot_file(doc.name, "index", index))
+    doc.db_set("data_file", save_snapshot_file(doc.name, "data", columnar))
+    return doc
+
+
+def save_snapshot_file(snapshot_name, kind, content):
+    file_doc = frappe.get_doc(
+        {
+            "doctype": "File",
+            "file_name": "{0}-{1}.json.gz".format(snapshot_name, kind),
+            "attached_to_doctype": "NHIF Price Package Snapshot",
+            "attached_to_name": snapshot_name,
+            "is_private": 1,
+            "content": gzip.compress(json.dumps(content, default=str).encode()),
+        }
+    )
+    file_doc.save(ignore_permissions=True)
+    return file_doc.name
+
+
+def load_snapshot_file(file_name):
+    # kept for the request only, never in the redis doc cache
+    if not hasattr(frappe.local, "nhif_snapshot_files"):
+        frappe.local.nhif_snapshot_files = {}
+    cache = frappe.local.nhif_snapshot_files
+    if file_name not in cache:
+        cache[file_name] = json.loads(
+            gzip.decompress(frappe.get_doc("File", file_name).get_content())
+        )
+    return cache[file_name]
+
+
+def get_snapshot_index(snapshot):
+    return load_snapshot_file(
+        frappe.db.get_value("NHIF Price Package Snapshot", snapshot, "index_file")
+    )
+
+
+def get_snapshot_section_index(snapshot, section):
+    """{record key: record hash} of the section, keyed by the current key
+    fields even when the snapshot was indexed by others"""
+    index = get_snapshot_index(snapshot)
+    key_fields = SNAPSHOT_SECTIONS[section]
+    if tuple(index.get("key_fields", {}).get(section) or ()) == key_fields:
+        return index[section]
+    return {
+        get_record_key(record, key_fields): get_record_hash(record)
+        for record in get_snapshot_records(snapshot, section)
+    }
+
+
+def get_snapshot_records(snapshot, section, keys=None):
+    """Records of `section` as dicts, only those with a key in `keys` when given"""
+    data = load_snapshot_file(
+        frappe.db.get_value("NHIF Price Package Snapshot", snapshot, "data_file")
+    )[section]
+    key_fields = SNAPSHOT_SECTIONS[section]
+    records = []
+    for row in data["rows"]:
+        record = normalize_record(dict(zip(data["columns"], row)))
+        if keys is None or get_record_key(record, key_fields) in keys:
+            records.append(record)
+    return records
+
+
+def get_latest_snapshots(facility_code, limit=2):
+    return frappe.get_all(
+        "NHIF Price Package Snapshot",
+        filters={"facility_code": facility_code},
+        fields=["name", "log_name", "time_stamp"],
+        order_by="time_stamp desc",
+        page_length=limit,
+    )
+
+
+def get_snapshot_diff(current, previous, section):
+    """Keys of the new, changed and deleted records between two snapshots,
+    worked out from the hash indexes alone"""
+    current_index = get_snapshot_section_index(current, section)
+    previous_index = get_snapshot_section_index(previous, section)
+    new_keys = set(current_index) - set(previous_index)
+    deleted_keys = set(previous_index) - set(current_index)
+    changed_keys = {
+        key
+        for key, record_hash in current_index.items()
+        if key in previous_index and previous_index[key] != record_hash
+    }
+    return new_keys, changed_keys, deleted_keys
+
+
+@frappe.whitelist()
+def get_nhif_price_on_date(facility_code, item_code, date):
+    """Price package records of `item_code` in the last download made on or
+    before `date`"""
+    frappe.has_permission("NHIF Price Package Snapshot", "read", throw=True)
+    snapshot = frappe.get_all(
+        "NHIF Price Package Snapshot",
+        filters={
+            "facility_code": facility_code,
+            "time_stamp": ["<", add_to_date(get_datetime(getdate(date)), days=1)],
+        },
+        fields=["name", "time_stamp"],
+        order_by="time_stamp desc",
+        page_length=1,
+    )
+    if not snapshot:
+        frappe.throw(
+            _("No NHIF Price Package downloaded for facility {0} on or before {1}").format(
+                facility_code, date
+            )
+        )
+
+    return {
+        "snapshot": snapshot[0].name,
+        "time_stamp": snapshot[0].time_stamp,
+        "records": [
+            record
+            for record in get_snapshot_records(snapshot[0].name, "PricePackage")
+            if cstr(record.get("ItemCode")) == cstr(item_code)
+        ],
+    }
@@ -4,22 +4,286 @@
 
 from __future__ import unicode_literals
 import frappe
+import base64
+import gzip
+import hashlib
+import json
 from frappe.model.document import Document
+from frappe.utils import now_datetime, add_to_date, cint, cstr
+
+
+# Logs are pushed to a redis list and written by a background flush in
+# multi-row inserts, so NHIF calls do not wait on (or commit) the database.
+LOG_BUFFER_KEY = "nhif_response_log_buffer"
+LOG_FLUSH_SCHEDULED_KEY = "nhif_response_log_flush_scheduled"
+LOG_FLUSH_BATCH_SIZE = 200
+# seconds a scheduled flush covers before the next add_log schedules another
+LOG_FLUSH_INTERVAL = 60
+
+# payloads bigger than this are gzipped before they are buffered, and later
+# saved into a private File attached to the log, the row only keeps a
+# reference with the sha256 digest
+LOG_PAYLOAD_INLINE_LIMIT = 64 * 1024
+LOG_PAYLOAD_FIELDS = ("request_body", "response_data")
+PAYLOAD_REF_PREFIX = "nhif-payload:"
+
+LOG_RETENTION_DAYS = 180
+LOG_PRUNE_BATCH_SIZE = 1000
+
+LOG_COLUMNS = [
+    "name",
+    "creation",
+    "modified",
+    "owner",
+    "modified_by",
+    "timestamp",
+    "request_type",
+    "request_url",
+    "user_id",
+    "request_body",
+    "response_data",
+    "request_header",
+    "status_code",
+    "duration",
+]
 
 
 class NHIFResponseLog(Document):
     pass
 
 
-def add_log(request_type, request_url, request_header=None, request_body=None, response_data=None, status_code=None):
-    doc = frappe.new_doc("NHIF Response Log")
-    doc.request_type = str(request_type)
-    doc.request_url = str(request_url)
-    doc.request_header = str(request_header) or ""
-    doc.request_body = str(request_body) or ""
-    doc.response_data = str(response_data) or ""
-    doc.user_id = frappe.session.user
-    doc.status_code = status_code or ""
-    doc.save(ignore_permissions=True)
-    frappe.db.commit()
-    return doc.name
+def add_log(request_type, request_url, request_header=None, request_body=None, response_data=None, status_code=None, duration=None, immediate=False):
+    """Record an NHIF request and return the name of its log.
+
+    The log is buffered and written in the background. With `immediate`
+    it is inserted right away in the caller's transaction, for callers that
+    read the log back in the same request."""
+    time_stamp = now_datetime()
+    record = {
+        "name": get_log_name(time_stamp),
+        "creation": time_stamp,
+        "modified": time_stamp,
+        "owner": frappe.session.user,
+        "modified_by": frappe.session.user,
+        "timestamp": time_stamp,
+        "request_type": str(request_type),
+        "request_url": str(request_url),
+        "user_id": frappe.session.user,
+        "request_body": str(request_body) or "",
+        "response_data": str(response_data) or "",
+        "request_header": str(request_header) or "",
+        "status_code": status_code or "",
+        "duration": duration,
+    }
+
+    if not immediate:
+        try:
+            compress_payloads(record)
+            frappe.cache().rpush(LOG_BUFFER_KEY, frappe.as_json(record, indent=None))
+            schedule_log_flush()
+            return record["name"]
+        except Exception:
+            # redis unavailable, write it with the caller's transaction
+            frappe.logger().debug({"nhif_response_log_buffer_error": record["name"]})
+
+    insert_logs([record])
+    return record["name"]
+
+
+def compress_payloads(record):
+    """Gzip the payloads over LOG_PAYLOAD_INLINE_LIMIT so they are held in
+    redis compressed, insert_logs saves them to their File as they are"""
+    for fieldname in LOG_PAYLOAD_FIELDS:
+        content = cstr(record.get(fieldname)).encode("utf-8")
+        if len(content) <= LOG_PAYLOAD_INLINE_LIMIT:
+            continue
+        record[fieldname] = frappe.safe_decode(base64.b64encode(gzip.compress(content)))
+        record.setdefault("compressed", {})[fieldname] = {
+            "sha256": hashlib.sha256(content).hexdigest(),
+            "size": len(content),
+        }
+
+
+def get_log_name(time_stamp):
+    # names are assigned up front since the row is written later
+    return "NHIF-RES-{0}-{1}".format(
+        time_stamp.strftime("%y"), frappe.generate_hash("", 10).upper()
+    )
+
+
+def schedule_log_flush():
+    if frappe.cache().set(
+        frappe.cache().make_key(LOG_FLUSH_SCHEDULED_KEY),
+        1,
+        nx=True,
+        ex=LOG_FLUSH_INTERVAL,
+    ):
+        frappe.enqueue(
+            "hms_tz.nhif.doctype.nhif_response_log.nhif_response_log.flush_logs",
+            queue="short",
+        )
+
+
+def flush_logs():
+    """Write the buffered logs, also run by the scheduler to pick up logs
+    left behind by a failed flush"""
+    frappe.cache().delete(frappe.cache().make_key(LOG_FLUSH_SCHEDULED_KEY))
+    key = frappe.cache().make_key(LOG_BUFFER_KEY)
+    while True:
+        pipe = frappe.cache().pipeline()
+        pipe.lrange(key, 0, LOG_FLUSH_BATCH_SIZE - 1)
+        pipe.ltrim(key, LOG_FLUSH_BATCH_SIZE, -1)
+        batch = pipe.execute()[0]
+        if not batch:
+            break
+
+        records = [json.loads(frappe.safe_decode(row)) for row in batch]
+        try:
+            insert_logs(records)
+            frappe.db.commit()
+            continue
+        except Exception:
+            frappe.db.rollback()
+
+        # insert them one by one so a bad record only loses itself
+        failed = []
+        for record in records:
+            frappe.db.savepoint("nhif_response_log")
+            try:
+                insert_logs([record])
+            except Exception:
+                frappe.db.rollback(save_point="nhif_response_log")
+                failed.append(record["name"])
+                frappe.log_error(
+                    frappe.get_traceback(),
+                    "NHIF Response Log flush: {0}".format(record["name"]),
+                )
+        if len(failed) < len(records):
+            frappe.db.commit()
+            continue
+
+        # nothing could be written, the database is likely unavailable,
+        # keep them for the next flush
+        frappe.db.rollback()
+        pipe = frappe.cache().pipeline()
+        pipe.rpush(key, *batch)
+        pipe.execute()
+        break
+
+
+def insert_logs(records):
+    rows = []
+    for record in records:
+        row = dict(record)
+        compressed = record.get("compressed") or {}
+        for fieldname in LOG_PAYLOAD_FIELDS:
+            if fieldname in compressed:
+                row[fieldname] = save_payload_file(
+                    record["name"],
+                    fieldname,
+                    base64.b64decode(record[fieldname]),
+                    **compressed[fieldname]
+                )
+            else:
+                row[fieldname] = store_payload(
+                    record["name"], fieldname, record.get(fieldname)
+                )
+        rows.append(row)
+
+    frappe.db.sql(
+        "INSERT INTO `tabNHIF Response Log` ({0}) VALUES {1}".format(
+            ", ".join("`{0}`".format(c) for c in LOG_COLUMNS),
+            ", ".join(["%s"] * len(records)),
+        ),
+        tuple(tuple(row.get(c) for c in LOG_COLUMNS) for row in rows),
+    )
+
+
+def store_payload(log_name, fieldname, payload):
+    payload = cstr(payload)
+    if len(payload) <= LOG_PAYLOAD_INLINE_LIMIT:
+        return payload
+
+    content = payload.encode("utf-8")
+    return save_payload_file(
+        log_name,
+        fieldname,
+        gzip.compress(content),
+        sha256=hashlib.sha256(content).hexdigest(),
+        size=len(content),
+    )
+
+
+def save_payload_file(log_name, fieldname, compressed, sha256, size):
+    file_doc = frappe.get_doc(
+        {
+            "doctype": "File",
+            "file_name": "{0}-{1}.json.gz".format(log_name, fieldname),
+            "attached_to_doctype": "NHIF Response Log",
+            "attached_to_name": log_name,
+            "is_private": 1,
+            "content": compressed,
+        }
+    )
+    file_doc.save(ignore_permissions=True)
+    return PAYLOAD_REF_PREFIX + json.dumps(
+        {"file": file_doc.name, "sha256": sha256, "size": size}
+    )
+
+
+def get_log_payload(log_name, fieldname):
+    """The full request_body or response_data of a log, read back from its
+    file when it was stored compressed"""
+    value = cstr(frappe.db.get_value("NHIF Response Log", log_name, fieldname))
+    if not value.startswith(PAYLOAD_REF_PREFIX):
+        return value
+
+    ref = json.loads(value[len(PAYLOAD_REF_PREFIX):])
+    content = gzip.decompress(frappe.get_doc("File", ref["file"]).get_content())
+    if hashlib.sha256(content).hexdigest() != ref["sha256"]:
+        frappe.throw(
+            "{0} of NHIF Response Log {1} does not match its digest".format(
+                fieldname, log_name
+            )
+        )
+    return content.decode("utf-8")
+
+
+def prune_logs():
+    """Delete logs older than `nhif_response_log_retention_days` (site config)
+    together with their payload files. Logs of price package downloads
+    are kept while an NHIF Price Package Snapshot links to them."""
+    retention_days = cint(
+        frappe.conf.get("nhif_response_log_retention_days") or LOG_RETENTION_DAYS
+    )
+    cutoff = add_to_date(now_datetime(), days=-retention_days)
+    while True:
+        names = frappe.db.sql_list(
+            """
+            SELECT name FROM `tabNHIF Response Log`
+            WHERE creation < %(cutoff)s
+            AND name NOT IN (
+                SELECT log_name FROM `tabNHIF Price Package Snapshot`
+                WHERE log_name IS NOT NULL
+            )
+            LIMIT %(limit)s
+        """,
+            {"cutoff": cutoff, "limit": LOG_PRUNE_BATCH_SIZE},
+        )
+        if not names:
+            break
+
+        for file_name in frappe.get_all(
+            "File",
+            filters={
+                "attached_to_doctype": "NHIF Response Log",
+                "attached_to_name": ["in", names],
+            },
+            pluck="name",
+        ):
+            frappe.delete_doc("File", file_name, ignore_permissions=True)
+        frappe.db.sql(
+            "DELETE FROM `tabNHIF Response Log` WHERE name IN %(names)s",
+            {"names": names},
+        )
+        frappe.db.commit()
@@ -42,5 +42,17 @@ frappe.query_reports["Claims Reconciliation Report"] = {
 			"reqd": 1,
 			"width": "30px"
 		},
+		{
+			"fieldname": "view",
+			"label": __("View"),
+			"fieldtype": "Select",
+			"options": "Submitted Claims\nDiscrepancies",
+			"default": "Submitted Claims"
+		},
+		{
+			"fieldname": "refresh_from_nhif",
+			"label": __("Refresh from NHIF"),
+			"fieldtype": "Check"
+		},
 	]
 };
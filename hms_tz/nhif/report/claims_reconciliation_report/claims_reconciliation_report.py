@@ -6,18 +6,34 @@ import frappe
 from frappe import _
 from hms_tz.nhif.api.token import get_claimsservice_token
 from hms_tz.nhif.doctype.nhif_response_log.nhif_response_log import add_log
+from hms_tz.nhif.api.nhif_client import nhif_request, LONG_READ_TIMEOUT
+from frappe.utils import cint, flt
 import json
-import requests
+
+# seconds the submitted claims downloaded from NHIF are reused for
+NHIF_CLAIMS_CACHE_TTL = 600
+# fields of the NHIF records that may carry the claimed amount
+NHIF_AMOUNT_FIELDS = ("AmountClaimed", "TotalAmountClaimed")
 
 
 def execute(filters=None):
-    columns = get_columns()
+    columns = get_columns(filters)
     data = get_data(filters)
     return columns, data
 
 
-def get_columns():
-    columns = [
+def get_columns(filters=None):
+    columns = []
+    if filters and filters.get("view") == "Discrepancies":
+        columns.append(
+            {
+                "fieldname": "discrepancy",
+                "label": _("Discrepancy"),
+                "fieldtype": "Data",
+                "width": 140
+            }
+        )
+    columns += [
         {
             "fieldname": "SubmissionID",
             "label": _("Submission ID"),
@@ -109,29 +125,139 @@ def get_columns():
             "options": "",
             "width": 100
         },
+        {
+            "fieldname": "nhif_amount",
+            "label": _("NHIF Amount"),
+            "fieldtype": "Currency",
+            "width": 100
+        },
+        {
+            "fieldname": "total_amount",
+            "label": _("Claim Amount"),
+            "fieldtype": "Currency",
+            "width": 100
+        },
     ]
     return columns
 
 
 def get_data(filters):
-    updated_data = []
     data = get_nhif_data(filters)
+    claims = get_local_claims(filters, [item.get("SubmissionID") for item in data])
+
+    # join the NHIF records to the claims by SubmissionID, else by FolioNo
+    # an amended claim keeps the folio id, the submitted one wins
+    by_submission_id = {
+        claim.folio_id: claim
+        for claim in sorted(claims, key=lambda claim: claim.docstatus == 1)
+        if claim.folio_id
+    }
+    by_folio_no = {}
+    for claim in claims:
+        if (
+            claim.docstatus == 1
+            and claim.claim_year == cint(filters.ClaimYear)
+            and claim.claim_month == cint(filters.ClaimMonth)
+        ):
+            by_folio_no.setdefault(cint(claim.folio_no), claim)
+
+    updated_data = []
+    matched = set()
     for item in data:
         item = frappe._dict(item)
-        claim_list = frappe.get_all("NHIF Patient Claim", filters={"folio_id": item.SubmissionID}, fields=[
-            "name", "patient_appointment", "patient", "patient_name", "posting_date", "authorization_no",
-            "practitioner_no"
-        ])
-        if len(claim_list) > 0:
-            item.update(claim_list[0])
+        item.nhif_amount = get_nhif_amount(item)
+        claim = by_submission_id.get(item.SubmissionID) or by_folio_no.get(
+            cint(item.FolioNo)
+        )
+        if claim:
+            matched.add(claim.name)
+            item.update(get_claim_values(claim))
+            if item.nhif_amount is not None and flt(item.nhif_amount) != flt(
+                claim.total_amount
+            ):
+                item.discrepancy = _("Amount Mismatch")
+        else:
+            item.discrepancy = _("Missing Locally")
         updated_data.append(item)
-    return updated_data
+
+    if filters.get("view") != "Discrepancies":
+        return updated_data
+
+    for claim in by_folio_no.values():
+        if claim.name not in matched:
+            row = frappe._dict(
+                BillNo=claim.name,
+                FolioNo=claim.folio_no,
+                ClaimYear=claim.claim_year,
+                ClaimMonth=claim.claim_month,
+                discrepancy=_("Missing at NHIF"),
+            )
+            row.update(get_claim_values(claim))
+            updated_data.append(row)
+    return [item for item in updated_data if item.get("discrepancy")]
+
+
+def get_local_claims(filters, submission_ids):
+    """The claims of the month plus any other claim with one of the
+    SubmissionIDs, in one query"""
+    return frappe.db.sql(
+        """
+        SELECT name, patient_appointment, patient, patient_name, posting_date,
+            authorization_no, practitioner_no, folio_id, folio_no, claim_year,
+            claim_month, total_amount, docstatus
+        FROM `tabNHIF Patient Claim`
+        WHERE folio_id IN %(submission_ids)s
+        OR (
+            company = %(company)s AND claim_year = %(claim_year)s
+            AND claim_month = %(claim_month)s AND docstatus = 1
+        )
+    """,
+        {
+            "submission_ids": [i for i in submission_ids if i] or [""],
+            "company": filters.company,
+            "claim_year": cint(filters.ClaimYear),
+            "claim_month": cint(filters.ClaimMonth),
+        },
+        as_dict=True,
+    )
+
+
+def get_claim_values(claim):
+    return {
+        "name": claim.name,
+        "patient_appointment": claim.patient_appointment,
+        "patient": claim.patient,
+        "patient_name": claim.patient_name,
+        "posting_date": claim.posting_date,
+        "authorization_no": claim.authorization_no,
+        "practitioner_no": claim.practitioner_no,
+        "total_amount": claim.total_amount,
+    }
+
+
+def get_nhif_amount(item):
+    for field in NHIF_AMOUNT_FIELDS:
+        if item.get(field) is not None:
+            return flt(item.get(field))
+    return None
+
+
+def get_nhif_cache_key(facility_code, filters):
+    return "nhif_submitted_claims|{0}|{1}|{2}".format(
+        facility_code, filters.ClaimYear, filters.ClaimMonth
+    )
 
 
 def get_nhif_data(filters):
-    token = get_claimsservice_token(filters.company)
     claimsserver_url, facility_code = frappe.get_value(
         "Company NHIF Settings", filters.company, ["claimsserver_url", "facility_code"])
+    cache_key = get_nhif_cache_key(facility_code, filters)
+    if not cint(filters.get("refresh_from_nhif")):
+        data = frappe.cache().get_value(cache_key)
+        if data is not None:
+            return data
+
+    token = get_claimsservice_token(filters.company)
     headers = {
         "Authorization": "Bearer " + token,
         "Content-Type": "application/json"
@@ -139,7 +265,9 @@ def get_nhif_data(filters):
     url = str(claimsserver_url) + \
         "/claimsserver/api/v1/Claims/getSubmittedClaims?FacilityCode={0}&ClaimYear={1}&ClaimMonth={2}".format(
             facility_code, filters.ClaimYear, filters.ClaimMonth)
-    r = requests.get(url, headers=headers, timeout=300)
+    r = nhif_request(
+        "GET", url, "getSubmittedClaims", read_timeout=LONG_READ_TIMEOUT, headers=headers
+    )
     if r.status_code != 200:
         add_log(
             request_type="getSubmittedClaims",
@@ -158,11 +286,12 @@ def get_nhif_data(filters):
                 response_data=r.text,
                 status_code=r.status_code
             )
-        if json.loads(r.text):
+        data = json.loads(r.text) or []
+        frappe.cache().set_value(cache_key, data, expires_in_sec=NHIF_CLAIMS_CACHE_TTL)
+        if data:
             frappe.msgprint(
                 _("The claims has been loaded successfully"), alert=True)
-            return json.loads(r.text)
         else:
             frappe.msgprint(
                 _("No Data"), alert=True)
-            return []
+        return data
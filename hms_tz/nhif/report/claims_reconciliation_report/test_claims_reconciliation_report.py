@@ -0,0 +1,82 @@
+# Copyright (c) 2022, Aakvatech and Contributors
+# See license.txt
+
+import frappe
+import unittest
+from unittest.mock import patch
+from hms_tz.nhif.report.claims_reconciliation_report.claims_reconciliation_report import (
+	get_data,
+)
+
+REPORT_MODULE = "hms_tz.nhif.report.claims_reconciliation_report.claims_reconciliation_report"
+
+
+def make_claim(name, folio_id, folio_no, total_amount, docstatus=1):
+	return frappe._dict(
+		name=name,
+		folio_id=folio_id,
+		folio_no=folio_no,
+		claim_year=2022,
+		claim_month=11,
+		total_amount=total_amount,
+		docstatus=docstatus,
+	)
+
+
+def get_report_data(nhif_data, claims, view=None):
+	filters = frappe._dict(company="_Test Company", ClaimYear=2022, ClaimMonth=11, view=view)
+	with patch(REPORT_MODULE + ".get_nhif_data", return_value=nhif_data), patch(
+		REPORT_MODULE + ".get_local_claims", return_value=claims
+	):
+		return get_data(filters)
+
+
+class TestClaimsReconciliationReport(unittest.TestCase):
+	def test_join_by_submission_id_prefers_submitted_claim(self):
+		data = get_report_data(
+			[{"SubmissionID": "SUB-1", "FolioNo": 7, "AmountClaimed": 100}],
+			[
+				make_claim("CLM-1-1", "SUB-1", 7, 100),
+				make_claim("CLM-1", "SUB-1", 7, 90, docstatus=2),
+			],
+		)
+		self.assertEqual(data[0].name, "CLM-1-1")
+		self.assertFalse(data[0].get("discrepancy"))
+
+	def test_join_by_folio_no(self):
+		data = get_report_data(
+			[{"SubmissionID": "SUB-2", "FolioNo": "8", "AmountClaimed": 50}],
+			[make_claim("CLM-2", None, 8, 50)],
+		)
+		self.assertEqual(data[0].name, "CLM-2")
+		self.assertFalse(data[0].get("discrepancy"))
+
+	def test_discrepancies(self):
+		data = get_report_data(
+			[
+				{"SubmissionID": "SUB-1", "FolioNo": 1, "AmountClaimed": 100},
+				{"SubmissionID": "SUB-2", "FolioNo": 2, "TotalAmountClaimed": 60},
+				{"SubmissionID": "SUB-3", "FolioNo": 3, "AmountClaimed": 70},
+			],
+			[
+				make_claim("CLM-1", "SUB-1", 1, 100),
+				make_claim("CLM-2", "SUB-2", 2, 50),
+				make_claim("CLM-4", "SUB-4", 4, 80),
+			],
+			view="Discrepancies",
+		)
+		self.assertEqual(
+			[(row.get("name"), row.get("SubmissionID"), row.discrepancy) for row in data],
+			[
+				("CLM-2", "SUB-2", "Amount Mismatch"),
+				(None, "SUB-3", "Missing Locally"),
+				("CLM-4", None, "Missing at NHIF"),
+			],
+		)
+
+	def test_all_view_keeps_matched_rows(self):
+		data = get_report_data(
+			[{"SubmissionID": "SUB-1", "FolioNo": 1, "AmountClaimed": 100}],
+			[make_claim("CLM-1", "SUB-1", 1, 100), make_claim("CLM-4", "SUB-4", 4, 80)],
+		)
+		self.assertEqual([row.name for row in data], ["CLM-1"])
@@ -22,6 +22,12 @@ frappe.query_reports["Monthly NHIF Summary"] = {
 			"fieldtype": "Link",
 			"options": "Company",
 			"reqd": 1
+		},
+		{
+			"fieldname": "trend_months",
+			"label": __("Trend Months"),
+			"fieldtype": "Int",
+			"description": __("Show this many months up to the selected one")
 		}
 
 	]
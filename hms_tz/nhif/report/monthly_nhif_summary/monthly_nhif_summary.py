@@ -3,13 +3,18 @@
 
 import frappe
 from frappe import _
-from frappe.utils import getdate
+from frappe.utils import getdate, cint, flt
+from hms_tz.nhif.doctype.nhif_monthly_claim_summary.nhif_monthly_claim_summary import (
+    SUMMARY_FIELDS,
+    get_claim_summaries,
+    get_summary_name,
+)
 import calendar
 
 
 def execute(filters):
     data = []
-    columns = get_columns()
+    columns = get_columns(filters)
 
     nhif_summary = get_data(filters)
     if nhif_summary:
@@ -28,8 +33,11 @@ def execute(filters):
     return columns, data
 
 
-def get_columns():
-    columns = [
+def get_columns(filters=None):
+    columns = []
+    if filters and cint(filters.get("trend_months")) > 1:
+        columns.append({"fieldname": "period", "label": _("Month"), "fieldtype": "Data"})
+    columns += [
         {"fieldname": "male", "label": _("Male"), "fieldtype": "Data"},
         {"fieldname": "female", "label": _("Female"), "fieldtype": "Data"},
         {
@@ -67,98 +75,72 @@ def get_columns():
 
 
 def get_data(filters):
-    details = []
-    parent_list = []
-
-    male_count = (
-        female_count
-    ) = total_amount = total_amount_for_out_patient = total_amount_for_inpatient = 0
-    consultation = (
-        diagnostic_examination
-    ) = surgical_produceral_charge = medicine = inpatient_charges = 0
-
-    claims = frappe.get_all(
-        "NHIF Patient Claim",
-        filters=[
-            ["docstatus", "=", 1],
-            ["company", "=", filters.get("company")],
-            ["claim_month", "=", filters.get("submit_claim_month")],
-            ["claim_year", "=", filters.get("submit_claim_year")]
-        ],
-        fields=["name", "company", "facility_code", "gender", "total_amount"],
-    )
-    if not claims:
+    company = filters.get("company")
+    claim_year = cint(filters.get("submit_claim_year"))
+    claim_month = cint(filters.get("submit_claim_month"))
+
+    # the selected month, preceded by the earlier ones of a trend view
+    periods = []
+    for i in range(max(cint(filters.get("trend_months")), 1) - 1, -1, -1):
+        month_index = claim_year * 12 + claim_month - 1 - i
+        periods.append((month_index // 12, month_index % 12 + 1))
+
+    summaries = get_summaries(company, periods)
+    if (claim_year, claim_month) not in summaries:
         return []
 
-    facility_code = claims[0]["facility_code"]
-    facility_name = claims[0]["company"]
-
-    for claim_doc in claims:
-        parent_list.append(claim_doc.name)
-
-        if claim_doc.gender == "Male":
-            male_count += 1
-        else:
-            female_count += 1
-
-    items = frappe.get_all(
-        "NHIF Patient Claim Item",
-        filters={"parent": ["in", parent_list]},
-        fields=["ref_doctype", "amount_claimed"],
-    )
-
-    for item in items:
-        if item.ref_doctype == "Patient Appointment":
-            consultation += item.amount_claimed
-        elif item.ref_doctype == "Drug Prescription":
-            medicine += item.amount_claimed
-        elif (item.ref_doctype == "Lab Prescription") | (
-            item.ref_doctype == "Radiology Procedure Prescription"
-        ):
-            diagnostic_examination += item.amount_claimed
-        elif (item.ref_doctype == "Procedure Prescription") | (
-            item.ref_doctype == "Therapy Plan Detail"
-        ):
-            surgical_produceral_charge += item.amount_claimed
-        else:
-            inpatient_charges += item.amount_claimed
-
-    total_amount = (
-        consultation
-        + medicine
-        + diagnostic_examination
-        + surgical_produceral_charge
-        + inpatient_charges
-    )
-
-    first_day_of_month = getdate(
-        str(filters.get('submit_claim_year')) + '-' + str(filters.get('submit_claim_month')) + '-1'
-    )
-
-    last_day_of_month = first_day_of_month.replace(
-        day = calendar.monthrange(first_day_of_month.year, first_day_of_month.month)[1]
-    )
-    
-    details.append(
-        {
-            "from_date": first_day_of_month,
-            "to_date": last_day_of_month,
-            "accreditation_no": "01440",
-            "ownership": "Religious/NGO",
-            "facility_name": facility_name,
-            "facility_code": facility_code,
-            "male": male_count,
-            "female": female_count,
-            "total_patient": male_count + female_count,
-            "amount_claimed": total_amount,
-            "consultation": consultation,
-            "diagnostic_examination": diagnostic_examination,
-            "surgical_produceral_charge": surgical_produceral_charge,
-            "medicine": medicine,
-            "inpatient_charges": inpatient_charges,
-            "total_amount_for_out_patient": total_amount_for_out_patient,
-            "total_amount_for_inpatient": total_amount_for_inpatient,
-        }
-    )
+    details = []
+    for period in periods:
+        summary = summaries.get(period)
+        if not summary:
+            continue
+
+        first_day_of_month = getdate("{0}-{1}-1".format(*period))
+        last_day_of_month = first_day_of_month.replace(
+            day = calendar.monthrange(first_day_of_month.year, first_day_of_month.month)[1]
+        )
 
+        details.append(
+            {
+                "period": first_day_of_month.strftime("%b %Y"),
+                "from_date": first_day_of_month,
+                "to_date": last_day_of_month,
+                "accreditation_no": "01440",
+                "ownership": "Religious/NGO",
+                "facility_name": company,
+                "facility_code": summary.facility_code,
+                "male": cint(summary.male),
+                "female": cint(summary.female),
+                "total_patient": cint(summary.male) + cint(summary.female),
+                "amount_claimed": flt(summary.amount_claimed),
+                "consultation": flt(summary.consultation),
+                "diagnostic_examination": flt(summary.diagnostic_examination),
+                "surgical_produceral_charge": flt(summary.surgical_produceral_charge),
+                "medicine": flt(summary.medicine),
+                "inpatient_charges": flt(summary.inpatient_charges),
+                "total_amount_for_out_patient": 0,
+                "total_amount_for_inpatient": 0,
+            }
+        )
+
+    # the print format reads the selected month from the first row
+    details.reverse()
     return details
+
+
+def get_summaries(company, periods):
+    """Read the months from the NHIF Monthly Claim Summary rollup, falling
+    back to aggregating the claims for months it does not hold yet"""
+    summaries = {}
+    for row in frappe.get_all(
+        "NHIF Monthly Claim Summary",
+        filters={"name": ["in", [get_summary_name(company, *period) for period in periods]]},
+        fields=["claim_year", "claim_month", "facility_code"] + SUMMARY_FIELDS,
+    ):
+        if cint(row.male) + cint(row.female):
+            summaries[(row.claim_year, row.claim_month)] = row
+
+    missing = [period for period in periods if period not in summaries]
+    if missing:
+        summaries.update(get_claim_summaries(company, missing))
+    return summaries
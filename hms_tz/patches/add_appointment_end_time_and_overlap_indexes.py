@@ -0,0 +1,22 @@
+import frappe
+
+
+def execute():
+    frappe.reload_doc("hms_tz", "doctype", "patient_appointment")
+
+    # end time used by validate_overlaps, kept in sync on validate from now on
+    frappe.db.sql(
+        """
+        UPDATE `tabPatient Appointment`
+        SET appointment_end_time = TIMESTAMP(appointment_date, appointment_time)
+            + INTERVAL IFNULL(duration, 0) MINUTE
+        WHERE appointment_date IS NOT NULL AND appointment_time IS NOT NULL
+    """
+    )
+
+    for field in ("practitioner", "patient"):
+        frappe.db.add_index(
+            "Patient Appointment",
+            ["appointment_date", field, "appointment_time", "appointment_end_time"],
+            index_name="appointment_date_{0}_time_index".format(field),
+        )
@@ -0,0 +1,10 @@
+import frappe
+
+
+def execute():
+    # used by get_claims_usage to count claims per subscription over a date range
+    frappe.db.add_index(
+        "Patient Encounter",
+        ["insurance_subscription", "creation"],
+        index_name="insurance_subscription_creation_index",
+    )
@@ -0,0 +1,13 @@
+import frappe
+
+
+def execute():
+    frappe.reload_doc("nhif", "doctype", "nhif_patient_claim")
+
+    # folio_id has search_index set, the month lookup of the reconciliation
+    # report needs its own index
+    frappe.db.add_index(
+        "NHIF Patient Claim",
+        ["company", "claim_year", "claim_month", "folio_no"],
+        index_name="company_claim_month_folio_index",
+    )
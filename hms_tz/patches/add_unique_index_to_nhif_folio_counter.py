@@ -0,0 +1,25 @@
+import frappe
+
+
+def execute():
+    # keep the highest counter of each month, the others only held folio
+    # numbers already handed out
+    frappe.db.sql(
+        """
+        DELETE counter FROM `tabNHIF Folio Counter` counter
+        INNER JOIN `tabNHIF Folio Counter` other
+            ON other.company <=> counter.company
+            AND other.claim_year <=> counter.claim_year
+            AND other.claim_month <=> counter.claim_month
+            AND (
+                IFNULL(other.folio_no, 0) > IFNULL(counter.folio_no, 0)
+                OR (
+                    IFNULL(other.folio_no, 0) = IFNULL(counter.folio_no, 0)
+                    AND other.name > counter.name
+                )
+            )
+    """
+    )
+
+    # on_doctype_update adds the unique key on company, claim year and month
+    frappe.reload_doc("nhif", "doctype", "nhif_folio_counter")
@@ -0,0 +1,12 @@
+import frappe
+from hms_tz.nhif.doctype.nhif_monthly_claim_summary.nhif_monthly_claim_summary import (
+    build_claim_summaries,
+)
+
+
+def execute():
+    frappe.reload_doc("nhif", "doctype", "nhif_monthly_claim_summary")
+    for company in frappe.get_all(
+        "NHIF Patient Claim", filters={"docstatus": 1}, pluck="company", distinct=True
+    ):
+        build_claim_summaries(company)
@@ -0,0 +1,44 @@
+import frappe
+import json
+from hms_tz.nhif.doctype.nhif_response_log.nhif_response_log import get_log_payload
+from hms_tz.nhif.doctype.nhif_price_package_snapshot.nhif_price_package_snapshot import (
+    save_snapshot,
+)
+
+
+def execute():
+    """Snapshot the last two price package downloads of every facility, so
+    the next download can be diffed against the store"""
+    frappe.reload_doc("nhif", "doctype", "nhif_price_package_snapshot")
+
+    for setting in frappe.get_all(
+        "Company NHIF Settings",
+        filters={"facility_code": ["is", "set"]},
+        fields=["company", "facility_code"],
+    ):
+        if frappe.db.exists(
+            "NHIF Price Package Snapshot", {"facility_code": setting.facility_code}
+        ):
+            continue
+
+        logs = frappe.get_all(
+            "NHIF Response Log",
+            filters={
+                "request_type": "GetPricePackageWithExcludedServices",
+                "response_data": ["not in", ["", None]],
+                "request_url": ["like", "%" + setting.facility_code + "%"],
+                "status_code": "200",
+            },
+            fields=["name", "creation"],
+            order_by="creation desc",
+            page_length=2,
+        )
+        for log in reversed(logs):
+            try:
+                data = json.loads(get_log_payload(log.name, "response_data"))
+            except ValueError:
+                continue
+            save_snapshot(
+                setting.company, setting.facility_code, data, log.name, log.creation
+            )
+        frappe.db.commit()
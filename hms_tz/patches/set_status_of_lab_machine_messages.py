@@ -0,0 +1,14 @@
+import frappe
+
+
+def execute():
+    frappe.reload_doc("nhif", "doctype", "lab_machine_message")
+
+    # messages received before the queue were applied on save
+    frappe.db.sql(
+        """
+        UPDATE `tabLab Machine Message`
+        SET status = IF(IFNULL(lab_test, '') = '', 'Unmatched', 'Processed')
+        WHERE IFNULL(status, '') IN ('', 'Queued')
+    """
+    )